@@ -5,5 +5,8 @@
 from .renderer import *
 from .camera import *
 from .shot import *
+from .surface import *
+from .profiling import *
+from .cache import *
 from .utils import *
-from .globals import __version__
+from .globals import ContextManager, ShareGroup, __version__
@@ -0,0 +1,460 @@
+"""
+    Headless benchmarks of the loading and rendering hot paths.
+
+    Run with `python -m alfr.benchmark -o results.json` (EGL is used as fallback
+    without a display). The results are written as json and can be compared
+    between releases with `python -m alfr.benchmark --compare old.json new.json`.
+    With `--scaling` synthetic light fields of 10 to 10,000 shots are benchmarked
+    instead, recording wall time, host memory (RSS) and texture memory.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+import numpy as np
+import moderngl
+from alfr.globals import ContextManager, __version__
+from alfr.camera import Camera
+from alfr.renderer import Renderer
+from alfr.shot import ShotCollection, memory_usage
+from alfr.synthetic import SYNTHETIC_ROTATION, synthetic_shots
+from alfr.utils import (
+    export_shots_to_csv,
+    export_shots_to_npz,
+    load_shots_from_csv,
+    load_shots_from_json,
+    load_shots_from_npz,
+)
+from typing import Callable, List, Sequence
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# the scene shipped with the repository
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+
+# shot loaders by format, the debug scene is exported to the other formats
+LOADERS = {
+    "json": load_shots_from_json,
+    "npz": load_shots_from_npz,
+    "csv": load_shots_from_csv,
+}
+EXPORTERS = {
+    "npz": export_shots_to_npz,
+    "csv": export_shots_to_csv,
+}
+
+SHOT_COUNTS = (1, 18, 72)
+RESOLUTIONS = ((256, 256), (512, 512), (1024, 1024))
+QUICK_SHOT_COUNTS = (1, 18)
+QUICK_RESOLUTIONS = ((256, 256),)
+SCALING_SHOT_COUNTS = (10, 100, 1000, 10000)
+
+
+def time_call(fn: Callable, repeat: int = 5, warmup: int = 1) -> dict:
+    """Time the function call.
+
+    Args:
+        fn (callable): the function to time, called without arguments
+        repeat (int): number of timed calls
+        warmup (int): number of untimed calls before (shader compilation,
+            lazily created framebuffers, ...)
+
+    Returns:
+        dict: the times (seconds) of all calls and their min, median and mean
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return _timing(times)
+
+
+def _timing(times: List[float]) -> dict:
+    return {
+        "times": times,
+        "min": min(times),
+        "median": float(np.median(times)),
+        "mean": float(np.mean(times)),
+    }
+
+
+def _debug_scene_camera() -> Camera:
+    """A virtual camera seeing the focal plane of the debug scene."""
+    return Camera(quaternion=[0.0, 1.0, 0.0, 0.0])
+
+
+def _coverage(integral: np.ndarray) -> float:
+    """The fraction of the pixels of an integral covered by at least one shot."""
+    return float(np.count_nonzero(integral[..., 3]) / integral[..., 3].size)
+
+
+def _check_coverage(coverage: float, case: str):
+    # an empty image is cheap, its timings say nothing about the renderer
+    if coverage == 0.0:
+        raise RuntimeError(f"The virtual camera of {case} does not see any shot")
+
+
+def _repeat_shots(shots: list, n: int) -> list:
+    """n shots, the shots are repeated if there are fewer."""
+    return [shots[i % len(shots)] for i in range(n)]
+
+
+def _rss_bytes() -> int:
+    """The current resident set size of the process (None if unknown)."""
+    if resource is None:
+        return None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def _peak_rss_bytes() -> int:
+    """The peak resident set size of the process so far (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on linux
+
+
+def _environment(ctx: moderngl.Context) -> dict:
+    return {
+        "alfr": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "moderngl": moderngl.__version__,
+        "gl_vendor": ctx.info["GL_VENDOR"],
+        "gl_renderer": ctx.info["GL_RENDERER"],
+        "gl_version": ctx.info["GL_VERSION"],
+    }
+
+
+def benchmark_loading(
+    scene: str = DEBUG_SCENE,
+    formats: Sequence[str] = tuple(LOADERS),
+    repeat: int = 5,
+    ctx: moderngl.Context = None,
+) -> List[dict]:
+    """Time loading the shots of the scene from each format.
+
+    Args:
+        scene (str): pose json file of the scene
+        formats (Sequence[str]): formats of `LOADERS`
+        repeat (int): number of timed loads per format
+
+    Returns:
+        List[dict]: one result per format
+    """
+    results = []
+    shots = load_shots_from_json(scene, ctx=ctx)
+    export_dir = tempfile.mkdtemp(prefix="alfr_benchmark_")
+    try:
+        for fmt in formats:
+            if fmt == "json":
+                file = scene
+            else:
+                # exported to a temporary directory, the image paths are stored
+                # relative to it and resolved again when loading
+                file = os.path.join(export_dir, "poses." + fmt)
+                EXPORTERS[fmt](shots, file)
+            loader = LOADERS[fmt]
+            result = {
+                "name": "load_shots",
+                "params": {"format": fmt, "shots": len(shots)},
+            }
+            result.update(time_call(lambda: loader(file, ctx=ctx), repeat))
+            results.append(result)
+    finally:
+        shutil.rmtree(export_dir, ignore_errors=True)
+    return results
+
+
+def benchmark_rendering(
+    scene: str = DEBUG_SCENE,
+    shot_counts: Sequence[int] = SHOT_COUNTS,
+    resolutions: Sequence[tuple] = RESOLUTIONS,
+    repeat: int = 5,
+    ctx: moderngl.Context = None,
+) -> List[dict]:
+    """Time `project_shot`, `project_multiple_shots` and `integrate`.
+
+    The shots of the scene are repeated to reach the shot counts. The shots are
+    passed as list and as `ShotCollection`. The integrate results hold the
+    fraction of the pixels covered by the shots; a RuntimeError is raised if
+    the virtual camera sees none, the timings would measure empty images.
+
+    Args:
+        scene (str): pose json file of the scene
+        shot_counts (Sequence[int]): numbers of shots
+        resolutions (Sequence[tuple]): resolutions of the rendered images
+        repeat (int): number of timed calls per case
+
+    Returns:
+        List[dict]: one result per case
+    """
+    results = []
+    scene_shots = load_shots_from_json(scene, ctx=ctx)
+    vcam = _debug_scene_camera()
+
+    for resolution in resolutions:
+        renderer = Renderer(resolution, ctx=ctx)
+
+        result = {
+            "name": "project_shot",
+            "params": {"resolution": list(resolution), "shots": 1},
+        }
+        result.update(
+            time_call(lambda: renderer.project_shot(scene_shots[0], vcam), repeat)
+        )
+        results.append(result)
+
+        for n in shot_counts:
+            shots = _repeat_shots(scene_shots, n)
+            for container, container_shots in (
+                ("list", shots),
+                ("collection", ShotCollection.from_shots(shots)),
+            ):
+                params = {
+                    "resolution": list(resolution),
+                    "shots": n,
+                    "container": container,
+                }
+                for name, fn in (
+                    ("project_multiple_shots", renderer.project_multiple_shots),
+                    ("integrate", renderer.integrate),
+                ):
+                    result = {"name": name, "params": dict(params)}
+                    result.update(time_call(lambda: fn(container_shots, vcam), repeat))
+                    results.append(result)
+                result["coverage"] = _coverage(
+                    renderer.integrate(container_shots, vcam)
+                )
+                _check_coverage(result["coverage"], f"the {n} shots")
+    return results
+
+
+def run_benchmarks(
+    scene: str = DEBUG_SCENE,
+    shot_counts: Sequence[int] = SHOT_COUNTS,
+    resolutions: Sequence[tuple] = RESOLUTIONS,
+    formats: Sequence[str] = tuple(LOADERS),
+    repeat: int = 5,
+    ctx: moderngl.Context = None,
+) -> dict:
+    """Run all benchmarks.
+
+    Returns:
+        dict: the environment (versions, GL renderer) and the results
+    """
+    if ctx is None:
+        ctx = ContextManager.get_default_context()
+    return {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "environment": _environment(ctx),
+        "results": benchmark_loading(scene, formats, repeat, ctx)
+        + benchmark_rendering(scene, shot_counts, resolutions, repeat, ctx),
+    }
+
+
+def benchmark_scaling(
+    shot_counts: Sequence[int] = SCALING_SHOT_COUNTS,
+    shot_resolution: tuple = (64, 64),
+    channels: int = 3,
+    resolution: tuple = (256, 256),
+    layout: str = "grid",
+    repeat: int = 3,
+    ctx: moderngl.Context = None,
+) -> List[dict]:
+    """Time creating and integrating synthetic light fields of growing size.
+
+    Each light field is created in memory with `synthetic_shots` and released
+    before the next one. Besides the times, the results hold the host memory
+    (current and peak RSS of the process, in bytes) and the bytes of the shot
+    textures after creating the shots, the integrate results the coverage (see
+    `benchmark_rendering`).
+
+    Args:
+        shot_counts (Sequence[int]): numbers of shots
+        shot_resolution (tuple): resolution of the shot images
+        channels (int): number of channels of the shot images
+        resolution (tuple): resolution of the integral
+        layout (str): layout of the shots (see `alfr.synthetic.LAYOUTS`)
+        repeat (int): number of timed integrals per shot count
+
+    Returns:
+        List[dict]: a "synthetic_shots" and an "integrate" result per shot count
+    """
+    results = []
+    renderer = Renderer(resolution, ctx=ctx)
+    vcam = Camera(quaternion=SYNTHETIC_ROTATION)
+
+    for n in shot_counts:
+        params = {
+            "shots": n,
+            "shot_resolution": list(shot_resolution),
+            "channels": channels,
+            "layout": layout,
+        }
+        start = time.perf_counter()
+        shots = synthetic_shots(n, shot_resolution, channels, layout, ctx=ctx)
+        result = {"name": "synthetic_shots", "params": params}
+        result.update(_timing([time.perf_counter() - start]))
+        result.update(
+            rss=_rss_bytes(),
+            peak_rss=_peak_rss_bytes(),
+            texture_bytes=memory_usage(shots).texture_bytes,
+        )
+        results.append(result)
+
+        result = {
+            "name": "integrate",
+            "params": dict(params, resolution=list(resolution)),
+        }
+        result.update(time_call(lambda: renderer.integrate(shots, vcam), repeat))
+        result.update(
+            rss=_rss_bytes(),
+            peak_rss=_peak_rss_bytes(),
+            coverage=_coverage(renderer.integrate(shots, vcam)),
+        )
+        _check_coverage(result["coverage"], f"the {n} synthetic shots")
+        results.append(result)
+
+        for shot in shots:
+            shot.texture.release()
+        del shots
+    return results
+
+
+def _case_key(result: dict) -> str:
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare_benchmarks(baseline: dict, current: dict) -> List[dict]:
+    """Compare the median times of the cases in both benchmark results.
+
+    Returns:
+        List[dict]: name, params, both medians and their ratio (current /
+            baseline) of the cases found in both results
+    """
+    baseline_cases = {_case_key(result): result for result in baseline["results"]}
+    comparison = []
+    for result in current["results"]:
+        base = baseline_cases.get(_case_key(result))
+        if base is None:
+            continue
+        comparison.append(
+            {
+                "name": result["name"],
+                "params": result["params"],
+                "baseline": base["median"],
+                "current": result["median"],
+                "ratio": result["median"] / base["median"],
+            }
+        )
+    return comparison
+
+
+def _print_results(results: List[dict]):
+    for result in results:
+        params = ", ".join(f"{k}={v}" for k, v in result["params"].items())
+        line = f"{result['name']:24s} {params:54s} {result['median']*1000:10.2f} ms"
+        if result.get("peak_rss") is not None:
+            line += f", peak RSS {result['peak_rss'] / 2**20:.0f} MiB"
+        if "coverage" in result:
+            line += f", coverage {result['coverage']:.2f}"
+        if "texture_bytes" in result:
+            line += f", textures {result['texture_bytes'] / 2**20:.0f} MiB"
+        print(line)
+
+
+def _print_comparison(comparison: List[dict]):
+    for case in comparison:
+        params = ", ".join(f"{k}={v}" for k, v in case["params"].items())
+        print(
+            f"{case['name']:24s} {params:54s} {case['baseline']*1000:10.2f} ms"
+            f" -> {case['current']*1000:10.2f} ms ({case['ratio']:.2f}x)"
+        )
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m alfr.benchmark", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument("-o", "--output", help="write the results to a json file")
+    parser.add_argument("--scene", default=DEBUG_SCENE, help="pose json file")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument(
+        "--quick", action="store_true", help="fewer shot counts and resolutions"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CURRENT"),
+        help="compare two result files instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        help="benchmark synthetic light fields of growing size instead",
+    )
+    parser.add_argument(
+        "--max-shots",
+        type=int,
+        default=max(SCALING_SHOT_COUNTS),
+        help="largest light field of --scaling",
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        _print_comparison(compare_benchmarks(baseline, current))
+        return
+
+    if args.scaling:
+        ctx = ContextManager.get_default_context()
+        benchmarks = {
+            "version": BENCHMARK_FORMAT_VERSION,
+            "environment": _environment(ctx),
+            "results": benchmark_scaling(
+                [n for n in SCALING_SHOT_COUNTS if n <= args.max_shots],
+                repeat=args.repeat,
+                ctx=ctx,
+            ),
+        }
+    else:
+        benchmarks = run_benchmarks(
+            args.scene,
+            QUICK_SHOT_COUNTS if args.quick else SHOT_COUNTS,
+            QUICK_RESOLUTIONS if args.quick else RESOLUTIONS,
+            repeat=args.repeat,
+        )
+    _print_results(benchmarks["results"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(benchmarks, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
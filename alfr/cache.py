@@ -0,0 +1,462 @@
+"""
+    Cache of rendered images for repeated requests of (nearly) the same view.
+
+    A `ResultCache` assigned to `Renderer.cache` answers `Renderer.integrate`
+    and `Renderer.project_shot` from memory (and optionally from disk). Results
+    are keyed by the identity of the shot set, the quantized pose, field of view
+    and focus of the virtual camera, the resolution and all other arguments, so
+    views closer than the quantization steps share one result.
+"""
+import collections
+import hashlib
+import itertools
+import os
+import threading
+import weakref
+import numpy as np
+import moderngl
+from alfr.globals import __version__
+from alfr.camera import Camera
+from alfr.shot import Shot, ShotCollection
+from typing import List, Union
+
+CACHE_FORMAT_VERSION = 1
+
+# default quantization steps of the virtual camera:
+#   position in scene units, rotation per quaternion component (about 0.01
+#   degrees), field of view in degrees and focus (depth) in scene units
+POSITION_STEP = 1e-3
+ROTATION_STEP = 1e-4
+FOV_STEP = 1e-2
+FOCUS_STEP = 1e-3
+
+# Counters of a result cache:
+#   hits: results found in memory
+#   disk_hits: results found on disk (and moved to memory)
+#   misses: results rendered
+#   bypassed: calls that cannot be cached (weight functions, focal surfaces,
+#       unhashable arguments)
+#   evictions: results dropped from memory to stay within the memory limit
+#   entries: the number of results in memory
+#   bytes: the memory of these results
+CacheStats = collections.namedtuple(
+    "CacheStats",
+    ["hits", "disk_hits", "misses", "bypassed", "evictions", "entries", "bytes"],
+)
+
+
+def _digest(*parts) -> str:
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str((part.dtype, part.shape)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+# digests of collections, they are immutable
+_collection_keys = weakref.WeakKeyDictionary()
+# digests of recently used lists of shots by list id, with weak references to
+# the shots and their state (see `_shot_state`) to detect changes
+_list_keys = collections.OrderedDict()
+_MAX_LIST_KEYS = 64
+_keys_lock = threading.Lock()
+# serial numbers of textures of shots created from arrays, their names (glo)
+# are only unique within a context and every thread has its own context
+_texture_serials = weakref.WeakKeyDictionary()
+_texture_serial_counter = itertools.count()
+
+
+def shot_set_key(shots: Union[List[Shot], ShotCollection]) -> tuple:
+    """Identity of a shot set: a digest of the poses and images of the shots.
+
+    Shots loaded from files are identified by their image files (path, mtime
+    and size), so reloading them gives the same key. Shots created from arrays
+    are identified by their texture objects (in any context), their results are
+    not kept on disk.
+
+    The keys of collections and of recently used lists are kept, so a repeated
+    call does not read the files again. A list is checked for changed shots by
+    their state (see `_shot_state`).
+
+    Returns:
+        tuple: the digest and whether it is valid in other processes
+    """
+    if isinstance(shots, ShotCollection):
+        key = _collection_keys.get(shots)
+        if key is None:
+            key = _shot_set_key(
+                shots.positions,
+                shots.quaternions,
+                shots.fov_degrees,
+                shots.aspect_ratios,
+                shots.distortion_models,
+                shots.distortions,
+                shots.weights,
+                np.tile([shots._z_near, shots._z_far], (len(shots), 1)),
+                shots.image_files,
+                shots.textures,
+            )
+            _collection_keys[shots] = key
+        return key
+    with _keys_lock:
+        refs_and_states = _list_keys.get(id(shots))
+    if refs_and_states is not None:
+        refs, states, key = refs_and_states
+        if len(refs) == len(shots) and all(
+            ref() is shot and state == _shot_state(shot)
+            for ref, state, shot in zip(refs, states, shots)
+        ):
+            return key
+    key = _list_key(shots)
+    refs_and_states = (
+        [weakref.ref(shot) for shot in shots],
+        [_shot_state(shot) for shot in shots],
+        key,
+    )
+    with _keys_lock:
+        _list_keys[id(shots)] = refs_and_states
+        _list_keys.move_to_end(id(shots))
+        while len(_list_keys) > _MAX_LIST_KEYS:
+            _list_keys.popitem(last=False)
+    return key
+
+
+def _shot_state(shot: Shot) -> tuple:
+    """The state of a shot entering its key.
+
+    The pose setters replace the position and rotation objects (this also
+    invalidates the cached matrices), so their ids tell whether they changed.
+    """
+    return (
+        id(shot.texture),
+        id(shot._camera_position),
+        id(shot._rotation),
+        shot._field_of_view_degrees,
+        shot._ratio,
+        shot._z_near,
+        shot._z_far,
+        shot._distortion_code,
+        shot._distortion.tobytes(),
+        shot.weight,
+    )
+
+
+def _list_key(shots: List[Shot]) -> tuple:
+    return _shot_set_key(
+        np.array([shot.position for shot in shots]).reshape(-1, 3),
+        np.array([shot.rotation for shot in shots]).reshape(-1, 4),
+        np.array([shot.fov_degree for shot in shots], dtype=float),
+        np.array([shot.aspect_ratio for shot in shots], dtype=float),
+        np.array([shot._distortion_code for shot in shots], dtype=np.int32),
+        np.array([shot.distortion for shot in shots], dtype="f4").reshape(-1, 4),
+        np.array([shot.weight for shot in shots], dtype=float),
+        np.array([(shot._z_near, shot._z_far) for shot in shots]).reshape(-1, 2),
+        [shot.image_file for shot in shots],
+        [shot.texture for shot in shots],
+    )
+
+
+def _shot_set_key(
+    positions: np.ndarray,
+    quaternions: np.ndarray,
+    fovy: np.ndarray,
+    ratios: np.ndarray,
+    distortion_models: np.ndarray,
+    distortions: np.ndarray,
+    weights: np.ndarray,
+    clipping: np.ndarray,
+    image_files,
+    textures,
+) -> tuple:
+    persistent = all(file is not None for file in image_files)
+    if persistent:
+        try:
+            # rewritten images get a new key, as for the pose cache
+            images = []
+            for file in image_files:
+                stat = os.stat(file)
+                images.append((os.path.realpath(file), stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            persistent = False
+    if not persistent:
+        images = [_texture_serial(texture) for texture in textures]
+    digest = _digest(
+        np.asarray(positions, dtype=np.float64),
+        np.asarray(quaternions, dtype=np.float64),
+        np.asarray(fovy, dtype=np.float64),
+        np.asarray(ratios, dtype=np.float64),
+        np.asarray(distortion_models, dtype=np.int32),
+        np.asarray(distortions, dtype="f4"),
+        np.asarray(weights, dtype=np.float64),
+        np.asarray(clipping, dtype=np.float64),
+        images,
+    )
+    return digest, persistent
+
+
+def _texture_serial(texture: moderngl.Texture) -> int:
+    """A number identifying the texture (in any context) while it exists."""
+    with _keys_lock:
+        serial = _texture_serials.get(texture)
+        if serial is None:
+            serial = _texture_serials[texture] = next(_texture_serial_counter)
+    return serial
+
+
+def _quantize(values, step: float) -> tuple:
+    return tuple(int(v) for v in np.round(np.asarray(values, dtype=np.float64) / step))
+
+
+class ResultCache:
+    """LRU cache of rendered images, bounded in memory, with an optional disk tier.
+
+    The cache is thread-safe, so renderers of several threads can share it.
+    Results are returned as copies. With a disk directory, results are also
+    written there (as npy files) and found again after a restart; the least
+    recently used files are deleted beyond `max_disk_bytes`.
+
+    Example:
+        renderer.cache = ResultCache(max_bytes=512 << 20)
+        renderer.integrate(shots, vcam)  # rendered
+        renderer.integrate(shots, vcam)  # from the cache
+        print(renderer.cache.stats())
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 256 << 20,
+        disk_dir: str = None,
+        max_disk_bytes: int = 4 << 30,
+        position_step: float = POSITION_STEP,
+        rotation_step: float = ROTATION_STEP,
+        fov_step: float = FOV_STEP,
+        focus_step: float = FOCUS_STEP,
+    ):
+        """
+        Args:
+            max_bytes (int): the memory limit of the cached results
+            disk_dir (str): directory of the disk tier (created if missing),
+                None keeps the results in memory only
+            max_disk_bytes (int): the limit of the disk tier
+            position_step (float): quantization of the camera position
+            rotation_step (float): quantization of the camera quaternion
+            fov_step (float): quantization of the field of view in degrees
+            focus_step (float): quantization of the focus
+        """
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.position_step = position_step
+        self.rotation_step = rotation_step
+        self.fov_step = fov_step
+        self.focus_step = focus_step
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> array, oldest first
+        self._bytes = 0
+        self._counts = dict.fromkeys(
+            ["hits", "disk_hits", "misses", "bypassed", "evictions"], 0
+        )
+        self._disk_dir = disk_dir
+        self._disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def call_key(
+        self,
+        method: str,
+        arguments: dict,
+        output_layout: str,
+        resolution: tuple,
+        default_focus: float = None,
+    ) -> tuple:
+        """The key of a render call (None if it cannot be cached).
+
+        Args:
+            method (str): the name of the render method
+            arguments (dict): the arguments of the call by name; the shots are
+                given as "shots" or "shot", the camera as "vcam"
+            output_layout (str): the output layout of the renderer
+            resolution (tuple): the resolution of the image
+            default_focus (float): the focus of the renderer without one
+                (focus=None), so both give the same key
+
+        Returns:
+            tuple: the key, the last item tells whether it is valid on disk
+        """
+        arguments = dict(arguments)
+        shots = (
+            [arguments.pop("shot")] if "shot" in arguments else arguments.pop("shots")
+        )
+        vcam = arguments.pop("vcam")
+        focus = arguments.pop("focus", None)
+        if focus is None:
+            focus = default_focus
+        arguments.pop("resolution", None)
+        options = []
+        for name, value in sorted(arguments.items()):
+            if callable(value):
+                return None  # e.g. weight functions depend on more than the shots
+            if isinstance(value, (list, tuple, np.ndarray)):
+                value = np.asarray(value)
+                if value.dtype == object:
+                    return None
+                value = _digest(value)
+            else:
+                try:
+                    hash(value)
+                except TypeError:
+                    return None
+            options.append((name, value))
+        shots_key, persistent = shot_set_key(shots)
+        return (
+            method,
+            shots_key,
+            self.camera_key(vcam),
+            None if focus is None else _quantize([focus], self.focus_step),
+            tuple(int(v) for v in resolution),
+            output_layout,
+            tuple(options),
+            persistent,
+        )
+
+    def camera_key(self, vcam: Camera) -> tuple:
+        """The quantized pose, field of view and projection of the camera."""
+        q = np.asarray(vcam.rotation, dtype=np.float64)
+        q = q / np.linalg.norm(q)
+        if q[np.argmax(np.abs(q))] < 0:
+            q = -q  # q and -q are the same rotation
+        return (
+            _quantize(vcam.position, self.position_step),
+            _quantize(q, self.rotation_step),
+            _quantize([vcam.fov_degree], self.fov_step),
+            float(vcam.aspect_ratio),
+            (vcam._z_near, vcam._z_far),
+        )
+
+    def get(self, key: tuple) -> np.ndarray:
+        """The cached result (a copy) or None; a miss is counted."""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self._counts["hits"] += 1
+                return result.copy()
+        result = self._read(key)
+        with self._lock:
+            if result is None:
+                self._counts["misses"] += 1
+                return None
+            self._counts["disk_hits"] += 1
+            self._insert(key, result)
+        return result.copy()
+
+    def put(self, key: tuple, result: np.ndarray):
+        """Store a copy of the result (in memory and on disk)."""
+        result = np.array(result)
+        result.setflags(write=False)
+        with self._lock:
+            self._insert(key, result)
+        self._write(key, result)
+
+    def count_bypassed(self):
+        """Count a call that cannot be cached."""
+        with self._lock:
+            self._counts["bypassed"] += 1
+
+    def stats(self) -> CacheStats:
+        """The counters of the cache."""
+        with self._lock:
+            return CacheStats(
+                entries=len(self._entries), bytes=self._bytes, **self._counts
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of cacheable calls answered from memory or disk."""
+        with self._lock:
+            hits = self._counts["hits"] + self._counts["disk_hits"]
+            calls = hits + self._counts["misses"]
+        return hits / calls if calls else 0.0
+
+    def reset_stats(self):
+        """Reset the hit, miss and eviction counters."""
+        with self._lock:
+            self._counts = dict.fromkeys(self._counts, 0)
+
+    def clear(self, disk: bool = False):
+        """Drop the results in memory (and on disk)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if disk and self._disk_dir is not None:
+                for path, _, _ in self._disk_files():
+                    os.remove(path)
+                self._disk_bytes = 0
+
+    def _insert(self, key: tuple, result: np.ndarray):
+        if result.nbytes > self.max_bytes:
+            return  # kept on disk only
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+        self._entries[key] = result
+        self._bytes += result.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._counts["evictions"] += 1
+
+    def _disk_path(self, key: tuple) -> str:
+        if self._disk_dir is None or not key[-1]:
+            return None
+        name = _digest(CACHE_FORMAT_VERSION, __version__, key)
+        return os.path.join(self._disk_dir, name + ".npy")
+
+    def _disk_files(self) -> list:
+        """(path, size, mtime) of the files of the disk tier."""
+        files = []
+        for entry in os.scandir(self._disk_dir):
+            if entry.name.endswith(".npy") and entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _read(self, key: tuple) -> np.ndarray:
+        path = self._disk_path(key)
+        if path is None:
+            return None
+        try:
+            result = np.load(path)
+            os.utime(path)  # recently used
+        except (OSError, ValueError):
+            return None
+        result.setflags(write=False)
+        return result
+
+    def _write(self, key: tuple, result: np.ndarray):
+        path = self._disk_path(key)
+        if path is None or os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, result)
+        os.replace(tmp_path, path)  # atomic, readers never see partial files
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=lambda file: file[2])
+        self._disk_bytes = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
@@ -8,6 +8,140 @@ import numpy as np
 from pyrr import Matrix44, Quaternion, Vector3, vector
 
 
+def rotation_matrices(quaternions: np.ndarray) -> np.ndarray:
+    """Vectorized version of `Matrix33.from_quaternion`.
+
+    Args:
+        quaternions (np.ndarray): Nx4 quaternions in pyrr format (x,y,z,w)
+
+    Returns:
+        np.ndarray: Nx3x3 rotation matrices (in pyrr's row-vector convention)
+    """
+    q = np.asarray(quaternions, dtype=np.float64)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    invs = 1.0 / (x * x + y * y + z * z + w * w)  # normalizes the quaternions
+    m = np.empty((len(q), 3, 3))
+    m[:, 0, 0] = (x * x - y * y - z * z + w * w) * invs
+    m[:, 1, 1] = (-x * x + y * y - z * z + w * w) * invs
+    m[:, 2, 2] = (-x * x - y * y + z * z + w * w) * invs
+    m[:, 1, 0] = 2.0 * (x * y + z * w) * invs
+    m[:, 0, 1] = 2.0 * (x * y - z * w) * invs
+    m[:, 2, 0] = 2.0 * (x * z - y * w) * invs
+    m[:, 0, 2] = 2.0 * (x * z + y * w) * invs
+    m[:, 2, 1] = 2.0 * (y * z + x * w) * invs
+    m[:, 1, 2] = 2.0 * (y * z - x * w) * invs
+    return m
+
+
+def quaternions_from_matrices(matrices: np.ndarray) -> np.ndarray:
+    """Vectorized version of `Quaternion.from_matrix`.
+
+    Args:
+        matrices (np.ndarray): Nx3x3 (or Nx4x4) rotation matrices
+
+    Returns:
+        np.ndarray: Nx4 quaternions in pyrr format (x,y,z,w)
+    """
+    m = np.asarray(matrices, dtype=np.float64)
+    m00, m01, m02 = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+    m10, m11, m12 = m[:, 1, 0], m[:, 1, 1], m[:, 1, 2]
+    m20, m21, m22 = m[:, 2, 0], m[:, 2, 1], m[:, 2, 2]
+    trace = m00 + m11 + m22
+
+    # same case distinction as pyrr, which picks the numerically stable branch
+    case_w = trace > 0
+    case_x = ~case_w & (m00 > m11) & (m00 > m22)
+    case_y = ~case_w & ~case_x & (m11 > m22)
+    case_z = ~case_w & ~case_x & ~case_y
+
+    q = np.empty((len(m), 4))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = 0.5 / np.sqrt(trace + 1.0)
+        q[case_w] = np.stack(
+            [(m21 - m12) * s, (m02 - m20) * s, (m10 - m01) * s, 0.25 / s], axis=-1
+        )[case_w]
+        s = 2.0 * np.sqrt(1.0 + m00 - m11 - m22)
+        q[case_x] = np.stack(
+            [0.25 * s, (m01 + m10) / s, (m02 + m20) / s, (m21 - m12) / s], axis=-1
+        )[case_x]
+        s = 2.0 * np.sqrt(1.0 + m11 - m00 - m22)
+        q[case_y] = np.stack(
+            [(m01 + m10) / s, 0.25 * s, (m12 + m21) / s, (m02 - m20) / s], axis=-1
+        )[case_y]
+        s = 2.0 * np.sqrt(1.0 + m22 - m00 - m11)
+        q[case_z] = np.stack(
+            [(m02 + m20) / s, (m12 + m21) / s, 0.25 * s, (m10 - m01) / s], axis=-1
+        )[case_z]
+    return q
+
+
+def quaternion_products(q1: np.ndarray, q2: np.ndarray) -> np.ndarray:
+    """Vectorized version of `quaternion.cross` (Hamilton product) of Nx4 quaternions."""
+    x1, y1, z1, w1 = np.moveaxis(np.asarray(q1, dtype=np.float64), -1, 0)
+    x2, y2, z2, w2 = np.moveaxis(np.asarray(q2, dtype=np.float64), -1, 0)
+    return np.stack(
+        [
+            x1 * w2 + y1 * z2 - z1 * y2 + w1 * x2,
+            -x1 * z2 + y1 * w2 + z1 * x2 + w1 * y2,
+            x1 * y2 - y1 * x2 + z1 * w2 + w1 * z2,
+            -x1 * x2 - y1 * y2 - z1 * z2 + w1 * w2,
+        ],
+        axis=-1,
+    )
+
+
+def rotate_vectors(quaternions: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """Vectorized version of `Quaternion * Vector3` for Nx4 quaternions and Nx3 vectors."""
+    q = np.asarray(quaternions, dtype=np.float64)
+    v = np.zeros((len(q), 4))
+    v[:, :3] = vectors
+    conjugate = q * np.array([-1.0, -1.0, -1.0, 1.0])
+    return quaternion_products(q, quaternion_products(v, conjugate))[:, :3]
+
+
+def view_matrices(positions: np.ndarray, quaternions: np.ndarray) -> np.ndarray:
+    """Vectorized version of `Camera.view_matrix` for many cameras.
+
+    Args:
+        positions (np.ndarray): Nx3 camera positions
+        quaternions (np.ndarray): Nx4 camera rotations (x,y,z,w)
+
+    Returns:
+        np.ndarray: Nx4x4 view matrices
+    """
+    R = rotation_matrices(quaternions)
+    m = np.zeros((len(R), 4, 4))
+    m[:, :3, :3] = R
+    m[:, 3, :3] = -np.einsum("ni,nij->nj", np.asarray(positions, dtype=np.float64), R)
+    m[:, 3, 3] = 1.0
+    return m
+
+
+def projection_matrices(
+    fovy_degrees: np.ndarray, ratios: np.ndarray, z_near: float, z_far: float
+) -> np.ndarray:
+    """Vectorized version of `Camera.projection_matrix` for many cameras.
+
+    Args:
+        fovy_degrees (np.ndarray): N vertical fields of view in degrees
+        ratios (np.ndarray): N aspect ratios (width / height)
+        z_near (float): distance of the near clipping plane
+        z_far (float): distance of the far clipping plane
+
+    Returns:
+        np.ndarray: Nx4x4 perspective projection matrices
+    """
+    ymax = z_near * np.tan(np.asarray(fovy_degrees, dtype=np.float64) * np.pi / 360.0)
+    xmax = ymax * ratios
+    m = np.zeros((len(ymax), 4, 4))
+    m[:, 0, 0] = z_near / xmax
+    m[:, 1, 1] = z_near / ymax
+    m[:, 2, 2] = -(z_far + z_near) / (z_far - z_near)
+    m[:, 2, 3] = -1.0
+    m[:, 3, 2] = -2.0 * z_far * z_near / (z_far - z_near)
+    return m
+
+
 class Camera:
     def __init__(
         self,
@@ -20,6 +154,12 @@ class Camera:
         camera_front: Vector3 = None,
         camera_up: Vector3 = None,
     ):
+        # cached matrices, rebuilt lazily after the camera has changed
+        self._projection_matrix = None
+        self._view_matrix = None
+        self._projection_matrix_f4 = None
+        self._view_matrix_f4 = None
+
         self._field_of_view_degrees = field_of_view_degrees
         self._z_near = z_near
         self._z_far = z_far
@@ -46,7 +186,8 @@ class Camera:
 
     @position.setter
     def position(self, position: Vector3):
-        self._camera_position = position
+        self._camera_position = Vector3(position)
+        self._invalidate_view()
         # print("camera.position(setter):", self._camera_position)
 
     @property
@@ -56,11 +197,17 @@ class Camera:
     @fov_degree.setter
     def fov_degree(self, fov_degree: float):
         self._field_of_view_degrees = fov_degree
+        self._invalidate_projection()
 
     @property
     def rotation(self) -> Quaternion:
         return self._rotation
 
+    @rotation.setter
+    def rotation(self, rotation: Quaternion):
+        self._rotation = Quaternion(rotation)
+        self._invalidate_view()
+
     @property
     def aspect_ratio(self) -> float:
         return self._ratio
@@ -68,18 +215,60 @@ class Camera:
     @aspect_ratio.setter
     def aspect_ratio(self, ratio: float):
         self._ratio = ratio
+        self._invalidate_projection()
 
     @property
     def projection_matrix(self) -> Matrix44:
-        return Matrix44.perspective_projection(
-            self._field_of_view_degrees, self._ratio, self._z_near, self._z_far
-        )
+        if self._projection_matrix is None:
+            self._projection_matrix = Matrix44.perspective_projection(
+                self._field_of_view_degrees, self._ratio, self._z_near, self._z_far
+            )
+        return self._projection_matrix
 
     @property
     def view_matrix(self) -> Matrix44:
-        return Matrix44.from_quaternion(self.rotation) * Matrix44.from_translation(
-            -self.position
-        )
+        if self._view_matrix is None:
+            self._view_matrix = Matrix44.from_quaternion(
+                self.rotation
+            ) * Matrix44.from_translation(-self.position)
+        return self._view_matrix
+
+    @property
+    def projection_matrix_f4(self) -> np.ndarray:
+        """The projection matrix as read-only float32 array, ready for a uniform write."""
+        if self._projection_matrix_f4 is None:
+            self._projection_matrix_f4 = self._as_f4(self.projection_matrix)
+        return self._projection_matrix_f4
+
+    @property
+    def view_matrix_f4(self) -> np.ndarray:
+        """The view matrix as read-only float32 array, ready for a uniform write."""
+        if self._view_matrix_f4 is None:
+            self._view_matrix_f4 = self._as_f4(self.view_matrix)
+        return self._view_matrix_f4
+
+    @staticmethod
+    def _as_f4(matrix: Matrix44) -> np.ndarray:
+        m = np.array(matrix, dtype="f4")
+        m.setflags(write=False)
+        return m
+
+    def _invalidate_projection(self):
+        """Mark the projection matrix as dirty.
+
+        Must be called whenever field of view, aspect ratio or clipping planes change.
+        """
+        self._projection_matrix = None
+        self._projection_matrix_f4 = None
+
+    def _invalidate_view(self):
+        """Mark the view matrix as dirty.
+
+        Must be called whenever position or rotation change. Note that in-place
+        modifications of `position` or `rotation` are not tracked, assign them instead.
+        """
+        self._view_matrix = None
+        self._view_matrix_f4 = None
 
     def _build_look_at(self):
         self._cameras_target = self._camera_position + self._camera_front
@@ -106,27 +295,27 @@ class ControllableCamera(Camera):
         self._rotate_vertically = 0.1
 
     def zoom_in(self):
-        self._field_of_view_degrees = self._field_of_view_degrees - self._zoom_step
+        self.fov_degree = self.fov_degree - self._zoom_step
         self.build_projection()
 
     def zoom_out(self):
-        self._field_of_view_degrees = self._field_of_view_degrees + self._zoom_step
+        self.fov_degree = self.fov_degree + self._zoom_step
         self.build_projection()
 
     def move_forward(self):
-        self._camera_position = (
+        self.position = (
             self._camera_position + self._camera_front * self._move_horizontally
         )
         self.build_look_at()
 
     def move_backwards(self):
-        self._camera_position = (
+        self.position = (
             self._camera_position - self._camera_front * self._move_horizontally
         )
         self.build_look_at()
 
     def strafe_left(self):
-        self._camera_position = (
+        self.position = (
             self._camera_position
             - vector.normalize(self._camera_front ^ self._camera_up)
             * self._move_horizontally
@@ -134,7 +323,7 @@ class ControllableCamera(Camera):
         self.build_look_at()
 
     def strafe_right(self):
-        self._camera_position = (
+        self.position = (
             self._camera_position
             + vector.normalize(self._camera_front ^ self._camera_up)
             * self._move_horizontally
@@ -142,15 +331,11 @@ class ControllableCamera(Camera):
         self.build_look_at()
 
     def strafe_up(self):
-        self._camera_position = (
-            self._camera_position + self._camera_up * self._move_vertically
-        )
+        self.position = self._camera_position + self._camera_up * self._move_vertically
         self.build_look_at()
 
     def strafe_down(self):
-        self._camera_position = (
-            self._camera_position - self._camera_up * self._move_vertically
-        )
+        self.position = self._camera_position - self._camera_up * self._move_vertically
         self.build_look_at()
 
     def rotate_left(self):
@@ -0,0 +1,323 @@
+"""
+    Fast readers for COLMAP models.
+    The binary files are memory-mapped and parsed with numpy; the results are
+    identical to the readers in alfr.thirdparty.read_write_model.
+"""
+import collections
+import mmap
+import os
+import struct
+import numpy as np
+from .thirdparty.read_write_model import (
+    Image,
+    Point3D,
+    detect_model_format,
+    read_cameras_binary,
+    read_cameras_text,
+    read_images_text,
+    read_points3D_text,
+)  # from https://github.com/colmap/colmap
+
+
+# the pose of an image without its 2D observations
+ImageHeader = collections.namedtuple(
+    "ImageHeader", ["id", "qvec", "tvec", "camera_id", "name"]
+)
+
+# image properties in images.bin (followed by a 0-terminated name)
+IMAGE_HEADER_DTYPE = np.dtype(
+    [("image_id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")]
+)
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+# point properties in points3D.bin (followed by track_length * (image_id, point2D_idx))
+POINT3D_HEADER_DTYPE = np.dtype(
+    [
+        ("point3D_id", "<u8"),
+        ("xyz", "<f8", 3),
+        ("rgb", "u1", 3),
+        ("error", "<f8"),
+        ("track_length", "<u8"),
+    ]
+)
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def _map_file(path: str) -> mmap.mmap:
+    with open(path, "rb") as fid:
+        return mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read_at(buffer, offsets: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Read one value of a scalar dtype at each of the (unaligned) byte offsets."""
+    values = np.empty(len(offsets), dtype=dtype)
+    misalignment = offsets % dtype.itemsize
+    for shift in np.unique(misalignment):
+        # a view of the buffer starting at the given shift, so the values line up
+        view = np.frombuffer(
+            buffer,
+            dtype=dtype,
+            offset=shift,
+            count=(len(buffer) - shift) // dtype.itemsize,
+        )
+        selected = misalignment == shift
+        values[selected] = view[(offsets[selected] - shift) // dtype.itemsize]
+    return values
+
+
+def _read_records(buffer, offsets: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Read one record of a structured dtype at each of the byte offsets."""
+    records = np.empty(len(offsets), dtype=dtype)
+    for name, (field, field_offset) in dtype.fields.items():
+        column = records[name]
+        if column.ndim == 1:
+            column = column[:, np.newaxis]
+        for i in range(column.shape[1]):
+            column[:, i] = _read_at(
+                buffer, offsets + field_offset + i * field.base.itemsize, field.base
+            )
+    return records
+
+
+def _read_points2D(buffer, offset: int, num_points2D: int):
+    points = np.frombuffer(
+        buffer, dtype=POINT2D_DTYPE, count=num_points2D, offset=offset
+    )
+    if num_points2D == 0:
+        # an empty tuple gives a float array in the thirdparty reader
+        return np.zeros((0, 2)), np.array(())
+    # copies, no view of the buffer may outlive it (it is closed after reading)
+    return points["xy"].copy(), points["point3D_id"].copy()
+
+
+def _scan_images_binary(path_to_model_file: str, with_points2D: bool = True):
+    """Read the image headers of images.bin and optionally their 2D points.
+
+    Returns:
+        tuple: structured header array, image names and (xys, point3D_ids) per
+            image or None if the 2D points are skipped
+    """
+    mm = _map_file(path_to_model_file)
+    try:
+        num_reg_images = struct.unpack_from("<Q", mm, 0)[0]
+        offsets, names, points2D = [], [], []
+
+        offset = 8
+        for _ in range(num_reg_images):
+            offsets.append(offset)
+            name_end = mm.find(b"\x00", offset + IMAGE_HEADER_DTYPE.itemsize)
+            names.append(
+                mm[offset + IMAGE_HEADER_DTYPE.itemsize : name_end].decode("utf-8")
+            )
+            num_points2D = struct.unpack_from("<Q", mm, name_end + 1)[0]
+            if with_points2D:
+                points2D.append(_read_points2D(mm, name_end + 9, num_points2D))
+            # seek to the next image
+            offset = name_end + 9 + POINT2D_DTYPE.itemsize * num_points2D
+
+        headers = _read_records(
+            mm, np.array(offsets, dtype=np.int64), IMAGE_HEADER_DTYPE
+        )
+    finally:
+        mm.close()
+
+    return headers, names, points2D if with_points2D else None
+
+
+def read_images_binary(path_to_model_file: str) -> dict:
+    """Fast version of `read_images_binary` from the thirdparty reader.
+
+    Args:
+        path_to_model_file (str): path to images.bin
+
+    Returns:
+        dict: the images by image id
+    """
+    headers, names, points2D = _scan_images_binary(path_to_model_file)
+
+    images = {}
+    for image_id, qvec, tvec, camera_id, name, (xys, point3D_ids) in zip(
+        headers["image_id"].tolist(),
+        headers["qvec"],
+        headers["tvec"],
+        headers["camera_id"].tolist(),
+        names,
+        points2D,
+    ):
+        images[image_id] = Image(
+            id=image_id,
+            qvec=qvec,
+            tvec=tvec,
+            camera_id=camera_id,
+            name=name,
+            xys=xys,
+            point3D_ids=point3D_ids,
+        )
+    return images
+
+
+def read_image_headers_binary(path_to_model_file: str) -> dict:
+    """Read only the poses of images.bin, the 2D observations are skipped.
+
+    Args:
+        path_to_model_file (str): path to images.bin
+
+    Returns:
+        dict: the image headers by image id
+    """
+    headers, names, _ = _scan_images_binary(path_to_model_file, with_points2D=False)
+
+    images = {}
+    for image_id, qvec, tvec, camera_id, name in zip(
+        headers["image_id"].tolist(),
+        headers["qvec"],
+        headers["tvec"],
+        headers["camera_id"].tolist(),
+        names,
+    ):
+        images[image_id] = ImageHeader(
+            id=image_id, qvec=qvec, tvec=tvec, camera_id=camera_id, name=name
+        )
+    return images
+
+
+def read_image_headers_text(path: str) -> dict:
+    """Read only the poses of images.txt, the 2D observations are skipped.
+
+    Args:
+        path (str): path to images.txt
+
+    Returns:
+        dict: the image headers by image id
+    """
+    images = {}
+    with open(path, "r") as fid:
+        while True:
+            line = fid.readline()
+            if not line:
+                break
+            line = line.strip()
+            if len(line) > 0 and line[0] != "#":
+                elems = line.split()
+                image_id = int(elems[0])
+                images[image_id] = ImageHeader(
+                    id=image_id,
+                    qvec=np.array(tuple(map(float, elems[1:5]))),
+                    tvec=np.array(tuple(map(float, elems[5:8]))),
+                    camera_id=int(elems[8]),
+                    name=elems[9],
+                )
+                fid.readline()  # skip the line with the 2D observations
+    return images
+
+
+def read_points3D_binary(path_to_model_file: str) -> dict:
+    """Fast version of `read_points3D_binary` from the thirdparty reader.
+
+    Args:
+        path_to_model_file (str): path to points3D.bin
+
+    Returns:
+        dict: the 3D points by point id
+    """
+    mm = _map_file(path_to_model_file)
+    try:
+        num_points = struct.unpack_from("<Q", mm, 0)[0]
+        offsets, track_lengths = [], []
+
+        # only the track lengths are read sequentially, they give the next offset
+        track_length_offset = POINT3D_HEADER_DTYPE.fields["track_length"][1]
+        offset = 8
+        for _ in range(num_points):
+            offsets.append(offset)
+            track_length = struct.unpack_from("<Q", mm, offset + track_length_offset)[0]
+            track_lengths.append(track_length)
+            offset += (
+                POINT3D_HEADER_DTYPE.itemsize + TRACK_ELEM_DTYPE.itemsize * track_length
+            )
+
+        offsets = np.array(offsets, dtype=np.int64)
+        track_lengths = np.array(track_lengths, dtype=np.int64)
+        headers = _read_records(mm, offsets, POINT3D_HEADER_DTYPE)
+
+        # byte offsets of all track elements
+        track_ends = np.cumsum(track_lengths)
+        first_elem = np.repeat(track_ends - track_lengths, track_lengths)
+        elem_offsets = np.repeat(
+            offsets + POINT3D_HEADER_DTYPE.itemsize, track_lengths
+        ) + TRACK_ELEM_DTYPE.itemsize * (np.arange(track_lengths.sum()) - first_elem)
+        tracks = _read_records(mm, elem_offsets, TRACK_ELEM_DTYPE)
+    finally:
+        mm.close()
+
+    image_ids = tracks["image_id"].astype(np.int64)
+    point2D_idxs = tracks["point2D_idx"].astype(np.int64)
+
+    points3D = {}
+    for point3D_id, xyz, rgb, error, start, end in zip(
+        headers["point3D_id"].tolist(),
+        headers["xyz"],
+        headers["rgb"].astype(np.int64),
+        headers["error"],
+        (track_ends - track_lengths).tolist(),
+        track_ends.tolist(),
+    ):
+        points3D[point3D_id] = Point3D(
+            id=point3D_id,
+            xyz=xyz,
+            rgb=rgb,
+            error=np.array(error),
+            image_ids=image_ids[start:end],
+            point2D_idxs=point2D_idxs[start:end],
+        )
+    return points3D
+
+
+def read_model(path: str, ext: str = "", poses_only: bool = False):
+    """Fast version of `read_model` from the thirdparty reader.
+
+    Args:
+        path (str): the folder of the COLMAP model
+        ext (str): the model format (".bin" or ".txt"), detected if empty
+        poses_only (bool): only read cameras and image headers; the 2D observations
+            are skipped and points3D is neither read nor required
+
+    Returns:
+        tuple: cameras, images and points3D dicts (points3D is None if poses_only)
+    """
+    # try to detect the extension automatically
+    if ext == "":
+        if _detect_model_format(path, ".bin", poses_only):
+            ext = ".bin"
+        elif _detect_model_format(path, ".txt", poses_only):
+            ext = ".txt"
+        else:
+            print("Provide model format: '.bin' or '.txt'")
+            return
+
+    if ext == ".txt":
+        cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
+        if poses_only:
+            images = read_image_headers_text(os.path.join(path, "images" + ext))
+            return cameras, images, None
+        images = read_images_text(os.path.join(path, "images" + ext))
+        points3D = read_points3D_text(os.path.join(path, "points3D") + ext)
+    else:
+        cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
+        if poses_only:
+            images = read_image_headers_binary(os.path.join(path, "images" + ext))
+            return cameras, images, None
+        images = read_images_binary(os.path.join(path, "images" + ext))
+        points3D = read_points3D_binary(os.path.join(path, "points3D") + ext)
+    return cameras, images, points3D
+
+
+def _detect_model_format(path: str, ext: str, poses_only: bool) -> bool:
+    if not poses_only:
+        return detect_model_format(path, ext)
+    # points3D is not needed
+    if os.path.isfile(os.path.join(path, "cameras" + ext)) and os.path.isfile(
+        os.path.join(path, "images" + ext)
+    ):
+        print("Detected model format: '" + ext + "'")
+        return True
+    return False
@@ -1,3 +1,4 @@
+import threading
 import moderngl
 
 __version__ = "0.0.1"
@@ -6,31 +7,132 @@ __version__ = "0.0.1"
 # ctx = moderngl.create_standalone_context()  # global OpenGL context
 
 
-import moderngl
-
-
 class ContextManager:
     """ContextManager for OpenGL contexts with moderngl.
     based on: https://github.com/moderngl/moderngl/blob/master/examples/context_manager.py
+
+    An OpenGL context is current in one thread only, so every thread gets its own
+    default context. Use a `ShareGroup` to use the same textures from several
+    threads.
     """
 
-    ctx = None
+    ctx = None  # the default context of the first thread asking for one
+    _lock = threading.Lock()
+    _thread_contexts = threading.local()
+
+    @staticmethod
+    def create_context(allow_fallback_egl_context=True) -> moderngl.Context:
+        """
+        Create a new standalone context, current in the calling thread.
+        """
+        try:
+            return moderngl.create_standalone_context()
+        except:
+            if allow_fallback_egl_context:
+                return moderngl.create_standalone_context(backend="egl")
+            raise
 
     @staticmethod
     def get_default_context(allow_fallback_egl_context=True) -> moderngl.Context:
         """
-        Default context
+        Default context of the calling thread, created on the first call (not at
+        import). The first thread gets `ContextManager.ctx`.
+        """
+        local = ContextManager._thread_contexts
+        ctx = getattr(local, "ctx", None)
+        if ctx is None:
+            ctx = ContextManager.create_context(allow_fallback_egl_context)
+            with ContextManager._lock:
+                if ContextManager.ctx is None:
+                    ContextManager.ctx = ctx
+            local.ctx = ctx
+        return ctx
+
+    @staticmethod
+    def release_thread_context():
+        """
+        Release the default context of the calling thread (e.g. before a worker
+        thread ends). Its textures and framebuffers become invalid.
         """
+        local = ContextManager._thread_contexts
+        ctx = getattr(local, "ctx", None)
+        if ctx is None:
+            return
+        local.ctx = None
+        with ContextManager._lock:
+            if ContextManager.ctx is ctx:
+                ContextManager.ctx = None
+        ctx.release()
 
-        if ContextManager.ctx is None:
+
+class ShareGroup:
+    """A context whose objects (e.g. shot textures) are used by several threads.
+
+    Standalone contexts (including EGL) cannot share textures with other
+    contexts, so the group has one context that is made current in the thread
+    entering the group. Threads take turns: entering blocks while another thread
+    is in the group. Textures are uploaded once and neither duplicated nor
+    reloaded per thread. Leaving the group makes the default context of the
+    thread (see `ContextManager.get_default_context`) current again.
+
+    Example:
+        group = ShareGroup()
+        with group as ctx:
+            shots = load_shots_from_json(json_file, ctx=ctx)
+
+        def render():  # in any thread
+            with group as ctx:
+                renderer = Renderer(ctx=ctx)
+                img = renderer.integrate(shots, vcam)
+    """
+
+    def __init__(self, allow_fallback_egl_context=True):
+        self._lock = threading.RLock()
+        self._depth = 0  # nesting of the thread in the group
+        self._ctx = None
+        error = None
+
+        def create():
+            nonlocal error
             try:
-                ContextManager.ctx = moderngl.create_standalone_context()
-            except:
-                if allow_fallback_egl_context:
-                    ContextManager.ctx = moderngl.create_standalone_context(
-                        backend="egl"
-                    )
-                else:
-                    raise
-
-        return ContextManager.ctx
+                self._ctx = ContextManager.create_context(allow_fallback_egl_context)
+                # make nothing current, the context has no previous one to restore
+                self._ctx.__exit__(None, None, None)
+            except Exception as e:
+                error = e
+
+        # created in a helper thread, the current context of this thread is kept
+        thread = threading.Thread(target=create)
+        thread.start()
+        thread.join()
+        if error is not None:
+            raise error
+
+    @property
+    def ctx(self) -> moderngl.Context:
+        """The context of the group, only use it within the group."""
+        return self._ctx
+
+    def __enter__(self) -> moderngl.Context:
+        self._lock.acquire()
+        if self._depth == 0:
+            self._ctx.__enter__()
+        self._depth += 1
+        return self._ctx
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._ctx.__exit__(*exc)
+            # the backends do not restore the previous context, make the default
+            # context of the thread current again
+            ctx = getattr(ContextManager._thread_contexts, "ctx", None)
+            if ctx is not None:
+                ctx.__enter__()
+        self._lock.release()
+        return False
+
+    def release(self):
+        """Release the context of the group and all its objects."""
+        with self._lock:
+            self._ctx.release()
@@ -0,0 +1,414 @@
+"""
+    Instrumentation of the renderer: per-call breakdowns of the CPU and GPU time
+    spent in each stage (see `Renderer.stats`), and tracing of loading and
+    rendering activity as spans on a timeline (see `set_tracer`).
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+import weakref
+import moderngl
+from typing import Callable, Dict, List
+
+# Stages of a render call:
+#   setup: framebuffers, matrices and clearing
+#   upload: binding the shots (textures and uniforms), CPU only
+#   draw: drawing the shots and the fullscreen passes
+#   readback: reading images from the GPU
+#   postprocess: numpy processing of the read images, CPU only
+STAGES = ("setup", "upload", "draw", "readback", "postprocess")
+_CPU_STAGES = ("upload", "postprocess")  # not timed on the GPU
+# llvmpipe (Mesa's software renderer, e.g. with EGL) reports 0xFFFFFFFF ns for a
+# timer query of the first call rendered on a context, the queries of the first
+# call timed on a context of these renderers are discarded
+_FIRST_CALL_UNTIMED = ("llvmpipe",)
+_timed_contexts = weakref.WeakSet()  # contexts a call has been timed on
+
+# The breakdown of one render call:
+#   method: the name of the Renderer method
+#   wall: the wall time of the call in seconds
+#   cpu: the wall time of each stage in seconds (the draw stage without upload)
+#   gpu: the GPU time of each stage in seconds, measured with timer queries
+#       (empty if they are not supported, and for the first call timed on a
+#       llvmpipe context)
+#   shots: the number of shots bound, a shot drawn in several passes counts
+#       several times
+CallStats = collections.namedtuple(
+    "CallStats", ["method", "wall", "cpu", "gpu", "shots"]
+)
+
+
+class _NoStage:
+    """Context of a stage or span that is not recorded."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class ChromeTracer:
+    """Collects spans as Chrome trace events.
+
+    The exported json file can be opened in chrome://tracing or Perfetto. Spans
+    are "complete" events with microsecond timestamps, relative to the creation
+    of the tracer, on the thread that recorded them.
+
+    Any object with an `add_span(name, category, start, end, **args)` method
+    (times from `time.perf_counter`) can be installed with `set_tracer`.
+    """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._events = []
+
+    def add_span(self, name: str, category: str, start: float, end: float, **args):
+        """Record a span, start and end are `time.perf_counter` times."""
+        self._events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self._pid,
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+    @property
+    def events(self) -> List[dict]:
+        """The recorded trace events."""
+        return list(self._events)
+
+    def clear(self):
+        """Forget the recorded spans."""
+        self._events = []
+
+    def to_json(self) -> dict:
+        """The recorded spans in the Chrome trace-event format."""
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    def export(self, json_file: str):
+        """Write the recorded spans to a Chrome trace-event json file."""
+        with open(json_file, "w") as f:
+            json.dump(self.to_json(), f)
+
+
+# the installed tracer, spans are only created if one is installed
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install a tracer (e.g. a `ChromeTracer`), None removes it.
+
+    Returns:
+        the previously installed tracer
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer():
+    """The installed tracer (None if tracing is off)."""
+    return _tracer
+
+
+class _Span:
+    """Context recording a span with the tracer."""
+
+    def __init__(self, tracer, name: str, category: str, args: dict):
+        self._tracer = tracer
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._tracer.add_span(
+            self._name, self._category, self._start, time.perf_counter(), **self._args
+        )
+        return False
+
+    def set(self, **args):
+        """Add arguments to the span, e.g. sizes known at its end."""
+        self._args.update(args)
+
+
+def trace_span(name: str, category: str = "alfr", **args):
+    """Context recording a span with the installed tracer (a no-op without)."""
+    tracer = _tracer
+    if tracer is None:
+        return _NO_STAGE
+    return _Span(tracer, name, category, args)
+
+
+def traced(category: str) -> Callable:
+    """Decorator recording the calls of a function as spans named after it."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with _Span(tracer, fn.__name__, category, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _Stage:
+    """Context recording the CPU and GPU time of a stage of the current call.
+
+    A stage within another stage pauses the outer one, so every moment of the
+    call is counted for one stage only. With a tracer, the stage is also
+    recorded as span.
+    """
+
+    def __init__(self, stats: "RenderStats", name: str, tracer, args: dict):
+        self._stats = stats
+        self._name = name
+        self._tracer = tracer
+        self._args = args
+        self._query = None
+        self._start = 0.0
+        self._excluded = 0.0
+
+    def __enter__(self):
+        stats = self._stats
+        if stats._recording:
+            if stats._stages:
+                stats._stages[-1]._end_query()
+            stats._stages.append(self)
+            self._excluded = stats._excluded
+            self._query = stats._begin_query(self._name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stats = self._stats
+        end = time.perf_counter()
+        if self._tracer is not None:
+            self._tracer.add_span(self._name, "render", self._start, end, **self._args)
+        if not stats._recording or not stats._stages or stats._stages[-1] is not self:
+            return False  # not recorded or unwound by the call (e.g. a generator)
+        elapsed = end - self._start
+        self._end_query()
+        stats._stages.pop()
+        # the time of inner stages and of binding shots is counted for them
+        stats._cpu[self._name] += elapsed - (stats._excluded - self._excluded)
+        stats._excluded = self._excluded + elapsed
+        if stats._stages:
+            outer = stats._stages[-1]
+            outer._query = stats._begin_query(outer._name)
+        return False
+
+    def _end_query(self):
+        if self._query is not None:
+            self._query.__exit__(None, None, None)
+            self._stats._pending.append((self._name, self._query))
+            self._query = None
+
+
+class _Call:
+    """Context recording one render call (in the stats and/or as span)."""
+
+    def __init__(self, stats: "RenderStats", method: str, tracer):
+        self._stats = stats
+        self._method = method
+        self._tracer = tracer
+        self._start = 0.0
+
+    def __enter__(self):
+        stats = self._stats
+        stats._in_call = True
+        stats._tracer = self._tracer
+        stats._recording = stats.enabled
+        stats._cpu = dict.fromkeys(STAGES, 0.0)
+        stats._excluded = 0.0
+        stats._shots = 0
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stats = self._stats
+        end = time.perf_counter()
+        stats._in_call = False
+        stats._tracer = None
+        if self._tracer is not None:
+            self._tracer.add_span(self._method, "render", self._start, end)
+        if not stats._recording:
+            return False
+        stats._recording = False
+        if exc[0] is not None or stats._stages:
+            # the call raised, possibly within stages (or a generator holding one
+            # was not closed): their queries are ended and the call is not recorded
+            for stage in reversed(stats._stages):
+                stage._end_query()
+            stats._stages = []
+            stats._queries.extend(query for _, query in stats._pending)
+            stats._pending = []
+            return False
+        gpu = stats._collect_queries()
+        stats._calls.append(
+            CallStats(self._method, end - self._start, stats._cpu, gpu, stats._shots)
+        )
+        return False
+
+
+class RenderStats:
+    """Per-call breakdowns of the work of a renderer.
+
+    Disabled by default. When enabled, every call of a public render method
+    records the wall time of its stages (`STAGES`) and their GPU time with timer
+    queries. The queries are read after the call has read back its result, so
+    they do not stall the pipeline; the overhead is a few microseconds per call
+    and two clock reads per shot.
+
+    Example:
+        renderer.stats.enabled = True
+        renderer.integrate(shots, vcam)
+        print(renderer.stats.last)
+    """
+
+    def __init__(self, ctx: moderngl.Context, enabled: bool = False, history=1000):
+        """
+        Args:
+            ctx (moderngl.Context): the context of the renderer
+            enabled (bool): whether to record the calls
+            history (int): the number of recent calls kept
+        """
+        self.enabled = enabled
+        self._ctx = ctx
+        self._calls = collections.deque(maxlen=history)
+        self._in_call = False
+        self._recording = False  # whether the current call is recorded
+        self._tracer = None  # the tracer of the current call
+        self._stages = []  # the active stages of the current call, innermost last
+        self._cpu = dict.fromkeys(STAGES, 0.0)
+        self._excluded = 0.0  # time counted for inner stages and uploads
+        self._shots = 0
+        self._pending = []  # (stage, query) of the current call
+        self._queries = []  # unused queries
+        self._gpu_timing = True
+
+    @property
+    def calls(self) -> List[CallStats]:
+        """The recorded calls, oldest first."""
+        return list(self._calls)
+
+    @property
+    def last(self) -> CallStats:
+        """The most recent call (None if no call was recorded)."""
+        return self._calls[-1] if self._calls else None
+
+    def reset(self):
+        """Forget the recorded calls."""
+        self._calls.clear()
+
+    def totals(self) -> Dict[str, dict]:
+        """Sum up the recorded calls per method.
+
+        Returns:
+            dict: per method the number of calls, the total wall time, the cpu
+                and gpu time per stage and the number of shots bound
+        """
+        totals = {}
+        for call in self._calls:
+            total = totals.setdefault(
+                call.method,
+                {
+                    "calls": 0,
+                    "wall": 0.0,
+                    "cpu": dict.fromkeys(STAGES, 0.0),
+                    "gpu": {},
+                    "shots": 0,
+                },
+            )
+            total["calls"] += 1
+            total["wall"] += call.wall
+            total["shots"] += call.shots
+            for stage, seconds in call.cpu.items():
+                total["cpu"][stage] += seconds
+            for stage, seconds in call.gpu.items():
+                total["gpu"][stage] = total["gpu"].get(stage, 0.0) + seconds
+        return totals
+
+    def call(self, method: str):
+        """Context recording a call of the method (nested calls are not recorded).
+
+        The call is also traced if a tracer is installed.
+        """
+        tracer = _tracer
+        if self._in_call or not (self.enabled or tracer is not None):
+            return _NO_STAGE
+        return _Call(self, method, tracer)
+
+    def stage(self, name: str, **args):
+        """Context recording a stage of the current call, args are traced."""
+        if not self._in_call:
+            return _NO_STAGE
+        return _Stage(self, name, self._tracer, args)
+
+    def add_upload(self, seconds: float):
+        """Count the time of binding a shot."""
+        self._cpu["upload"] += seconds
+        self._excluded += seconds
+        self._shots += 1
+
+    @property
+    def recording(self) -> bool:
+        """Whether the stats of a call are being recorded."""
+        return self._recording
+
+    @property
+    def tracer(self):
+        """The tracer of the current call (None if it is not traced)."""
+        return self._tracer
+
+    def _begin_query(self, stage: str) -> moderngl.Query:
+        if not self._gpu_timing or stage in _CPU_STAGES:
+            return None
+        if self._queries:
+            query = self._queries.pop()
+        else:
+            try:
+                query = self._ctx.query(time=True)
+            except moderngl.Error:
+                self._gpu_timing = False  # timer queries are not supported
+                return None
+        query.__enter__()
+        return query
+
+    def _collect_queries(self) -> Dict[str, float]:
+        gpu = {}
+        discard = False
+        if self._pending and self._ctx not in _timed_contexts:
+            _timed_contexts.add(self._ctx)
+            discard = self._ctx.info["GL_RENDERER"].startswith(_FIRST_CALL_UNTIMED)
+        for stage, query in self._pending:
+            if not discard:
+                gpu[stage] = gpu.get(stage, 0.0) + query.elapsed * 1e-9
+            self._queries.append(query)
+        self._pending = []
+        return gpu
@@ -1,34 +1,141 @@
+import collections
+import functools
+import inspect
+import time
 import numpy as np
-import cv2
 import moderngl
 from alfr.globals import ContextManager
-from alfr.shot import Shot
+from alfr.shot import MemoryUsage, Shot, ShotCollection, _add_textures
 from alfr.camera import Camera
-from typing import Tuple
+from alfr.surface import FocalSurface
+from alfr.profiling import RenderStats
+from alfr.cache import ResultCache
+from typing import Callable, Sequence, Tuple, Union
 from pyrr import Matrix44, Quaternion, Vector3, vector
 from typing import List
 
 
+# depth (z) of the default focal plane
+FOCAL_PLANE_Z = 10.0
+
+
 def plane(size):
     """
     Create a plane with the given size.
     """
     u = np.repeat(np.linspace(-size, size, 2), 2)
     v = np.tile([-size, size], 2)
-    w = np.ones(4) * 10
+    w = np.ones(4) * FOCAL_PLANE_Z
     return np.concatenate([np.dstack([u, v, w]), np.dstack([v, u, w])])
 
 
+# Output layouts of the images returned by the renderer:
+#   name: (top-down rows, BGR channel order, float values in [0,1])
+OUTPUT_LAYOUTS = {
+    "opencv": (True, True, False),  # BGRA, top-down, uint8 (integrals 0..255)
+    "gl": (False, False, False),  # RGBA, bottom-up, uint8 (integrals 0..255)
+    "float": (True, False, True),  # RGBA, top-down, float32 in [0,1]
+}
+
+
+# Integration methods of `Renderer.integrate`
+INTEGRATION_METHODS = ("mean", "median", "trimmed_mean")
+# robust integration bins the intensities of a pixel into histograms with
+# HISTOGRAM_BINS bins (4 per render target) ...
+HISTOGRAM_BINS = 32
+# ... refined this often around the median (32^2 = 1024 intensity levels)
+MEDIAN_LEVELS = 2
+# upper end of the intensity range, so an intensity of 1 is inside the last bin
+_MAX_INTENSITY = 1.0 + 1.0 / 1024
+
+# Per-pixel statistics of the projected shots (see `Renderer.statistics`):
+#   mean, variance, min and max (HxWx3, in the channel order of the output layout)
+#   and count (HxW, the number of shots covering the pixel)
+PixelStatistics = collections.namedtuple(
+    "PixelStatistics", ["mean", "variance", "min", "max", "count"]
+)
+
+
+def _recorded(method):
+    """Record the calls of a render method in `Renderer.stats` and its peak memory."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._readback_bytes = 0
+        with self.stats.call(method.__name__):
+            result = method(self, *args, **kwargs)
+        self._update_peak_memory_usage(method.__name__)
+        return result
+
+    return wrapper
+
+
+def _cached(method):
+    """Answer calls of a render method from `Renderer.cache` if it is set."""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.cache
+        if cache is None:
+            return method(self, *args, **kwargs)
+        call = signature.bind(self, *args, **kwargs)
+        call.apply_defaults()
+        arguments = dict(call.arguments)
+        del arguments["self"]
+        key = None
+        if self._focal_surface is None:  # its geometry is not part of the key
+            resolution = arguments["resolution"] or self._fbo.size
+            key = cache.call_key(
+                method.__name__,
+                arguments,
+                self._output_layout,
+                resolution,
+                FOCAL_PLANE_Z,
+            )
+        if key is None:
+            cache.count_bypassed()
+            return method(self, *args, **kwargs)
+        result = cache.get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            cache.put(key, result)
+        return result
+
+    return wrapper
+
+
 class Renderer:
     def __init__(
         self,
         resolution: tuple = (512, 512),
-        ctx: moderngl.Context = ContextManager.get_default_context(),
+        ctx: moderngl.Context = None,
+        output_layout: str = "opencv",
+        focal_surface: FocalSurface = None,
     ):
 
-        self._ctx = ctx
+        # the default context is created on first use, not at import
+        self._ctx = ctx if ctx is not None else ContextManager.get_default_context()
+        self.output_layout = output_layout
+        # per-call breakdowns of the render methods, disabled by default
+        self.stats = RenderStats(self._ctx)
+        # results of integrate and project_shot, not cached by default
+        self.cache: ResultCache = None
         self._program = self._setup_alfr_program(self._ctx)
+        # depth pre-pass of focal surfaces, see _begin_blending
+        self._depth_program = self._setup_depth_program(self._ctx)
         self._fbo = self._ctx.simple_framebuffer(resolution, components=4)
+        self._accum_fbo = None  # float framebuffers used by integrate
+        self._integral_fbo = None
+        self._sharpness_fbo = None  # used by autofocus
+        self._focus_sweep_fbos = None  # used by depth_from_focus
+        self._statistics_fbos = None  # used by statistics
+        self._robust_fbos = None  # used by robust integration
+        # memory accounting, see memory_usage and peak_memory_usage
+        self._readback_bytes = 0  # of the current call
+        self._memory_key = None
+        self._memory = None
+        self._peak_memory = {}
 
         vbo = self._ctx.buffer(plane(100).astype("f4"))
         # Indices are given to specify the order of drawing
@@ -39,62 +146,181 @@ class Renderer:
             (vbo, "3f", "in_position")
         ]
         self._vao = self._ctx.vertex_array(self._program, vao_content, ibo)
+        self._buffers = [vbo, ibo]
+        self.focal_surface = focal_surface
 
-    def _prepare_projection(self, vcam: Camera, focus=None, resolution: tuple = None):
+        # fullscreen quad for the normalization pass of integrate
+        self._normalize_program = self._setup_normalize_program(self._ctx)
+        quad = self._ctx.buffer(
+            np.array([-1.0, -1.0, 1.0, -1.0, -1.0, 1.0, 1.0, 1.0], dtype="f4")
+        )
+        self._quad_vao = self._ctx.vertex_array(
+            self._normalize_program, [(quad, "2f", "in_position")]
+        )
+        self._buffers.append(quad)
+        self._sharpness_program = self._setup_sharpness_program(self._ctx)
+        self._sharpness_quad_vao = self._ctx.vertex_array(
+            self._sharpness_program, [(quad, "2f", "in_position")]
+        )
+        self._select_program = self._setup_select_program(self._ctx)
+        self._select_quad_vao = self._ctx.vertex_array(
+            self._select_program, [(quad, "2f", "in_position")]
+        )
+        self._focus_sweep_program = self._setup_focus_sweep_program(self._ctx)
+        self._focus_sweep_quad_vao = self._ctx.vertex_array(
+            self._focus_sweep_program, [(quad, "2f", "in_position")]
+        )
+
+    def _prepare_projection(
+        self, vcam: Camera, focus=None, resolution: tuple = None, layout: str = None
+    ):
         """Prepare the renderer for projection a shot.
 
         Activate the framebuffer, clear it and set the matrices for the shader program.
+        The vertical flip and the channel order of the output layout are folded into
+        the projection matrix and the shader output.
 
         Args:
             vcam (Camera): the virtual camera
-            focus (float): the focus object
+            focus (float): the depth (z) of the focal plane, defaults to
+                `FOCAL_PLANE_Z`; a focal surface is moved along z like the
+                plane, by focus - `FOCAL_PLANE_Z`
             resolution (tuple): the resolution of the image
+            layout (str): the output layout, defaults to `output_layout`
 
         """
+        with self.stats.stage("setup"):
+            top_down, bgr, _ = OUTPUT_LAYOUTS[layout or self._output_layout]
 
-        if resolution is not None and resolution != self._fbo.size:
-            self.fbo = self._ctx.simple_framebuffer(resolution, components=4)
-        self.fbo.use()
+            if resolution is not None and resolution != self._fbo.size:
+                self.fbo = self._ctx.simple_framebuffer(resolution, components=4)
+            self.fbo.use()
 
-        self._ctx.clear(0.0, 0.0, 0.0)
-        self._ctx.enable(moderngl.DEPTH_TEST)
+            self._ctx.clear(0.0, 0.0, 0.0)
+            self._ctx.enable(moderngl.DEPTH_TEST)
+
+            modelMat = self._program["m_model"]
+            viewMat = self._program["m_cam"]
+            projMat = self._program["m_proj"]
 
-        modelMat = self._program["m_model"]
-        viewMat = self._program["m_cam"]
-        projMat = self._program["m_proj"]
+            proj = vcam.projection_matrix_f4
+            if top_down:
+                # mirror y in clip space, so the first row read back is the top row
+                proj = proj * np.array([1.0, -1.0, 1.0, 1.0], dtype="f4")
+            projMat.write(proj)
+            viewMat.write(vcam.view_matrix_f4)
+            # the focal plane (or surface) is moved along z from FOCAL_PLANE_Z to
+            # the focus
+            z_offset = 0.0 if focus is None else float(focus) - FOCAL_PLANE_Z
+            model = Matrix44.from_translation([0.0, 0.0, z_offset]).astype("f4")
+            modelMat.write(model)
+            self._program["swap_rb"].value = bgr
 
-        projMat.write(vcam.projection_matrix.astype("f4"))
-        viewMat.write(vcam.view_matrix.astype("f4"))
-        modelMat.write((Matrix44.identity()).astype("f4"))  # Todo!
+            if self._focal_surface is not None:
+                self._depth_program["m_proj"].write(proj)
+                self._depth_program["m_cam"].write(vcam.view_matrix_f4)
+                self._depth_program["m_model"].write(model)
+                # cull the surface and select its level of detail for this view
+                self._focal_surface.update(vcam, self.fbo.size, z_offset)
+
+    def _render_focal_surface(self):
+        """Draw the focal surface (the plane if no surface is set)."""
+        if self._focal_surface is None:
+            self._vao.render(moderngl.TRIANGLES)
+        elif self._focal_surface.index_count > 0:
+            self._surface_vao.render(
+                moderngl.TRIANGLES, vertices=self._focal_surface.index_count
+            )
 
-    def _img_from_fbo(self) -> np.ndarray:
+    def _img_from_fbo(
+        self, fbo: moderngl.Framebuffer = None, dtype="f1", attachment: int = 0
+    ) -> np.ndarray:
         """Get the image from the framebuffer.
 
+        Args:
+            fbo (moderngl.Framebuffer): the framebuffer to read, defaults to `fbo`
+            dtype (str): the moderngl dtype to read ("f1" or "f4")
+            attachment (int): the color attachment to read
+
         Returns:
             np.ndarray: the image
         """
-        # opencv image
         # see https://stackoverflow.com/questions/65056007/numpy-array-to-and-from-moderngl-buffer-open-and-save-with-cv2
-        raw = self.fbo.read(components=4, dtype="f1")
-        return np.frombuffer(raw, dtype="uint8").reshape((*self.fbo.size[1::-1], 4))
+        fbo = fbo or self.fbo
+        img = np.empty((*fbo.size[1::-1], 4), dtype="uint8" if dtype == "f1" else "f4")
+        with self.stats.stage("readback", bytes=img.nbytes):
+            fbo.read_into(img, components=4, dtype=dtype, attachment=attachment)
+        self._readback_bytes += img.nbytes
+        return img
 
-    def _postpro_img(self, img: np.ndarray) -> np.ndarray:
-        """Postprocess an image such that it is compatible with opencv
+    def _bind_shots(self, shots: Union[List[Shot], ShotCollection]):
+        """Iterate over the shots, binding each one for drawing before it is yielded.
 
-        Args:
-            img (np.ndarray): the image to process
+        The loop is recorded as draw stage, the binding as upload. Traced, every
+        shot is a span (from binding it until the next one is bound).
+        """
+        stats = self.stats
+        tracer = stats.tracer
+        if isinstance(shots, ShotCollection):
+            bind = functools.partial(shots.use, renderer=self)
+        else:
+            bind = lambda i: shots[i].use(self)
+        with stats.stage("draw", shots=len(shots)):
+            for i in range(len(shots)):
+                if not stats.recording and tracer is None:
+                    bind(i)
+                    yield i
+                    continue
+                start = time.perf_counter()
+                bind(i)
+                bound = time.perf_counter()
+                if stats.recording:
+                    stats.add_upload(bound - start)
+                yield i
+                if tracer is not None:
+                    tracer.add_span("bind", "render", start, bound, shot=i)
+                    tracer.add_span(
+                        "shot", "render", start, time.perf_counter(), shot=i
+                    )
 
-        Returns:
-            np.ndarray: processed image
-        """
-        # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # convert to RGB, opencv uses BGR
-        img = np.flip(img, 0).copy(order="C")  # flip image vertically
-        # flip red and blue channels; cvtColor removes alpha channel so do it manually!
-        tmp = img[:, :, 0].copy()
-        img[:, :, 0] = img[:, :, 2].copy()
-        img[:, :, 2] = tmp
-        return img
+    def _read_projection(self, layout: str = None) -> np.ndarray:
+        """Read the projected shot from the framebuffer in the given output layout."""
+        _, _, as_float = OUTPUT_LAYOUTS[layout or self._output_layout]
+        return self._img_from_fbo(dtype="f4" if as_float else "f1")
 
+    def _integral_framebuffers(
+        self,
+    ) -> Tuple[moderngl.Framebuffer, moderngl.Framebuffer]:
+        """Get the float framebuffers for accumulating and normalizing integrals.
+
+        The accumulation framebuffer has a depth buffer for non-planar focal
+        surfaces. They are (re)created whenever the resolution of the renderer
+        changes.
+        """
+        if self._accum_fbo is None or self._accum_fbo.size != self.fbo.size:
+            self._release_framebuffer(self._accum_fbo)
+            self._release_framebuffer(self._integral_fbo)
+            self._accum_fbo = self._ctx.framebuffer(
+                color_attachments=[self._ctx.texture(self.fbo.size, 4, dtype="f4")],
+                depth_attachment=self._ctx.depth_renderbuffer(self.fbo.size),
+            )
+            self._integral_fbo = self._ctx.framebuffer(
+                color_attachments=[self._ctx.texture(self.fbo.size, 4, dtype="f4")]
+            )
+        return self._accum_fbo, self._integral_fbo
+
+    @staticmethod
+    def _release_framebuffer(fbo: moderngl.Framebuffer):
+        """Release a framebuffer and its attachments."""
+        if fbo is None:
+            return
+        for attachment in (*fbo.color_attachments, fbo.depth_attachment):
+            if attachment is not None:
+                attachment.release()
+        fbo.release()
+
+    @_cached
+    @_recorded
     def project_shot(
         self, shot: Shot, vcam: Camera, focus=None, resolution=None
     ) -> np.ndarray:
@@ -103,7 +329,9 @@ class Renderer:
         Args:
             shot (Shot): the shot to project
             vcam (Camera): the virtual camera
-            focus (float): the focus object
+            focus (float): the depth (z) of the focal plane, defaults to
+                `FOCAL_PLANE_Z`; a focal surface is moved along z like the
+                plane, by focus - `FOCAL_PLANE_Z`
             resolution (tuple): the resolution of the image
 
         Returns:
@@ -113,15 +341,15 @@ class Renderer:
         self._prepare_projection(vcam, focus, resolution)
 
         self._ctx.clear(0.0, 0.0, 0.0)
-        shot.use(self)
-        self._vao.render(moderngl.TRIANGLES)
+        for _ in self._bind_shots([shot]):
+            self._render_focal_surface()
 
-        img = self._img_from_fbo()
-        return self._postpro_img(img)
+        return self._read_projection()
 
+    @_recorded
     def project_multiple_shots(
         self,
-        shots: List[Shot],
+        shots: Union[List[Shot], ShotCollection],
         vcam: Camera,
         focus=None,
         resolution=None,
@@ -130,51 +358,592 @@ class Renderer:
         """Project multiple shots into images.
 
         Args:
-            shots (List[Shot]): the shots to project
+            shots (List[Shot] or ShotCollection): the shots to project
             vcam (Camera): the virtual camera
-            focus (float): the focus object
+            focus (float): the depth (z) of the focal plane, defaults to
+                `FOCAL_PLANE_Z`; a focal surface is moved along z like the
+                plane, by focus - `FOCAL_PLANE_Z`
             resolution (tuple): the resolution of the image
-            postprocess (bool): whether to postprocess the image
+            postprocess (bool): whether to return the images in `output_layout`,
+                otherwise the raw "gl" layout is returned
 
         Returns:
             List[np.ndarray]: the projected images
         """
         projections = []
-        self._prepare_projection(vcam, focus, resolution)
+        layout = self._output_layout if postprocess else "gl"
+        self._prepare_projection(vcam, focus, resolution, layout)
 
-        for shot in shots:
+        for _ in self._bind_shots(shots):
             self._ctx.clear(0.0, 0.0, 0.0)
-            shot.use(self)
-            self._vao.render(moderngl.TRIANGLES)
+            self._render_focal_surface()
 
-            img = self._img_from_fbo()
-            projections.append(self._postpro_img(img) if postprocess else img)
+            projections.append(self._read_projection(layout))
 
         return projections
 
+    @_cached
+    @_recorded
     def integrate(
-        self, shots: List[Shot], vcam: Camera, focus=None, resolution: tuple = None
+        self,
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        focus=None,
+        resolution: tuple = None,
+        method: str = "mean",
+        trim: float = 0.25,
+        weights: Union[np.ndarray, Callable] = None,
+        border: float = 0.0,
     ) -> np.ndarray:
         """Integrate multiple shots into a single image.
 
+        The shots are accumulated with additive blending in a float framebuffer and
+        normalized by the number of contributing shots in a final GPU pass.
+        With a focal surface, a depth pre-pass ensures that only its visible
+        front-most parts are accumulated.
+
+        The robust methods are robust against occluders. They first draw the shots
+        into per-pixel intensity histograms (`HISTOGRAM_BINS` bins) to select the
+        intensity range to keep; only shots within it are then averaged. The
+        median refines its histogram `MEDIAN_LEVELS` times, so it is approximate
+        to 1/1024 of the intensity range. The memory does not depend on the
+        number of shots.
+
+        Shots can be weighted by their `weight` (quality), by `weights` (e.g.
+        `view_angle_weights`) and per pixel towards their image borders. The
+        weights are applied in the shader, the integral is the weighted average.
+        The histograms of the robust methods are not weighted.
+
         Args:
-            shots (List[Shot]): the shots to integrate
+            shots (List[Shot] or ShotCollection): the shots to integrate
             vcam (Camera): the virtual camera
-            focus (float): the focus object
+            focus (float): the depth (z) of the focal plane, defaults to
+                `FOCAL_PLANE_Z`; a focal surface is moved along z like the
+                plane, by focus - `FOCAL_PLANE_Z`
             resolution (tuple): the resolution of the image
+            method (str): "mean", "median" (of the intensity) or "trimmed_mean"
+            trim (float): the fraction of the darkest and of the brightest shots
+                ignored by "trimmed_mean"
+            weights (np.ndarray or callable): N weights of the shots or a function
+                `weights(shots, vcam)` returning them; multiplied with the
+                weights of the shots
+            border (float): the width of the border (as fraction of the image
+                size) over which the pixel weights fall off to zero at the edge
 
         Returns:
-            np.ndarray: the integrated image
+            np.ndarray: the integrated image (float32); pixels without any
+                contributing shot are zero including their alpha
         """
-        projections = self.project_multiple_shots(
-            shots, vcam, focus, resolution, postprocess=False
+        integral_fbo = self._integrate_to_fbo(
+            shots, vcam, focus, resolution, method, trim, weights, border
         )
+        return self._img_from_fbo(integral_fbo, dtype="f4")
+
+    def _integrate_to_fbo(
+        self,
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        focus=None,
+        resolution: tuple = None,
+        method: str = "mean",
+        trim: float = 0.25,
+        weights: Union[np.ndarray, Callable] = None,
+        border: float = 0.0,
+    ) -> moderngl.Framebuffer:
+        """Integrate the shots on the GPU, see `integrate`.
+
+        Returns:
+            moderngl.Framebuffer: the framebuffer holding the integral image
+        """
+        if method not in INTEGRATION_METHODS:
+            raise ValueError(
+                f"Unknown integration method {method}, use one of {INTEGRATION_METHODS}"
+            )
+        if not 0.0 <= trim < 0.5:
+            raise ValueError("trim must be in [0, 0.5)!")
+
+        _, _, as_float = OUTPUT_LAYOUTS[self._output_layout]
+        with self.stats.stage("setup"):
+            weights = self._shot_weights(shots, vcam, weights)
+            self._prepare_projection(vcam, focus, resolution)
+            accum_fbo, integral_fbo = self._integral_framebuffers()
+
+        self._program["output_mode"].value = 5
+        if method != "mean":
+            # the intensity range (and weights) of the shots to average
+            self._robust_selection(shots, method, trim).use(1)
+            self._program["output_mode"].value = 4
+            self._program["weighted_edges"].value = method == "trimmed_mean"
+            self._program["bin_width"].value = _MAX_INTENSITY / HISTOGRAM_BINS
+        self._program["border"].value = border
+
+        accum_fbo.use()
+        accum_fbo.clear(0.0, 0.0, 0.0, 0.0)
+        self._begin_blending()
+        self._ctx.blend_func = moderngl.ONE, moderngl.ONE
+        shot_weight = self._program["shot_weight"]
+        for i in self._bind_shots(shots):
+            if weights is not None:
+                shot_weight.value = weights[i]
+            self._render_focal_surface()
+        self._end_blending()
+        self._program["output_mode"].value = 0
+        shot_weight.value = 1.0
+
+        with self.stats.stage("draw"):
+            integral_fbo.use()
+            accum_fbo.color_attachments[0].use(0)
+            self._normalize_program["scale"].value = 1.0 if as_float else 255.0
+            self._quad_vao.render(moderngl.TRIANGLE_STRIP)
+
+        return integral_fbo
+
+    @staticmethod
+    def _shot_weights(
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        weights: Union[np.ndarray, Callable],
+    ) -> np.ndarray:
+        """The weights of all shots, None if they are all one."""
+        if isinstance(shots, ShotCollection):
+            shot_weights = shots.weights
+        else:
+            shot_weights = np.array([shot.weight for shot in shots], dtype=np.float64)
+        if callable(weights):
+            weights = weights(shots, vcam)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if weights.shape != shot_weights.shape:
+                raise ValueError(
+                    f"Expected {len(shot_weights)} weights, got {weights.shape}"
+                )
+            shot_weights = shot_weights * weights
+        if np.all(shot_weights == 1.0):
+            return None
+        return shot_weights.tolist()
+
+    def _robust_framebuffers(
+        self,
+    ) -> Tuple[moderngl.Framebuffer, Tuple[moderngl.Framebuffer, ...]]:
+        """Get the framebuffers for robust integration.
+
+        The histogram framebuffer has HISTOGRAM_BINS / 4 float targets; the two
+        selection framebuffers hold per-pixel intensity ranges and are used in
+        turns while refining.
+        """
+        fbos = self._robust_fbos
+        if fbos is None or fbos[0].size != self.fbo.size:
+            if fbos is not None:
+                for fbo in (fbos[0], *fbos[1]):
+                    self._release_framebuffer(fbo)
+            histogram_fbo = self._ctx.framebuffer(
+                color_attachments=[
+                    self._ctx.texture(self.fbo.size, 4, dtype="f4")
+                    for _ in range(HISTOGRAM_BINS // 4)
+                ],
+                depth_attachment=self._ctx.depth_renderbuffer(self.fbo.size),
+            )
+            selection_fbos = tuple(
+                self._ctx.framebuffer(
+                    color_attachments=[self._ctx.texture(self.fbo.size, 4, dtype="f4")]
+                )
+                for _ in range(2)
+            )
+            self._robust_fbos = histogram_fbo, selection_fbos
+        return self._robust_fbos
 
-        integral = np.stack(projections, axis=-1).sum(axis=-1)
-        integral = self._postpro_img(integral)  # postprocess only once!
-        alpha = integral[:, :, -1] / 255.0
-        integral = np.divide(integral, alpha[:, :, np.newaxis])
-        return integral
+    def _robust_selection(
+        self, shots: Union[List[Shot], ShotCollection], method: str, trim: float
+    ) -> moderngl.Texture:
+        """Select the intensities to average per pixel for robust integration.
+
+        Returns:
+            moderngl.Texture: for "median" the range (low, high, number of shots
+                below, number of shots) of the median intensity, for
+                "trimmed_mean" the kept range (low, high) and the weights of the
+                shots in its lowest and highest bins
+        """
+        histogram_fbo, (selection, next_selection) = self._robust_framebuffers()
+        selection.clear(0.0, _MAX_INTENSITY, 0.0, 0.0)
+        self._select_program["trimmed"].value = method == "trimmed_mean"
+        self._select_program["trim"].value = trim
+
+        for _ in range(MEDIAN_LEVELS if method == "median" else 1):
+            # histograms of the intensities within the current ranges
+            histogram_fbo.use()
+            histogram_fbo.clear(0.0, 0.0, 0.0, 0.0)
+            selection.color_attachments[0].use(1)
+            self._program["output_mode"].value = 3
+            self._begin_blending()
+            self._ctx.blend_func = moderngl.ONE, moderngl.ONE
+            for _ in self._bind_shots(shots):
+                self._render_focal_surface()
+            self._end_blending()
+            self._program["output_mode"].value = 0
+
+            with self.stats.stage("draw"):
+                next_selection.use()
+                for i, texture in enumerate(histogram_fbo.color_attachments):
+                    texture.use(2 + i)
+                selection.color_attachments[0].use(1)
+                self._select_quad_vao.render(moderngl.TRIANGLE_STRIP)
+            selection, next_selection = next_selection, selection
+
+        return selection.color_attachments[0]
+
+    def _begin_blending(self):
+        """Enable blending into the bound framebuffer.
+
+        Without a focal surface the depth test is disabled. With one, a depth
+        pre-pass (keeping the colors) is drawn first, so the shots are only
+        blended where they hit the nearest part of the surface. The pre-pass
+        uses its own program: the main program discards fragments outside of
+        the bound shot, which may be a stale one before the first shot is bound.
+        """
+        if self._focal_surface is None:
+            self._ctx.disable(moderngl.DEPTH_TEST)
+        elif self._focal_surface.index_count > 0:
+            # enabled again, robust integration blends in several passes
+            self._ctx.enable(moderngl.DEPTH_TEST)
+            fbo = self._ctx.fbo  # the bound framebuffer
+            color_mask = fbo.color_mask
+            # one mask per color attachment, a single one for one attachment
+            no_color = (False,) * 4
+            fbo.color_mask = (
+                no_color
+                if isinstance(color_mask[0], bool)
+                else [no_color] * len(color_mask)
+            )
+            fbo.use()  # the masks are applied when the framebuffer is used
+            self._surface_depth_vao.render(
+                moderngl.TRIANGLES, vertices=self._focal_surface.index_count
+            )
+            fbo.color_mask = color_mask
+            fbo.use()
+            self._ctx.depth_func = "<="
+        self._ctx.enable(moderngl.BLEND)
+
+    def _end_blending(self):
+        """Restore the state changed by `_begin_blending`."""
+        self._ctx.disable(moderngl.BLEND)
+        self._ctx.blend_equation = moderngl.FUNC_ADD
+        if self._focal_surface is not None:
+            self._ctx.depth_func = "<"
+            self._ctx.disable(moderngl.DEPTH_TEST)
+
+    def _statistics_framebuffers(
+        self,
+    ) -> Tuple[moderngl.Framebuffer, moderngl.Framebuffer]:
+        """Get the float framebuffers for the moments and extrema of shots.
+
+        The first holds the sums and sums of squares, the second the maxima and
+        negated minima; both share one depth buffer.
+        """
+        fbos = self._statistics_fbos
+        if fbos is None or fbos[0].size != self.fbo.size:
+            if fbos is not None:
+                self._release_framebuffer(fbos[0])
+                for texture in fbos[1].color_attachments:
+                    texture.release()
+                fbos[1].release()
+            depth = self._ctx.depth_renderbuffer(self.fbo.size)
+            self._statistics_fbos = tuple(
+                self._ctx.framebuffer(
+                    color_attachments=[
+                        self._ctx.texture(self.fbo.size, 4, dtype="f4")
+                        for _ in range(2)
+                    ],
+                    depth_attachment=depth,
+                )
+                for _ in range(2)
+            )
+        return self._statistics_fbos
+
+    @_recorded
+    def statistics(
+        self,
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        focus=None,
+        resolution: tuple = None,
+    ) -> PixelStatistics:
+        """Compute per-pixel statistics of the projected shots in one pass.
+
+        Every shot is drawn twice: with additive blending into float targets
+        accumulating sums, sums of squares and counts, and with max blending into
+        targets keeping the maxima and (negated) minima. The memory does not
+        depend on the number of shots, the targets are read back once.
+
+        Args:
+            shots (List[Shot] or ShotCollection): the shots to project
+            vcam (Camera): the virtual camera
+            focus (float): the depth (z) of the focal plane, defaults to
+                `FOCAL_PLANE_Z`; a focal surface is moved along z like the
+                plane, by focus - `FOCAL_PLANE_Z`
+            resolution (tuple): the resolution of the images
+
+        Returns:
+            PixelStatistics: mean, variance, min, max and count images (float32,
+                scaled like `integrate`); all are zero where no shot contributes
+        """
+        _, _, as_float = OUTPUT_LAYOUTS[self._output_layout]
+        with self.stats.stage("setup"):
+            self._prepare_projection(vcam, focus, resolution)
+            moments_fbo, extrema_fbo = self._statistics_framebuffers()
+            extrema_fbo.use()
+            extrema_fbo.clear(-1e30, -1e30, -1e30, -1e30)
+            moments_fbo.use()
+            moments_fbo.clear(0.0, 0.0, 0.0, 0.0)
+        self._begin_blending()  # the depth pre-pass fills the shared depth buffer
+        output_mode = self._program["output_mode"]
+        for _ in self._bind_shots(shots):
+            moments_fbo.use()
+            output_mode.value = 1
+            self._ctx.blend_equation = moderngl.FUNC_ADD
+            self._ctx.blend_func = moderngl.ONE, moderngl.ONE
+            self._render_focal_surface()
+
+            extrema_fbo.use()
+            output_mode.value = 2
+            self._ctx.blend_equation = moderngl.MAX
+            self._render_focal_surface()
+        output_mode.value = 0
+        self._end_blending()
+
+        total, total_sq, maximum, neg_minimum = (
+            self._img_from_fbo(fbo, dtype="f4", attachment=attachment).astype(
+                np.float64
+            )
+            for fbo in (moments_fbo, extrema_fbo)
+            for attachment in range(2)
+        )
+        with self.stats.stage("postprocess"):
+            count = total[..., 3]
+            covered = count > 0
+            n = np.maximum(count, 1)[..., np.newaxis]
+            mean = total[..., :3] / n
+            variance = np.maximum(total_sq[..., :3] / n - mean**2, 0.0)
+            scale = 1.0 if as_float else 255.0
+            mask = covered[..., np.newaxis]
+            return PixelStatistics(
+                (mean * scale).astype("f4"),
+                (variance * scale**2).astype("f4"),
+                np.where(mask, -neg_minimum[..., :3] * scale, 0.0).astype("f4"),
+                np.where(mask, maximum[..., :3] * scale, 0.0).astype("f4"),
+                count.astype("f4"),
+            )
+
+    def _sharpness_texture(self) -> moderngl.Texture:
+        """Get the float texture (with mipmaps) for the per-pixel sharpness."""
+        if self._sharpness_fbo is None or self._sharpness_fbo.size != self.fbo.size:
+            self._release_framebuffer(self._sharpness_fbo)
+            texture = self._ctx.texture(self.fbo.size, 4, dtype="f4")
+            self._sharpness_fbo = self._ctx.framebuffer(color_attachments=[texture])
+        return self._sharpness_fbo.color_attachments[0]
+
+    def _focus_score(self, integral_fbo: moderngl.Framebuffer, metric: str) -> float:
+        """Reduce the sharpness of an integral image to a scalar on the GPU.
+
+        The per-pixel sharpness terms are rendered into a float texture, which is
+        averaged by building its mipmaps; only the 1x1 level is read back.
+        """
+        with self.stats.stage("draw"):
+            texture = self._sharpness_texture()
+            self._sharpness_fbo.use()
+            integral_fbo.color_attachments[0].use(0)
+            self._sharpness_quad_vao.render(moderngl.TRIANGLE_STRIP)
+            texture.build_mipmaps()
+
+        top_level = int(np.log2(max(texture.size)))
+        with self.stats.stage("readback"):
+            gradient, mean, mean_sq, coverage = np.frombuffer(
+                texture.read(level=top_level), dtype="f4"
+            )[:4]
+        if coverage <= 0.0:
+            return 0.0
+        if metric == "gradient":
+            return float(gradient / coverage)
+        # variance of the covered pixels
+        return float(mean_sq / coverage - (mean / coverage) ** 2)
+
+    @_recorded
+    def autofocus(
+        self,
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        depth_range: Tuple[float, float],
+        steps: int = 8,
+        iterations: int = 3,
+        metric: str = "gradient",
+        resolution: tuple = None,
+    ) -> float:
+        """Find the focus (depth of the focal plane) with the sharpest integral.
+
+        The depth range is sampled at `steps` depths; then the search is repeated
+        `iterations - 1` times between the neighbours of the best depth. Each
+        candidate is integrated and scored on the GPU, only the scores are read
+        back.
+
+        Args:
+            shots (List[Shot] or ShotCollection): the shots to integrate
+            vcam (Camera): the virtual camera
+            depth_range (tuple): the nearest and farthest focus to search
+            steps (int): the number of depths evaluated per iteration
+            iterations (int): the number of coarse-to-fine iterations
+            metric (str): the sharpness metric, "gradient" (mean gradient energy)
+                or "variance" (intensity variance)
+            resolution (tuple): the resolution of the integral images
+
+        Returns:
+            float: the focus with the highest sharpness
+        """
+        if metric not in ("gradient", "variance"):
+            raise ValueError(f"Unknown metric {metric}, use 'gradient' or 'variance'")
+        if steps < 2:
+            raise ValueError("At least 2 steps are needed!")
+
+        near, far = depth_range
+        best_depth, best_score = near, -np.inf
+        for _ in range(iterations):
+            depths = np.linspace(near, far, steps)
+            scores = []
+            for depth in depths:
+                integral_fbo = self._integrate_to_fbo(shots, vcam, depth, resolution)
+                scores.append(self._focus_score(integral_fbo, metric))
+            best = int(np.argmax(scores))
+            if scores[best] > best_score:
+                best_depth, best_score = float(depths[best]), scores[best]
+            # refine between the neighbours of the best depth
+            near, far = depths[max(best - 1, 0)], depths[min(best + 1, steps - 1)]
+        return best_depth
+
+    def _focus_sweep_framebuffers(
+        self,
+    ) -> Tuple[moderngl.Framebuffer, moderngl.Framebuffer]:
+        """Get the two float framebuffers holding the state of a focus sweep."""
+        fbos = self._focus_sweep_fbos
+        if fbos is None or fbos[0].size != self.fbo.size:
+            for fbo in fbos or ():
+                self._release_framebuffer(fbo)
+            self._focus_sweep_fbos = tuple(
+                self._ctx.framebuffer(
+                    color_attachments=[self._ctx.texture(self.fbo.size, 4, dtype="f4")]
+                )
+                for _ in range(2)
+            )
+        return self._focus_sweep_fbos
+
+    @_recorded
+    def depth_from_focus(
+        self,
+        shots: Union[List[Shot], ShotCollection],
+        vcam: Camera,
+        depths: Sequence[float],
+        window: int = 5,
+        resolution: tuple = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Estimate the depth of every pixel as the focus with the highest contrast.
+
+        The shots are integrated at each depth and the local contrast (intensity
+        variance in a window) is compared on the GPU with the best one so far;
+        only the running best score, its depth and the sum of all scores are kept
+        in a texture, the focal stack is never stored.
+
+        Args:
+            shots (List[Shot] or ShotCollection): the shots to integrate
+            vcam (Camera): the virtual camera
+            depths (Sequence[float]): the focus depths to sweep
+            window (int): the size of the (square) window of the local contrast
+            resolution (tuple): the resolution of the maps
+
+        Returns:
+            tuple: the depth map and the confidence map (float32, in the output
+                layout's row order); the confidence is 1 - mean score / best score
+                and depths of pixels never covered by a shot are NaN
+        """
+        with self.stats.stage("setup"):
+            if resolution is not None and resolution != self.fbo.size:
+                self.fbo = self._ctx.simple_framebuffer(resolution, components=4)
+            state, next_state = self._focus_sweep_framebuffers()
+            state.clear(0.0, 0.0, 0.0, 0.0)
+            self._focus_sweep_program["radius"].value = window // 2
+
+        for depth in depths:
+            integral_fbo = self._integrate_to_fbo(shots, vcam, depth)
+            with self.stats.stage("draw"):
+                next_state.use()
+                integral_fbo.color_attachments[0].use(0)
+                state.color_attachments[0].use(1)
+                self._focus_sweep_program["depth"].value = float(depth)
+                self._focus_sweep_quad_vao.render(moderngl.TRIANGLE_STRIP)
+            state, next_state = next_state, state
+
+        best, best_depth, total, count = np.moveaxis(
+            self._img_from_fbo(state, dtype="f4"), -1, 0
+        )
+        with self.stats.stage("postprocess"):
+            covered = count > 0
+            depth_map = np.where(covered, best_depth, np.nan).astype("f4")
+            with np.errstate(divide="ignore", invalid="ignore"):
+                confidence = np.where(
+                    covered & (best > 0), 1.0 - total / np.maximum(count, 1) / best, 0.0
+                ).astype("f4")
+        return depth_map, confidence
+
+    def _framebuffers(self) -> Tuple[moderngl.Framebuffer, ...]:
+        """All framebuffers created by the renderer so far."""
+        fbos = [self._fbo, self._accum_fbo, self._integral_fbo, self._sharpness_fbo]
+        fbos.extend(self._focus_sweep_fbos or ())
+        fbos.extend(self._statistics_fbos or ())
+        if self._robust_fbos is not None:
+            fbos.append(self._robust_fbos[0])
+            fbos.extend(self._robust_fbos[1])
+        return tuple(fbo for fbo in fbos if fbo is not None)
+
+    def memory_usage(self) -> MemoryUsage:
+        """The GPU memory held by the renderer.
+
+        The framebuffers are created lazily by the render methods and kept for
+        the next call, so the usage grows with the methods used. Attachments
+        shared by framebuffers are counted once.
+
+        Returns:
+            MemoryUsage: the framebuffer bytes (by format) and the bytes of the
+                vertex and index buffers, including those of the focal surface
+        """
+        by_format = {}
+        attachments = []
+        for fbo in self._framebuffers():
+            attachments.extend(fbo.color_attachments)
+            attachments.append(fbo.depth_attachment)
+        framebuffer_bytes = _add_textures(by_format, attachments)
+        buffer_bytes = sum(buffer.size for buffer in self._buffers)
+        if self._focal_surface is not None:
+            buffer_bytes += self._focal_surface.buffer_bytes
+        return MemoryUsage(0, 0, framebuffer_bytes, buffer_bytes, by_format)
+
+    def _update_peak_memory_usage(self, method: str):
+        """Update the peak memory of the method after a call."""
+        key = (*self._framebuffers(), self._focal_surface)
+        if key != self._memory_key:
+            self._memory_key, self._memory = key, self.memory_usage()
+        usage = self._memory._replace(host_bytes=self._readback_bytes)
+        peak = self._peak_memory.get(method)
+        if peak is None or sum(usage[:4]) > sum(peak[:4]):
+            self._peak_memory[method] = usage
+
+    @property
+    def peak_memory_usage(self) -> dict:
+        """The peak memory of each render method (e.g. "integrate") so far.
+
+        The host bytes are those of the images read back in a call, the GPU bytes
+        those held by the renderer after the call (see `memory_usage`).
+        """
+        return dict(self._peak_memory)
+
+    def reset_peak_memory_usage(self):
+        """Forget the peak memory usage of the render methods."""
+        self._peak_memory = {}
 
     @property
     def fbo(self):
@@ -185,15 +954,74 @@ class Renderer:
     def fbo(self, fbo: moderngl.Framebuffer):
         self._fbo = fbo
 
+    @property
+    def focal_surface(self) -> FocalSurface:
+        """Get or Set the focal surface, None for the default plane."""
+        return self._focal_surface
+
+    @focal_surface.setter
+    def focal_surface(self, surface: FocalSurface):
+        self._focal_surface = surface
+        self._surface_vao = None
+        self._surface_depth_vao = None
+        if surface is not None:
+            self._surface_vao, self._surface_depth_vao = (
+                self._ctx.vertex_array(
+                    program,
+                    [(surface.vertex_buffer, "3f", "in_position")],
+                    surface.index_buffer,
+                    index_element_size=4,
+                )
+                for program in (self._program, self._depth_program)
+            )
+
     @property
     def program(self):
         """The internal shader program used by the renderer."""
         return self._program
 
+    @property
+    def output_layout(self) -> str:
+        """Get or Set the layout of returned images ("opencv", "gl" or "float")."""
+        return self._output_layout
+
+    @output_layout.setter
+    def output_layout(self, layout: str):
+        if layout not in OUTPUT_LAYOUTS:
+            raise ValueError(
+                f"Unknown output layout {layout}, use one of {list(OUTPUT_LAYOUTS)}"
+            )
+        self._output_layout = layout
+
+    @staticmethod
+    def _setup_depth_program(ctx: moderngl.Context) -> moderngl.Program:
+        """Setup the program writing the depth of the focal surface only."""
+        return ctx.program(
+            vertex_shader="""
+                    #version 330
+
+                    uniform mat4 m_proj;
+                    uniform mat4 m_model;
+                    uniform mat4 m_cam;
+
+                    in vec3 in_position;
+
+                    void main() {
+                        gl_Position = m_proj * m_cam * m_model * vec4(in_position, 1.0);
+                    }
+                """,
+            fragment_shader="""
+                    #version 330
+
+                    void main() {
+                    }
+                """,
+        )
+
     @staticmethod
     def _setup_alfr_program(ctx: moderngl.Context) -> moderngl.Program:
         """Setup the shader program to be used by the renderer."""
-        return ctx.program(
+        program = ctx.program(
             vertex_shader="""
                     #version 330
 
@@ -222,22 +1050,363 @@ class Renderer:
 
 
                     uniform sampler2D shotTexture;
+                    uniform bool swap_rb; // output BGR instead of RGB
+                    // 0: color, 1: color and squared color, 2: color and negated color,
+                    // 3: intensity histogram, 4: weighted color in the selection,
+                    // 5: weighted color (color times weight, weight)
+                    uniform int output_mode;
+                    // weight of the shot and width of the border weight falloff
+                    uniform float shot_weight;
+                    uniform float border;
+                    // per-pixel intensity ranges of robust integration (modes 3 and 4)
+                    uniform sampler2D selectionTexture;
+                    uniform bool weighted_edges;
+                    uniform float bin_width;
+
+                    uniform mat4 m_shot_proj;
+                    // lens distortion of the shot (see DISTORTION_MODELS)
+                    uniform int shot_distortion_model; // 0: none, 1: opencv, 2: fisheye
+                    uniform vec4 shot_distortion;
 
                     in vec4 wpos;
                     in vec4 shotUV;
-                    out vec4 color;
+                    layout(location = 0) out vec4 color;
+                    layout(location = 1) out vec4 color_extra; // used by statistics
+                    layout(location = 2) out vec4 histogram[6]; // bins 8 to 31
+
+                    // weight of the shot at the texture coordinate, falling off at the borders
+                    float pixel_weight(vec2 uv) {
+                        if (border <= 0.0) {
+                            return shot_weight;
+                        }
+                        vec2 edge = min(uv, 1.0 - uv);
+                        return shot_weight * clamp(min(edge.x, edge.y) / border, 0.0, 1.0);
+                    }
+
+                    // one-hot vector of the histogram bin among the 4 bins starting at first
+                    vec4 histogram_bin(int first, int bin) {
+                        return vec4(equal(ivec4(first) + ivec4(0, 1, 2, 3), ivec4(bin)));
+                    }
+
+                    // distort ideal normalized image coordinates (y pointing down)
+                    vec2 distort(vec2 p) {
+                        vec4 k = shot_distortion;
+                        float r2 = dot(p, p);
+                        if (shot_distortion_model == 1) {
+                            // radial (k1, k2) and tangential (p1, p2) distortion
+                            float radial = 1.0 + k.x * r2 + k.y * r2 * r2;
+                            return p * radial + vec2(
+                                2.0 * k.z * p.x * p.y + k.w * (r2 + 2.0 * p.x * p.x),
+                                k.z * (r2 + 2.0 * p.y * p.y) + 2.0 * k.w * p.x * p.y
+                            );
+                        } else if (shot_distortion_model == 2 && r2 > 1e-16) {
+                            // equidistant fisheye (k1, k2, k3, k4)
+                            float r = sqrt(r2);
+                            float theta = atan(r);
+                            float t2 = theta * theta;
+                            float theta_d = theta * (1.0 + t2 * (k.x + t2 * (k.y + t2 * (k.z + t2 * k.w))));
+                            return p * theta_d / r;
+                        }
+                        return p;
+                    }
 
                     void main() {
                         vec4 uv = shotUV;
-                        uv = vec4(uv.xyz / uv.w / 2.0 + .5, 1.0); // perspective division and conversion to [0,1] from NDC
+                        uv.xyz /= uv.w; // perspective division
+                        if (shot_distortion_model != 0) {
+                            // NDC to normalized image coordinates and back, the shot
+                            // texture is flipped so y points up in NDC
+                            vec2 focal = vec2(m_shot_proj[0][0], -m_shot_proj[1][1]);
+                            uv.xy = distort(uv.xy / focal) * focal;
+                        }
+                        uv = vec4(uv.xyz / 2.0 + .5, 1.0); // conversion to [0,1] from NDC
 
                         if(uv.x < 0.0 || uv.x > 1.0 || uv.y < 0.0 || uv.y > 1.0) {
                             discard; // throw away the fragment 
                             color = vec4(0.0, 0.0, 0.0, 0.0);
                         } else {
                             // DEBUG: color = vec4(1.0, 1.0, 0.0, 1.0);
-                            color = vec4(texture(shotTexture, uv.xy).rgb, 1.0);
+                            vec3 rgb = texture(shotTexture, uv.xy).rgb;
+                            color = vec4(swap_rb ? rgb.bgr : rgb, 1.0);
+                            if (output_mode == 1) {
+                                color_extra = vec4(color.rgb * color.rgb, 1.0);
+                            } else if (output_mode == 2) {
+                                color_extra = vec4(-color.rgb, 1.0);
+                            } else if (output_mode == 3 || output_mode == 4) {
+                                vec4 selection = texelFetch(selectionTexture, ivec2(gl_FragCoord.xy), 0);
+                                float intensity = (rgb.r + rgb.g + rgb.b) / 3.0;
+                                bool selected = intensity >= selection.x && intensity < selection.y;
+                                if (output_mode == 3) {
+                                    // the bin of the intensity within the range, the edges are
+                                    // computed exactly as in the selection pass
+                                    float width = (selection.y - selection.x) / 32.0;
+                                    int bin = clamp(int((intensity - selection.x) / width), 0, 31);
+                                    if (intensity < selection.x + float(bin) * width) bin -= 1;
+                                    if (intensity >= selection.x + float(bin + 1) * width) bin += 1;
+                                    bin = selected ? clamp(bin, 0, 31) : -1;
+                                    color = histogram_bin(0, bin);
+                                    color_extra = histogram_bin(4, bin);
+                                    for (int i = 0; i < 6; i++) {
+                                        histogram[i] = histogram_bin(8 + 4 * i, bin);
+                                    }
+                                } else {
+                                    float weight = selected ? pixel_weight(uv.xy) : 0.0;
+                                    if (selected && weighted_edges) {
+                                        // partially kept shots in the lowest and highest bins
+                                        if (intensity < selection.x + bin_width) {
+                                            weight *= selection.z;
+                                        } else if (intensity >= selection.y - bin_width) {
+                                            weight *= selection.w;
+                                        }
+                                    }
+                                    color = vec4(color.rgb * weight, weight);
+                                }
+                            } else if (output_mode == 5) {
+                                float weight = pixel_weight(uv.xy);
+                                color = vec4(color.rgb * weight, weight);
+                            }
+                        }
+                    }
+                """,
+        )
+        program["selectionTexture"].value = 1
+        program["shot_weight"].value = 1.0
+        return program
+
+    @staticmethod
+    def _setup_normalize_program(ctx: moderngl.Context) -> moderngl.Program:
+        """Setup the shader program dividing accumulated shots by their count."""
+        return ctx.program(
+            vertex_shader="""
+                    #version 330
+
+                    in vec2 in_position;
+
+                    void main() {
+                        gl_Position = vec4(in_position, 0.0, 1.0);
+                    }
+                """,
+            fragment_shader="""
+                    #version 330
+
+                    uniform sampler2D accumTexture;
+                    uniform float scale;
+
+                    out vec4 color;
+
+                    void main() {
+                        vec4 acc = texelFetch(accumTexture, ivec2(gl_FragCoord.xy), 0);
+                        // alpha holds the number of shots contributing to this pixel
+                        color = acc.a > 0.0 ? vec4(acc.rgb / acc.a, 1.0) * scale : vec4(0.0);
+                    }
+                """,
+        )
+
+    @staticmethod
+    def _setup_sharpness_program(ctx: moderngl.Context) -> moderngl.Program:
+        """Setup the shader program computing the per-pixel sharpness terms."""
+        return ctx.program(
+            vertex_shader="""
+                    #version 330
+
+                    in vec2 in_position;
+
+                    void main() {
+                        gl_Position = vec4(in_position, 0.0, 1.0);
+                    }
+                """,
+            fragment_shader="""
+                    #version 330
+
+                    uniform sampler2D integralTexture;
+
+                    out vec4 color;
+
+                    float intensity(ivec2 p) {
+                        vec4 c = texelFetch(integralTexture, p, 0);
+                        // pixels without any shot are marked as negative
+                        return c.a > 0.0 ? (c.r + c.g + c.b) / 3.0 : -1.0;
+                    }
+
+                    void main() {
+                        ivec2 p = ivec2(gl_FragCoord.xy);
+                        ivec2 last = textureSize(integralTexture, 0) - 1;
+                        float i = intensity(p);
+                        float right = intensity(min(p + ivec2(1, 0), last));
+                        float left = intensity(max(p - ivec2(1, 0), 0));
+                        float up = intensity(min(p + ivec2(0, 1), last));
+                        float down = intensity(max(p - ivec2(0, 1), 0));
+                        float dx = right - left;
+                        float dy = up - down;
+                        // only covered pixels with covered neighbours count
+                        bool covered = min(min(i, min(right, left)), min(up, down)) >= 0.0;
+                        // gradient energy, intensity, squared intensity and coverage
+                        color = covered ? vec4(dx * dx + dy * dy, i, i * i, 1.0) : vec4(0.0);
+                    }
+                """,
+        )
+
+    @staticmethod
+    def _setup_focus_sweep_program(ctx: moderngl.Context) -> moderngl.Program:
+        """Setup the shader program updating the best focus of every pixel."""
+        program = ctx.program(
+            vertex_shader="""
+                    #version 330
+
+                    in vec2 in_position;
+
+                    void main() {
+                        gl_Position = vec4(in_position, 0.0, 1.0);
+                    }
+                """,
+            fragment_shader="""
+                    #version 330
+
+                    uniform sampler2D integralTexture;
+                    // best score, its depth, sum of scores and number of scores
+                    uniform sampler2D stateTexture;
+                    uniform float depth;
+                    uniform int radius;
+
+                    out vec4 color;
+
+                    void main() {
+                        ivec2 p = ivec2(gl_FragCoord.xy);
+                        ivec2 last = textureSize(integralTexture, 0) - 1;
+                        vec4 state = texelFetch(stateTexture, p, 0);
+                        color = state;
+                        if (texelFetch(integralTexture, p, 0).a <= 0.0) {
+                            return; // no shot at this depth
+                        }
+
+                        // intensity variance of the covered pixels in the window
+                        float n = 0.0, sum = 0.0, sum_sq = 0.0;
+                        for (int y = -radius; y <= radius; y++) {
+                            for (int x = -radius; x <= radius; x++) {
+                                vec4 c = texelFetch(integralTexture, clamp(p + ivec2(x, y), ivec2(0), last), 0);
+                                if (c.a > 0.0) {
+                                    float i = (c.r + c.g + c.b) / 3.0;
+                                    n += 1.0;
+                                    sum += i;
+                                    sum_sq += i * i;
+                                }
+                            }
+                        }
+                        float score = max(sum_sq / n - (sum / n) * (sum / n), 0.0);
+
+                        color.zw += vec2(score, 1.0);
+                        if (state.w == 0.0 || score > state.x) {
+                            color.xy = vec2(score, depth);
+                        }
+                    }
+                """,
+        )
+        program["integralTexture"].value = 0
+        program["stateTexture"].value = 1
+        return program
+
+    @staticmethod
+    def _setup_select_program(ctx: moderngl.Context) -> moderngl.Program:
+        """Setup the shader program selecting intensity ranges from histograms."""
+        program = ctx.program(
+            vertex_shader="""
+                    #version 330
+
+                    in vec2 in_position;
+
+                    void main() {
+                        gl_Position = vec4(in_position, 0.0, 1.0);
+                    }
+                """,
+            fragment_shader="""
+                    #version 330
+
+                    // 32 bins, 4 per texture
+                    uniform sampler2D histogram0;
+                    uniform sampler2D histogram1;
+                    uniform sampler2D histogram2;
+                    uniform sampler2D histogram3;
+                    uniform sampler2D histogram4;
+                    uniform sampler2D histogram5;
+                    uniform sampler2D histogram6;
+                    uniform sampler2D histogram7;
+                    // low, high, number of shots below and number of shots (median)
+                    uniform sampler2D selectionTexture;
+                    uniform bool trimmed;
+                    uniform float trim;
+
+                    out vec4 color;
+
+                    // the bin containing the given rank and the number of shots below it
+                    int find_bin(vec4 h[8], float rank, out float below) {
+                        below = 0.0;
+                        for (int bin = 0; bin < 32; bin++) {
+                            float count = h[bin / 4][bin % 4];
+                            if (rank < below + count) {
+                                return bin;
+                            }
+                            below += count;
+                        }
+                        below -= h[7].w;
+                        return 31;
+                    }
+
+                    void main() {
+                        ivec2 p = ivec2(gl_FragCoord.xy);
+                        vec4 h[8] = vec4[8](
+                            texelFetch(histogram0, p, 0),
+                            texelFetch(histogram1, p, 0),
+                            texelFetch(histogram2, p, 0),
+                            texelFetch(histogram3, p, 0),
+                            texelFetch(histogram4, p, 0),
+                            texelFetch(histogram5, p, 0),
+                            texelFetch(histogram6, p, 0),
+                            texelFetch(histogram7, p, 0)
+                        );
+                        vec4 range = texelFetch(selectionTexture, p, 0);
+                        float width = (range.y - range.x) / 32.0;
+                        float total = 0.0;
+                        for (int i = 0; i < 8; i++) {
+                            total += dot(h[i], vec4(1.0));
+                        }
+
+                        if (trimmed) {
+                            // keep the ranks first..last, weighting the shots of the
+                            // lowest and highest kept bins by the kept fraction
+                            float cut = floor(trim * total);
+                            float first = cut, last = total - cut - 1.0;
+                            float below_low, below_high;
+                            int low = find_bin(h, first, below_low);
+                            int high = find_bin(h, last, below_high);
+                            float count_low = h[low / 4][low % 4];
+                            float count_high = h[high / 4][high % 4];
+                            float weight_low = (below_low + count_low - first) / count_low;
+                            float weight_high = (last - below_high + 1.0) / count_high;
+                            if (low == high) {
+                                weight_low = weight_high = (last - first + 1.0) / count_low;
+                            }
+                            color = total > 0.0 ? vec4(
+                                range.x + float(low) * width,
+                                range.x + float(high + 1) * width,
+                                weight_low,
+                                weight_high
+                            ) : vec4(0.0);
+                        } else {
+                            // narrow the range to the bin of the (lower) median
+                            float n = range.w > 0.0 ? range.w : total;
+                            float below;
+                            int bin = find_bin(h, floor((n - 1.0) / 2.0) - range.z, below);
+                            color = n > 0.0 ? vec4(
+                                range.x + float(bin) * width,
+                                range.x + float(bin + 1) * width,
+                                range.z + below,
+                                n
+                            ) : vec4(0.0);
                         }
                     }
                 """,
         )
+        for i in range(HISTOGRAM_BINS // 4):
+            program[f"histogram{i}"].value = 2 + i
+        program["selectionTexture"].value = 1
+        return program
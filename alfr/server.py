@@ -0,0 +1,554 @@
+"""
+    Local render server keeping light fields resident on the GPU.
+
+    Run with `python -m alfr.server --light-field scene=poses.json`. The light
+    fields are loaded once and rendered by one thread owning the OpenGL context,
+    so many clients share the warm context, the uploaded textures and the
+    compiled shaders. Requests are queued; the render thread takes all waiting
+    requests as a batch, orders them by light field and resolution, and renders
+    identical requests once. With `--cache-mb` repeated views are answered from
+    a `ResultCache`.
+
+    Endpoints (JSON bodies, images are returned as png or raw float32 npy):
+        GET  /light_fields  names and shot counts of the resident light fields
+        GET  /info          request, batch and cache counters
+        POST /load          {"name": ..., "path": ..., "fovy": ...}
+        POST /render        {"light_field": ..., "position": [x,y,z],
+                             "rotation": [x,y,z,w], "fovy": 60, "focus": ...,
+                             "resolution": [w,h], "mode": "mean", "format": "png"}
+
+    Example:
+        curl -d '{"light_field": "scene", "position": [0, 0, 10]}' \\
+            http://127.0.0.1:8765/render -o integral.png
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import urllib.request
+import numpy as np
+import moderngl
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from alfr.globals import ContextManager
+from alfr.cache import ResultCache
+from alfr.camera import Camera
+from alfr.renderer import INTEGRATION_METHODS, Renderer
+from alfr.shot import ShotCollection
+from alfr.utils import load_shots_from_csv, load_shots_from_json, load_shots_from_npz
+from typing import Dict, List
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# the largest number of queued requests rendered as one batch
+MAX_BATCH_SIZE = 32
+
+# shot loaders by file extension
+LOADERS = {
+    ".json": load_shots_from_json,
+    ".npz": load_shots_from_npz,
+    ".csv": load_shots_from_csv,
+}
+# render modes: the integration methods and the projection of a single shot
+MODES = INTEGRATION_METHODS + ("project",)
+# encodings of the returned images
+FORMATS = ("png", "raw")
+
+
+class RenderError(Exception):
+    """An invalid render request, status is the HTTP status code."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+# A parsed render request:
+#   light_field: name of the resident light field
+#   position: (x,y,z) of the virtual camera
+#   rotation: (x,y,z,w) quaternion of the virtual camera
+#   fovy: vertical field of view in degrees
+#   focus: depth of the focal plane (None for the default)
+#   resolution: (width, height) of the image
+#   mode: one of `MODES`
+#   shot: index of the shot projected by the "project" mode
+#   format: one of `FORMATS`
+_REQUEST_FIELDS = (
+    "light_field",
+    "position",
+    "rotation",
+    "fovy",
+    "focus",
+    "resolution",
+    "mode",
+    "shot",
+    "format",
+)
+
+
+def parse_render_request(body: dict, default_resolution: tuple = (512, 512)) -> tuple:
+    """Validate a render request and fill in the defaults.
+
+    Returns:
+        tuple: the values of the request fields, hashable to find identical
+            requests
+    """
+    unknown = set(body) - set(_REQUEST_FIELDS)
+    if unknown:
+        raise RenderError(f"Unknown request fields {sorted(unknown)}")
+    if "light_field" not in body:
+        raise RenderError("The request needs a light_field")
+    try:
+        position = tuple(float(v) for v in body.get("position", (0.0, 0.0, 0.0)))
+        rotation = tuple(float(v) for v in body.get("rotation", (0.0, 0.0, 0.0, 1.0)))
+        fovy = float(body.get("fovy", 60.0))
+        focus = body.get("focus")
+        focus = None if focus is None else float(focus)
+        resolution = tuple(int(v) for v in body.get("resolution", default_resolution))
+        shot = int(body.get("shot", 0))
+    except (TypeError, ValueError) as e:
+        raise RenderError(f"Invalid request value: {e}")
+    if len(position) != 3 or len(rotation) != 4 or len(resolution) != 2:
+        raise RenderError("position, rotation and resolution need 3, 4 and 2 values")
+    if min(resolution) < 1:
+        raise RenderError("The resolution must be positive")
+    mode = body.get("mode", "mean")
+    if mode not in MODES:
+        raise RenderError(f"Unknown mode {mode}, use one of {MODES}")
+    image_format = body.get("format", "png")
+    if image_format not in FORMATS:
+        raise RenderError(f"Unknown format {image_format}, use one of {FORMATS}")
+    return (
+        str(body["light_field"]),
+        position,
+        rotation,
+        fovy,
+        focus,
+        resolution,
+        mode,
+        shot,
+        image_format,
+    )
+
+
+def load_light_field(
+    path: str, fovy: float = None, ctx: moderngl.Context = None
+) -> ShotCollection:
+    """Load the shots of a pose file (json, npz or csv, see `LOADERS`)."""
+    loader = LOADERS.get(os.path.splitext(path)[1].lower())
+    if loader is None:
+        raise RenderError(f"Unknown light field format of {path}, use {list(LOADERS)}")
+    if not os.path.isfile(path):
+        raise RenderError(f"Light field {path} not found", status=404)
+    # fovy is the fallback for shots without a field of view
+    kwargs = {} if fovy is None else {"fovy": fovy}
+    return ShotCollection.from_shots(loader(path, ctx=ctx, **kwargs))
+
+
+def encode_image(img: np.ndarray, image_format: str) -> tuple:
+    """Encode a rendered image (opencv layout).
+
+    Returns:
+        tuple: the encoded bytes and their content type
+    """
+    if image_format == "raw":
+        f = io.BytesIO()
+        np.save(f, img.astype(np.float32, copy=False))
+        return f.getvalue(), "application/x-npy"
+    import cv2
+
+    ok, png = cv2.imencode(".png", np.clip(img, 0, 255).astype(np.uint8))
+    if not ok:
+        raise RenderError("The image could not be encoded", status=500)
+    return png.tobytes(), "image/png"
+
+
+class RenderService:
+    """Keeps light fields resident and renders queued requests in one thread.
+
+    The render thread creates and owns the OpenGL context, loading and
+    rendering happen in it. `submit` and `load` can be called from any thread
+    and return futures.
+    """
+
+    def __init__(
+        self,
+        resolution: tuple = (512, 512),
+        max_batch_size: int = MAX_BATCH_SIZE,
+        cache: ResultCache = None,
+        allow_fallback_egl_context: bool = True,
+    ):
+        """
+        Args:
+            resolution (tuple): the default resolution of the images
+            max_batch_size (int): the most requests rendered as one batch
+            cache (ResultCache): cache of the rendered images, None renders
+                every request
+        """
+        self.resolution = tuple(resolution)
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+        self._queue = queue.Queue()
+        self._light_fields = {}  # name -> ShotCollection, used in the render thread
+        self._light_field_info = {}  # name -> dict, read by any thread
+        self._info_lock = threading.Lock()
+        self._batches = 0
+        self._rendered = 0
+        self._requests = 0
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(allow_fallback_egl_context,),
+            name="alfr-render",
+            daemon=True,
+        )
+        self._started = Future()
+        self._thread.start()
+        self._started.result()  # raises if no context could be created
+
+    def load(self, name: str, path: str, fovy: float = None) -> Future:
+        """Load a light field (replacing one of the same name)."""
+        return self._put(("load", (name, path, fovy)))
+
+    def submit(self, request: tuple) -> Future:
+        """Queue a render request (see `parse_render_request`).
+
+        The future results in the rendered image (opencv layout).
+        """
+        return self._put(("render", request))
+
+    def light_fields(self) -> Dict[str, dict]:
+        """The resident light fields with their path and number of shots."""
+        with self._info_lock:
+            return {name: dict(info) for name, info in self._light_field_info.items()}
+
+    def info(self) -> dict:
+        """Counters of the handled requests, batches and of the cache."""
+        info = {
+            "requests": self._requests,
+            "rendered": self._rendered,
+            "batches": self._batches,
+            "queued": self._queue.qsize(),
+        }
+        if self.cache is not None:
+            info["cache"] = self.cache.stats()._asdict()
+        return info
+
+    def close(self):
+        """Stop the render thread and release the light fields."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _put(self, job: tuple) -> Future:
+        if not self._thread.is_alive():
+            raise RuntimeError("The render service is closed")
+        future = Future()
+        self._queue.put(job + (future,))
+        return future
+
+    def _run(self, allow_fallback_egl_context: bool):
+        try:
+            ctx = ContextManager.get_default_context(allow_fallback_egl_context)
+            renderer = Renderer(self.resolution, ctx=ctx)
+            renderer.cache = self.cache
+        except Exception as e:
+            self._started.set_exception(e)
+            return
+        self._started.set_result(None)
+
+        while True:
+            jobs = [self._queue.get()]
+            # take the waiting requests as one batch
+            while len(jobs) < self.max_batch_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in jobs
+            jobs = [job for job in jobs if job is not None]
+
+            # loads first, so requests of the batch see their light fields
+            for kind, args, future in jobs:
+                if kind == "load" and future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self._load(*args, ctx=ctx))
+                    except Exception as e:
+                        future.set_exception(e)
+            renders = [job for job in jobs if job[0] == "render"]
+            if renders:
+                self._render_batch(renderer, renders)
+            if stop:
+                break
+
+        self._light_fields.clear()
+        with self._info_lock:
+            self._light_field_info.clear()
+        ContextManager.release_thread_context()
+
+    def _load(self, name: str, path: str, fovy: float, ctx: moderngl.Context) -> dict:
+        shots = load_light_field(path, fovy, ctx)
+        previous = self._light_fields.pop(name, None)
+        if previous is not None:
+            for texture in set(previous.textures):
+                texture.release()
+        self._light_fields[name] = shots
+        info = {"path": path, "shots": len(shots)}
+        with self._info_lock:
+            self._light_field_info[name] = info
+        return dict(info)
+
+    def _render_batch(self, renderer: Renderer, jobs: List[tuple]):
+        # identical requests are rendered once
+        requests = {}
+        for _, request, future in jobs:
+            if future.set_running_or_notify_cancel():
+                requests.setdefault(request, []).append(future)
+        # by light field, resolution and mode, so the framebuffers are reused
+        order = sorted(requests, key=lambda r: (r[0], r[5], r[6]))
+        for request in order:
+            futures = requests[request]
+            try:
+                img = self._render(renderer, request)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(img)
+        self._batches += 1
+        self._rendered += len(requests)
+        self._requests += len(jobs)
+
+    def _render(self, renderer: Renderer, request: tuple) -> np.ndarray:
+        name, position, rotation, fovy, focus, resolution, mode, shot, _ = request
+        shots = self._light_fields.get(name)
+        if shots is None:
+            raise RenderError(f"Unknown light field {name}", status=404)
+        vcam = Camera(
+            field_of_view_degrees=fovy,
+            ratio=resolution[0] / resolution[1],
+            position=position,
+            quaternion=rotation,
+        )
+        if mode == "project":
+            if not 0 <= shot < len(shots):
+                raise RenderError(f"Shot {shot} is not in [0, {len(shots)})")
+            # a one-shot collection, bound like a Shot
+            return renderer.project_multiple_shots(
+                shots[shot], vcam, focus, resolution
+            )[0]
+        return renderer.integrate(shots, vcam, focus, resolution, method=mode)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "alfr-render"
+    protocol_version = "HTTP/1.1"  # keep-alive connections
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/light_fields":
+            self._send_json(service.light_fields())
+        elif self.path == "/info":
+            self._send_json(service.info())
+        else:
+            self._send_json({"error": f"Unknown path {self.path}"}, 404)
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+            if self.path == "/render":
+                request = parse_render_request(body, self.server.service.resolution)
+                img = self.server.service.submit(request).result()
+                data, content_type = encode_image(img, request[-1])
+                self._send(data, content_type)
+            elif self.path == "/load":
+                if "name" not in body or "path" not in body:
+                    raise RenderError("Loading needs a name and a path")
+                fovy = body.get("fovy")
+                info = self.server.service.load(
+                    str(body["name"]),
+                    str(body["path"]),
+                    None if fovy is None else float(fovy),
+                ).result()
+                self._send_json(info)
+            else:
+                raise RenderError(f"Unknown path {self.path}", status=404)
+        except RenderError as e:
+            self._send_json({"error": str(e)}, e.status)
+        except Exception as e:
+            self._send_json({"error": f"{type(e).__name__}: {e}"}, 500)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            raise RenderError(f"Invalid json: {e}")
+        if not isinstance(body, dict):
+            raise RenderError("The request body must be a json object")
+        return body
+
+    def _send_json(self, obj, status: int = 200):
+        self._send(json.dumps(obj).encode(), "application/json", status)
+
+    def _send(self, data: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class RenderServer(ThreadingHTTPServer):
+    """HTTP server answering render requests with a `RenderService`.
+
+    Example:
+        server = RenderServer({"scene": "poses.json"})
+        server.serve_forever()
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        light_fields: Dict[str, str] = None,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        resolution: tuple = (512, 512),
+        max_batch_size: int = MAX_BATCH_SIZE,
+        cache: ResultCache = None,
+        verbose: bool = False,
+    ):
+        """
+        Args:
+            light_fields (dict): names and pose files of the light fields loaded
+                at the start
+            host (str): the address to listen on, local only by default
+            port (int): the port to listen on (0 picks a free one)
+            resolution (tuple): the default resolution of the images
+            max_batch_size (int): the most requests rendered as one batch
+            cache (ResultCache): cache of the rendered images
+            verbose (bool): whether to log every request
+        """
+        self.verbose = verbose
+        self.service = RenderService(resolution, max_batch_size, cache)
+        try:
+            for name, path in (light_fields or {}).items():
+                self.service.load(name, path).result()
+            super().__init__((host, port), _RequestHandler)
+        except Exception:
+            self.service.close()
+            raise
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def server_close(self):
+        super().server_close()
+        self.service.close()
+
+
+def render_remote(url: str, light_field: str, **request) -> np.ndarray:
+    """Render with a running server, the image is returned raw (float32).
+
+    Args:
+        url (str): the url of the server, e.g. "http://127.0.0.1:8765"
+        light_field (str): the name of the light field
+        request: further fields of the request (position, rotation, fovy,
+            focus, resolution, mode, shot)
+
+    Returns:
+        np.ndarray: the rendered image (opencv layout)
+    """
+    body = dict(request, light_field=light_field, format="raw")
+    for key, value in body.items():
+        if isinstance(value, np.ndarray):
+            body[key] = value.tolist()
+    req = urllib.request.Request(
+        url.rstrip("/") + "/render",
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as response:
+        return np.load(io.BytesIO(response.read()))
+
+
+def _light_field_arg(value: str) -> tuple:
+    name, sep, path = value.partition("=")
+    if not sep or not name or not path:
+        raise argparse.ArgumentTypeError("use name=pose_file")
+    return name, path
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m alfr.server", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument(
+        "-l",
+        "--light-field",
+        type=_light_field_arg,
+        action="append",
+        default=[],
+        metavar="NAME=POSE_FILE",
+        help="light field loaded at the start (json, npz or csv)",
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        nargs=2,
+        default=(512, 512),
+        metavar=("WIDTH", "HEIGHT"),
+        help="default resolution of the images",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=MAX_BATCH_SIZE,
+        help="most requests rendered as one batch",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=0,
+        help="memory of the result cache in MiB (0 disables it)",
+    )
+    parser.add_argument("--cache-dir", help="directory of the disk tier of the cache")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log requests")
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache_mb > 0 or args.cache_dir:
+        cache = ResultCache(args.cache_mb << 20, args.cache_dir)
+    server = RenderServer(
+        dict(args.light_field),
+        args.host,
+        args.port,
+        tuple(args.resolution),
+        args.max_batch_size,
+        cache,
+        args.verbose,
+    )
+    for name, info in server.service.light_fields().items():
+        print(f"{name}: {info['shots']} shots from {info['path']}")
+    print(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
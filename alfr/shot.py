@@ -1,12 +1,40 @@
 import numpy as np
-import cv2
 import moderngl
 from alfr.globals import ContextManager
-from alfr.camera import Camera
+from alfr.camera import Camera, view_matrices, projection_matrices
+from alfr.profiling import trace_span
 from pyrr import Matrix44, Matrix33, Quaternion, Vector3, vector
+import collections
 import json
 import os
-from typing import Union
+from typing import Dict, Iterable, List, Sequence, Union
+
+# Lens distortion models applied by the renderer when sampling a shot; the index
+# is the code used in the shader:
+#   none: ideal pinhole camera
+#   opencv: radial-tangential distortion with coefficients (k1, k2, p1, p2)
+#   fisheye: equidistant fisheye distortion with coefficients (k1, k2, k3, k4)
+DISTORTION_MODELS = ("none", "opencv", "fisheye")
+
+# Memory held by shots (see `memory_usage`) or a renderer (`Renderer.memory_usage`)
+#   host_bytes: numpy arrays on the host (images of shots, read back images)
+#   texture_bytes: shot textures
+#   framebuffer_bytes: render targets and depth buffers
+#   buffer_bytes: vertex and index buffers
+#   by_format: bytes of the textures and render targets per format, e.g. "f1x3"
+#       for 8-bit textures with 3 components
+MemoryUsage = collections.namedtuple(
+    "MemoryUsage",
+    ["host_bytes", "texture_bytes", "framebuffer_bytes", "buffer_bytes", "by_format"],
+)
+
+
+def _distortion_code(model: str) -> int:
+    if model not in DISTORTION_MODELS:
+        raise ValueError(
+            f"Unknown distortion model {model}, use one of {DISTORTION_MODELS}"
+        )
+    return DISTORTION_MODELS.index(model)
 
 
 class Shot(Camera):
@@ -19,7 +47,10 @@ class Shot(Camera):
         shot_rotation: Quaternion,
         shot_fovy_degrees: float = 60.0,
         shot_aspect_ratio: float = 1.0,
-        ctx: moderngl.Context = ContextManager.get_default_context(),
+        ctx: moderngl.Context = None,
+        distortion_model: str = "none",
+        distortion: Sequence[float] = (0.0, 0.0, 0.0, 0.0),
+        weight: float = 1.0,
     ):
         super().__init__(
             field_of_view_degrees=shot_fovy_degrees,
@@ -28,28 +59,52 @@ class Shot(Camera):
             quaternion=shot_rotation,
         )
 
-        # global g.ctx
+        # the default context is created on first use, not at import
         if ctx is None:
-            raise RuntimeError("No OpenGL context available!")
+            ctx = ContextManager.get_default_context()
 
         # one perspective of the light field
         # self.texture = window.load_texture_2d(shot_filename)
         self._filename = None
         if isinstance(shot_filename, str):
-            img = self._load_image(shot_filename)
+            with trace_span("decode", "shot", file=shot_filename) as span:
+                img = self._load_image(shot_filename)
+                span.set(bytes=img.nbytes)
             self._filename = shot_filename
         elif isinstance(shot_filename, np.ndarray):
             img = shot_filename
         else:
             raise Exception("Unknown type for {shot_filename}")
-        self.texture = ctx.texture(img.shape[1::-1], img.shape[2], img)
+        with trace_span(
+            "upload", "shot", file=self._filename, size=img.shape, bytes=img.nbytes
+        ):
+            self.texture = ctx.texture(img.shape[1::-1], img.shape[2], img)
         self._img = img  # opencv image
 
+        # lens distortion of the image, corrected in the shader when projecting
+        self._distortion_code = _distortion_code(distortion_model)
+        self._distortion = np.zeros(4, dtype="f4")
+        self._distortion[:] = distortion
+        # quality of the shot, scales its contribution to weighted integrals
+        self.weight = weight
+
     @property
     def image_file(self):
         return self._filename
 
+    @property
+    def distortion_model(self) -> str:
+        """The lens distortion model of the image (see `DISTORTION_MODELS`)."""
+        return DISTORTION_MODELS[self._distortion_code]
+
+    @property
+    def distortion(self) -> np.ndarray:
+        """The 4 distortion coefficients of the image."""
+        return self._distortion
+
     def _load_image(self, texture_filename) -> np.ndarray:
+        import cv2  # imported on first use, it is slow to import
+
         img = cv2.imread(texture_filename)
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # convert to RGB, opencv uses BGR
         img = np.flip(img, 0).copy(order="C")  # flip image vertically
@@ -62,5 +117,347 @@ class Shot(Camera):
         self.texture.use(0)
 
         # get uniforms from shader program and set them
-        renderer.program["m_shot_proj"].write(self.projection_matrix.astype("f4"))
-        renderer.program["m_shot_cam"].write(self.view_matrix.astype("f4"))
+        renderer.program["m_shot_proj"].write(self.projection_matrix_f4)
+        renderer.program["m_shot_cam"].write(self.view_matrix_f4)
+        renderer.program["shot_distortion_model"].value = self._distortion_code
+        renderer.program["shot_distortion"].write(self._distortion)
+
+
+class ShotCollection:
+    """Many perspectives of the light field stored as contiguous arrays.
+
+    Poses are kept as Nx3 positions, Nx4 quaternions (x,y,z,w) and N fields of view
+    and aspect ratios, so view and projection matrices of all shots are computed in
+    one vectorized call. Lens distortions are given as N model codes (indices into
+    `DISTORTION_MODELS`) and Nx4 coefficients, the quality of the shots as N
+    weights. Indexing with an int, slice, index array or boolean mask returns a
+    new collection sharing the textures.
+    """
+
+    def __init__(
+        self,
+        positions: np.ndarray,
+        quaternions: np.ndarray,
+        textures: Sequence[moderngl.Texture],
+        fovy_degrees: Union[float, np.ndarray] = 60.0,
+        aspect_ratios: Union[float, np.ndarray] = 1.0,
+        image_files: Sequence[str] = None,
+        z_near: float = 0.1,
+        z_far: float = 10000,
+        distortion_models: Union[int, np.ndarray] = 0,
+        distortions: np.ndarray = None,
+        weights: Union[float, np.ndarray] = 1.0,
+    ):
+        self._positions = self._readonly(np.asarray(positions, dtype=np.float64))
+        n = len(self._positions)
+        self._quaternions = self._readonly(np.asarray(quaternions, dtype=np.float64))
+        self._fovy = self._readonly(np.broadcast_to(fovy_degrees, (n,)).astype(float))
+        self._ratios = self._readonly(
+            np.broadcast_to(aspect_ratios, (n,)).astype(float)
+        )
+        self._textures = np.empty(n, dtype=object)
+        self._textures[:] = list(textures)
+        self._image_files = np.empty(n, dtype=object)
+        if image_files is not None:
+            self._image_files[:] = list(image_files)
+        self._z_near = z_near
+        self._z_far = z_far
+        self._distortion_models = self._readonly(
+            np.broadcast_to(distortion_models, (n,)).astype(np.int32)
+        )
+        self._distortions = self._readonly(
+            np.zeros((n, 4), dtype="f4")
+            if distortions is None
+            else np.asarray(distortions, dtype="f4")
+        )
+
+        if self._positions.shape != (n, 3) or self._quaternions.shape != (n, 4):
+            raise ValueError("positions must be Nx3 and quaternions Nx4 arrays!")
+        self._weights = self._readonly(np.broadcast_to(weights, (n,)).astype(float))
+        if self._distortions.shape != (n, 4):
+            raise ValueError("distortions must be a Nx4 array!")
+
+        # cached float32 matrices of all shots
+        self._view_matrices = None
+        self._projection_matrices = None
+
+    @classmethod
+    def from_shots(cls, shots: List[Shot]) -> "ShotCollection":
+        """Create a collection from individual shots (sharing their textures)."""
+        return cls(
+            np.array([shot.position for shot in shots]).reshape(-1, 3),
+            np.array([shot.rotation for shot in shots]).reshape(-1, 4),
+            [shot.texture for shot in shots],
+            [shot.fov_degree for shot in shots],
+            [shot.aspect_ratio for shot in shots],
+            [shot.image_file for shot in shots],
+            z_near=shots[0]._z_near if shots else 0.1,
+            z_far=shots[0]._z_far if shots else 10000,
+            distortion_models=[shot._distortion_code for shot in shots],
+            distortions=np.array([shot.distortion for shot in shots]).reshape(-1, 4),
+            weights=[shot.weight for shot in shots],
+        )
+
+    @staticmethod
+    def _readonly(a: np.ndarray) -> np.ndarray:
+        a = np.array(a)  # copy, the matrices are cached
+        a.setflags(write=False)
+        return a
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __getitem__(self, index) -> "ShotCollection":
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        subset = ShotCollection(
+            self._positions[index],
+            self._quaternions[index],
+            self._textures[index],
+            self._fovy[index],
+            self._ratios[index],
+            self._image_files[index],
+            z_near=self._z_near,
+            z_far=self._z_far,
+            distortion_models=self._distortion_models[index],
+            distortions=self._distortions[index],
+            weights=self._weights[index],
+        )
+        if self._view_matrices is not None:
+            subset._view_matrices = self._view_matrices[index]
+        if self._projection_matrices is not None:
+            subset._projection_matrices = self._projection_matrices[index]
+        return subset
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions
+
+    @property
+    def quaternions(self) -> np.ndarray:
+        return self._quaternions
+
+    @property
+    def fov_degrees(self) -> np.ndarray:
+        return self._fovy
+
+    @property
+    def aspect_ratios(self) -> np.ndarray:
+        return self._ratios
+
+    @property
+    def textures(self) -> np.ndarray:
+        return self._textures
+
+    @property
+    def image_files(self) -> np.ndarray:
+        return self._image_files
+
+    @property
+    def distortion_models(self) -> np.ndarray:
+        """N lens distortion model codes (indices into `DISTORTION_MODELS`)."""
+        return self._distortion_models
+
+    @property
+    def distortions(self) -> np.ndarray:
+        """Nx4 float32 lens distortion coefficients."""
+        return self._distortions
+
+    @property
+    def weights(self) -> np.ndarray:
+        """N quality weights of the shots."""
+        return self._weights
+
+    @property
+    def view_matrices(self) -> np.ndarray:
+        """Nx4x4 float32 view matrices of all shots."""
+        if self._view_matrices is None:
+            self._view_matrices = self._readonly(
+                view_matrices(self._positions, self._quaternions).astype("f4")
+            )
+        return self._view_matrices
+
+    @property
+    def projection_matrices(self) -> np.ndarray:
+        """Nx4x4 float32 projection matrices of all shots."""
+        if self._projection_matrices is None:
+            self._projection_matrices = self._readonly(
+                projection_matrices(
+                    self._fovy, self._ratios, self._z_near, self._z_far
+                ).astype("f4")
+            )
+        return self._projection_matrices
+
+    def use(self, index: int, renderer):
+        """
+        Use the perspective with the given index of the light field.
+        """
+        self._textures[index].use(0)
+
+        renderer.program["m_shot_proj"].write(self.projection_matrices[index])
+        renderer.program["m_shot_cam"].write(self.view_matrices[index])
+        renderer.program["shot_distortion_model"].value = int(
+            self._distortion_models[index]
+        )
+        renderer.program["shot_distortion"].write(self._distortions[index])
+
+
+def _view_directions(shots: Union[List[Shot], ShotCollection]) -> np.ndarray:
+    """Nx3 viewing directions of the shots (the -z axis of their views)."""
+    if isinstance(shots, ShotCollection):
+        views = shots.view_matrices
+    else:
+        views = np.array([shot.view_matrix_f4 for shot in shots]).reshape(-1, 4, 4)
+    return -views[:, :3, 2].astype(np.float64)
+
+
+def _positions(shots: Union[List[Shot], ShotCollection]) -> np.ndarray:
+    if isinstance(shots, ShotCollection):
+        return shots.positions
+    return np.array([shot.position for shot in shots], dtype=np.float64).reshape(-1, 3)
+
+
+def view_angle_weights(
+    shots: Union[List[Shot], ShotCollection], vcam: Camera, power: float = 1.0
+) -> np.ndarray:
+    """Weights of the shots by the angle between their and the virtual view.
+
+    Args:
+        shots (List[Shot] or ShotCollection): the shots
+        vcam (Camera): the virtual camera
+        power (float): the exponent of the cosine, larger values prefer shots
+            looking more closely in the direction of the virtual camera
+
+    Returns:
+        np.ndarray: cos(angle)^power for each shot, zero beyond 90 degrees
+    """
+    directions = _view_directions(shots)
+    vcam_direction = _view_directions([vcam])[0]
+    cosines = (
+        directions
+        @ vcam_direction
+        / np.maximum(
+            np.linalg.norm(directions, axis=1) * np.linalg.norm(vcam_direction), 1e-12
+        )
+    )
+    return np.maximum(cosines, 0.0) ** power
+
+
+def distance_weights(
+    shots: Union[List[Shot], ShotCollection], vcam: Camera, scale: float = 1.0
+) -> np.ndarray:
+    """Weights of the shots by their distance to the virtual camera.
+
+    Args:
+        shots (List[Shot] or ShotCollection): the shots
+        vcam (Camera): the virtual camera
+        scale (float): the distance at which the weight is halved
+
+    Returns:
+        np.ndarray: 1 / (1 + (distance / scale)^2) for each shot
+    """
+    distances = np.linalg.norm(
+        _positions(shots) - np.asarray(vcam.position, dtype=np.float64), axis=1
+    )
+    return 1.0 / (1.0 + (distances / scale) ** 2)
+
+
+def _texture_format(texture: Union[moderngl.Texture, moderngl.Renderbuffer]) -> str:
+    """The format of a texture, e.g. "f1x3" (dtype x components)."""
+    if texture.depth:
+        return "depth"
+    return f"{texture.dtype}x{texture.components}"
+
+
+def texture_bytes(texture: Union[moderngl.Texture, moderngl.Renderbuffer]) -> int:
+    """The bytes of a texture or renderbuffer (without mipmaps).
+
+    Depth buffers are counted with 4 bytes per pixel.
+    """
+    if texture.depth:
+        return texture.width * texture.height * 4
+    # the dtype ends with the bytes per component ("f1", "f4", "u2", ...)
+    return texture.width * texture.height * texture.components * int(texture.dtype[1:])
+
+
+def _add_textures(
+    by_format: Dict[str, int],
+    textures: Iterable[Union[moderngl.Texture, moderngl.Renderbuffer]],
+) -> int:
+    """Add the bytes of the textures by format, shared textures are counted once.
+
+    Returns:
+        int: the bytes of the textures
+    """
+    total, seen = 0, set()
+    for texture in textures:
+        if texture is None:
+            continue
+        # textures and renderbuffers have separate names (glo)
+        key = (type(texture), texture.glo)
+        if key in seen:
+            continue
+        seen.add(key)
+        size = texture_bytes(texture)
+        fmt = _texture_format(texture)
+        by_format[fmt] = by_format.get(fmt, 0) + size
+        total += size
+    return total
+
+
+def memory_usage(shots: Union[List[Shot], ShotCollection]) -> MemoryUsage:
+    """The memory held by the shots.
+
+    For a list of shots the host bytes are their images, for a collection its
+    pose arrays. Textures shared by several shots are counted once.
+
+    Args:
+        shots (List[Shot] or ShotCollection): the shots
+
+    Returns:
+        MemoryUsage: the host and texture bytes
+    """
+    by_format = {}
+    if isinstance(shots, ShotCollection):
+        textures = shots.textures
+        host = sum(
+            a.nbytes
+            for a in (
+                shots._positions,
+                shots._quaternions,
+                shots._fovy,
+                shots._ratios,
+                shots._distortion_models,
+                shots._distortions,
+                shots._weights,
+                shots._view_matrices,
+                shots._projection_matrices,
+            )
+            if a is not None
+        )
+    else:
+        textures = [shot.texture for shot in shots]
+        host = sum(shot._img.nbytes for shot in shots)
+    return MemoryUsage(host, _add_textures(by_format, textures), 0, 0, by_format)
+
+
+def estimate_memory_usage(
+    n: int, resolution: tuple, channels: int = 3, bytes_per_channel: int = 1
+) -> MemoryUsage:
+    """The memory n loaded shots of the given image size will use.
+
+    Use it to check a budget before loading shots; the images are kept on the
+    host (`Shot._img`) and uploaded as textures of the same size.
+
+    Args:
+        n (int): number of shots
+        resolution (tuple): width and height of the images
+        channels (int): number of channels of the images
+        bytes_per_channel (int): 1 for 8-bit images
+
+    Returns:
+        MemoryUsage: the host and texture bytes
+    """
+    size = n * resolution[0] * resolution[1] * channels * bytes_per_channel
+    fmt = f"f{bytes_per_channel}x{channels}"
+    return MemoryUsage(size, size, 0, 0, {fmt: size} if n > 0 else {})
@@ -0,0 +1,388 @@
+"""
+    Focal surfaces the shots are projected onto.
+    A surface is a triangle mesh kept in GPU buffers. It is split into tiles with
+    several levels of detail; per virtual camera only the tiles inside its frustum
+    are drawn, each at the coarsest level whose error stays below `lod_pixels`.
+"""
+import numpy as np
+import moderngl
+from alfr.globals import ContextManager
+from alfr.camera import Camera
+from typing import List, Sequence, Tuple
+
+# corners of the unit cube, used to get the 8 corners of the tile bounding boxes
+_BOX_CORNERS = np.array(
+    [[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64
+)
+
+
+def _grid_samples(n: int, step: int) -> np.ndarray:
+    """Every step-th index of n samples, always including the last one."""
+    samples = np.arange(0, n, step)
+    if samples[-1] != n - 1:
+        samples = np.append(samples, n - 1)
+    return samples
+
+
+def _grid_faces(rows: np.ndarray, cols: np.ndarray, num_cols: int) -> np.ndarray:
+    """Two triangles per cell of the grid spanned by the given rows and columns."""
+    r0, c0 = np.meshgrid(rows[:-1], cols[:-1], indexing="ij")
+    r1, c1 = np.meshgrid(rows[1:], cols[1:], indexing="ij")
+    a, b = r0 * num_cols + c0, r0 * num_cols + c1
+    c, d = r1 * num_cols + c0, r1 * num_cols + c1
+    return np.concatenate(
+        [np.stack([a, b, c], -1).reshape(-1, 3), np.stack([b, d, c], -1).reshape(-1, 3)]
+    )
+
+
+def _cell_coordinates(n: int, samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Cell and position within the cell (0..1) of n indices on a coarse grid."""
+    indices = np.arange(n)
+    cells = np.clip(np.searchsorted(samples, indices, "right") - 1, 0, len(samples) - 2)
+    t = (indices - samples[cells]) / (samples[cells + 1] - samples[cells])
+    return cells, t
+
+
+def _grid_errors(heights: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Height difference of all grid vertices to the triangles of a coarse grid."""
+    if len(rows) < 2 or len(cols) < 2:
+        return np.zeros(heights.size)
+    i, v = _cell_coordinates(heights.shape[0], rows)
+    j, u = _cell_coordinates(heights.shape[1], cols)
+    i, v, j, u = i[:, np.newaxis], v[:, np.newaxis], j[np.newaxis], u[np.newaxis]
+    h00 = heights[rows[i], cols[j]]
+    h10 = heights[rows[i], cols[j + 1]]
+    h01 = heights[rows[i + 1], cols[j]]
+    h11 = heights[rows[i + 1], cols[j + 1]]
+    # the same triangles as _grid_faces: (00, 10, 01) and (10, 11, 01)
+    interpolated = np.where(
+        u + v <= 1.0,
+        h00 + u * (h10 - h00) + v * (h01 - h00),
+        h11 + (1.0 - u) * (h01 - h11) + (1.0 - v) * (h10 - h11),
+    )
+    return np.abs(heights - interpolated).ravel()
+
+
+def _cluster_vertices(
+    vertices: np.ndarray, faces: np.ndarray, cell_size: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Simplify a mesh by merging all vertices in a cell of a regular 3D grid.
+
+    Returns:
+        tuple: the faces of the simplified mesh (using the first vertex of each
+            cell) and the distance of every vertex to the vertex replacing it
+    """
+    keys = np.floor(vertices / cell_size).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    representative = first[inverse.ravel()]
+    faces = representative[faces]
+
+    # remove collapsed and duplicated triangles
+    faces = faces[
+        (faces[:, 0] != faces[:, 1])
+        & (faces[:, 1] != faces[:, 2])
+        & (faces[:, 0] != faces[:, 2])
+    ]
+    _, unique = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(unique)]
+
+    errors = np.linalg.norm(vertices - vertices[representative], axis=1)
+    return faces, errors
+
+
+class FocalSurface:
+    """A non-planar focal surface given as a triangle mesh.
+
+    The mesh is simplified into `levels` levels of detail by vertex clustering,
+    each level doubling the cell size. Use `from_height_grid` for digital
+    elevation models, which are simplified by subsampling the grid instead.
+    """
+
+    def __init__(
+        self,
+        vertices: np.ndarray,
+        faces: np.ndarray,
+        levels: int = 4,
+        tiles: int = 16,
+        lod_pixels: float = 1.0,
+        ctx: moderngl.Context = None,
+    ):
+        """
+        Args:
+            vertices (np.ndarray): Nx3 vertex positions in world coordinates
+            faces (np.ndarray): Mx3 vertex indices of the triangles
+            levels (int): the number of levels of detail
+            tiles (int): the number of tiles along x and y used for culling
+            lod_pixels (float): the maximum screen space error in pixels
+            ctx (moderngl.Context): the OpenGL context, defaults to the default
+                context (created on first use)
+        """
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+
+        edges = vertices[faces] - vertices[np.roll(faces, 1, axis=1)]
+        edge_length = np.median(np.linalg.norm(edges, axis=2)) if len(faces) else 1.0
+
+        lod_faces, lod_errors = [faces], [np.zeros(len(vertices))]
+        for level in range(1, levels):
+            level_faces, errors = _cluster_vertices(
+                vertices, faces, edge_length * 2**level
+            )
+            lod_faces.append(level_faces)
+            lod_errors.append(errors)
+
+        extent = np.ptp(vertices[:, :2], axis=0) if len(vertices) else np.ones(2)
+        self._setup(
+            vertices,
+            lod_faces,
+            lod_errors,
+            np.maximum(extent / tiles, np.finfo(np.float32).eps),
+            lod_pixels,
+            ctx,
+        )
+
+    @classmethod
+    def from_height_grid(
+        cls,
+        heights: np.ndarray,
+        origin: Sequence[float] = (0.0, 0.0),
+        spacing: Sequence[float] = (1.0, 1.0),
+        tile_size: int = 32,
+        lod_pixels: float = 1.0,
+        ctx: moderngl.Context = None,
+    ) -> "FocalSurface":
+        """Create a focal surface from a digital elevation grid.
+
+        The level of detail l uses every 2^l-th grid sample, down to one cell per
+        tile at the coarsest level.
+
+        Args:
+            heights (np.ndarray): the heights (z) of the grid, rows along y and
+                columns along x
+            origin (tuple): x and y of the first grid sample
+            spacing (tuple): distance of the grid samples along x and y
+            tile_size (int): the number of grid cells per tile side
+            lod_pixels (float): the maximum screen space error in pixels
+            ctx (moderngl.Context): the OpenGL context, defaults to the default
+                context (created on first use)
+
+        Returns:
+            FocalSurface: the focal surface
+        """
+        heights = np.asarray(heights, dtype=np.float64)
+        num_rows, num_cols = heights.shape
+        if num_rows < 2 or num_cols < 2:
+            raise ValueError("The height grid needs at least 2x2 samples!")
+
+        y, x = np.meshgrid(
+            origin[1] + spacing[1] * np.arange(num_rows),
+            origin[0] + spacing[0] * np.arange(num_cols),
+            indexing="ij",
+        )
+        vertices = np.stack([x, y, heights], -1).reshape(-1, 3)
+
+        lod_faces, lod_errors = [], []
+        for level in range(int(np.log2(max(tile_size, 1))) + 1):
+            rows = _grid_samples(num_rows, 2**level)
+            cols = _grid_samples(num_cols, 2**level)
+            lod_faces.append(_grid_faces(rows, cols, num_cols))
+            lod_errors.append(_grid_errors(heights, rows, cols))
+
+        surface = cls.__new__(cls)
+        surface._setup(
+            vertices,
+            lod_faces,
+            lod_errors,
+            np.abs(np.asarray(spacing, dtype=np.float64)) * tile_size,
+            lod_pixels,
+            ctx,
+        )
+        return surface
+
+    def _setup(
+        self,
+        vertices: np.ndarray,
+        lod_faces: List[np.ndarray],
+        lod_errors: List[np.ndarray],
+        tile_extent: np.ndarray,
+        lod_pixels: float,
+        ctx: moderngl.Context,
+    ):
+        """Sort the faces of all levels into tiles and upload them to the GPU.
+
+        Args:
+            vertices (np.ndarray): Nx3 vertex positions shared by all levels
+            lod_faces (list): Mx3 faces of every level of detail
+            lod_errors (list): N errors of every level, the distance of each vertex
+                to the simplified surface
+            tile_extent (np.ndarray): the size of a tile along x and y
+            lod_pixels (float): the maximum screen space error in pixels
+            ctx (moderngl.Context): the OpenGL context, defaults to the default
+                context (created on first use)
+        """
+        if ctx is None:
+            ctx = ContextManager.get_default_context()
+        self._ctx = ctx
+        self.lod_pixels = lod_pixels
+
+        # tiles of a regular xy grid, faces are assigned by their centroid
+        tile_origin = vertices[:, :2].min(axis=0) if len(vertices) else np.zeros(2)
+        tile_counts = np.maximum(
+            np.ceil(np.ptp(vertices[:, :2], axis=0) / tile_extent + 1e-9), 1
+        ).astype(np.int64)
+        num_tiles = int(np.prod(tile_counts))
+
+        bounds_min = np.full((num_tiles, 3), np.inf)
+        bounds_max = np.full((num_tiles, 3), -np.inf)
+        self._errors = np.zeros((len(lod_faces), num_tiles))
+        self._ranges = np.zeros((len(lod_faces), num_tiles, 2), dtype=np.int64)
+
+        def tiles_of(faces):
+            cell = (vertices[faces, :2].mean(axis=1) - tile_origin) // tile_extent
+            cell = np.clip(cell.astype(np.int64), 0, tile_counts - 1)
+            return cell[:, 1] * tile_counts[0] + cell[:, 0]
+
+        indices, first = [], 0
+        for level, faces in enumerate(lod_faces):
+            tile = tiles_of(faces)
+            order = np.argsort(tile, kind="stable")
+            faces, tile = faces[order], tile[order]
+            counts = 3 * np.bincount(tile, minlength=num_tiles)
+            self._ranges[level, :, 0] = first + np.cumsum(counts) - counts
+            self._ranges[level, :, 1] = counts
+            indices.append(faces.ravel())
+            first += counts.sum()
+
+            # the boxes of the tiles contain all their levels
+            for corner in range(3):
+                np.minimum.at(bounds_min, tile, vertices[faces[:, corner]])
+                np.maximum.at(bounds_max, tile, vertices[faces[:, corner]])
+
+        # the simplification error of a tile is the largest error of the vertices
+        # of its full resolution triangles
+        tile = tiles_of(lod_faces[0])
+        for level, errors in enumerate(lod_errors):
+            np.maximum.at(self._errors[level], tile, errors[lod_faces[0]].max(axis=1))
+
+        empty = ~np.isfinite(bounds_min[:, 0])
+        bounds_min[empty], bounds_max[empty] = 0.0, 0.0
+        self._bounds = np.stack([bounds_min, bounds_max], axis=1)
+        self._corners = (
+            bounds_min[:, np.newaxis]
+            + (bounds_max - bounds_min)[:, np.newaxis] * _BOX_CORNERS
+        )
+
+        self._vertex_buffer = ctx.buffer(vertices.astype("f4"))
+        self._lod_buffer = ctx.buffer(np.concatenate(indices).astype("u4"))
+        # indices of the selected tiles, copied from the lod buffer on the GPU
+        capacity = int(self._ranges[:, :, 1].max(axis=0).sum()) if num_tiles else 0
+        self._index_buffer = ctx.buffer(reserve=max(capacity, 1) * 4)
+        self._index_count = 0
+
+    def update(self, vcam: Camera, resolution: tuple, z_offset: float = 0.0) -> int:
+        """Select the tiles and levels of detail for the virtual camera.
+
+        Tiles outside the view frustum are culled, the remaining ones are copied
+        at their level of detail into `index_buffer`.
+
+        Args:
+            vcam (Camera): the virtual camera
+            resolution (tuple): the resolution of the rendered image
+            z_offset (float): the translation of the surface along z
+
+        Returns:
+            int: the number of indices to draw from `index_buffer`
+        """
+        if len(self._corners) == 0:
+            self._index_count = 0
+            return 0
+
+        # clip coordinates of the tile corners, same as in the vertex shader
+        view_proj = vcam.view_matrix_f4.astype(np.float64) @ vcam.projection_matrix_f4
+        corners = np.concatenate(
+            [self._corners, np.ones(self._corners.shape[:2] + (1,))], axis=2
+        )
+        corners[..., 2] += z_offset
+        clip = corners @ view_proj
+        x, y, z, w = clip[..., 0], clip[..., 1], clip[..., 2], clip[..., 3]
+        outside = (
+            (x < -w).all(1)
+            | (x > w).all(1)
+            | (y < -w).all(1)
+            | (y > w).all(1)
+            | (z < -w).all(1)
+            | (z > w).all(1)
+        )
+        visible = np.flatnonzero(~outside)
+
+        # screen space error of all levels at the distance of the tiles
+        position = np.asarray(vcam.position, dtype=np.float64) - [0.0, 0.0, z_offset]
+        bounds = self._bounds[visible]
+        delta = np.maximum(bounds[:, 0] - position, 0) + np.maximum(
+            position - bounds[:, 1], 0
+        )
+        distance = np.maximum(np.linalg.norm(delta, axis=1), vcam._z_near)
+        focal_pixels = resolution[1] / (2.0 * np.tan(np.radians(vcam.fov_degree) / 2))
+        accurate = self._errors[:, visible] * focal_pixels / distance <= self.lod_pixels
+        # the coarsest accurate level (level 0 is exact)
+        level = len(accurate) - 1 - np.argmax(accurate[::-1], axis=0)
+
+        ranges = self._ranges[level, visible]
+        ranges = ranges[ranges[:, 1] > 0]
+        # merge adjacent ranges, so they are copied at once
+        starts = np.flatnonzero(
+            np.r_[True, ranges[1:, 0] != ranges[:-1, 0] + ranges[:-1, 1]]
+        )
+        count = 0
+        for first, size in zip(
+            ranges[starts, 0].tolist(),
+            np.add.reduceat(ranges[:, 1], starts).tolist() if len(starts) else [],
+        ):
+            self._ctx.copy_buffer(
+                self._index_buffer,
+                self._lod_buffer,
+                size=size * 4,
+                read_offset=first * 4,
+                write_offset=count * 4,
+            )
+            count += size
+        self._index_count = count
+        return count
+
+    @property
+    def vertex_buffer(self) -> moderngl.Buffer:
+        """The vertex positions (3 floats per vertex)."""
+        return self._vertex_buffer
+
+    @property
+    def index_buffer(self) -> moderngl.Buffer:
+        """The indices selected by the last `update` (unsigned int)."""
+        return self._index_buffer
+
+    @property
+    def index_count(self) -> int:
+        """The number of indices selected by the last `update`."""
+        return self._index_count
+
+    @property
+    def levels(self) -> int:
+        """The number of levels of detail."""
+        return len(self._ranges)
+
+    @property
+    def num_tiles(self) -> int:
+        """The number of tiles used for culling."""
+        return len(self._bounds)
+
+    @property
+    def buffer_bytes(self) -> int:
+        """The bytes of the GPU buffers of the surface."""
+        return sum(
+            buffer.size
+            for buffer in (self._vertex_buffer, self._lod_buffer, self._index_buffer)
+        )
+
+    def release(self):
+        """Release the GPU buffers of the surface."""
+        for buffer in (self._vertex_buffer, self._lod_buffer, self._index_buffer):
+            buffer.release()
@@ -0,0 +1,236 @@
+"""
+    Procedural light fields of arbitrary size for scaling and soak tests.
+
+    The shots look along +z at a textured plane at `FOCAL_PLANE_Z`, so integrals
+    focused on it are sharp. The images are computed by intersecting
+    the pixel rays of each shot with the plane.
+"""
+import os
+import numpy as np
+import cv2
+import moderngl
+from alfr.camera import rotation_matrices
+from alfr.renderer import FOCAL_PLANE_Z
+from alfr.shot import Shot
+from alfr.utils import Poses, _no_distortion
+from typing import Iterator, List
+
+# Layouts of the shot positions:
+#   grid: a square grid of shots in the xy plane
+#   flight: lines of a serpentine flight path, every other line flown backwards
+#       (the shots are rotated by 180 degrees)
+LAYOUTS = ("grid", "flight")
+# rotation (x,y,z,w) of the shots, 180 degrees about y so they look along +z
+SYNTHETIC_ROTATION = (0.0, 1.0, 0.0, 0.0)
+
+
+def synthetic_poses(
+    n: int,
+    layout: str = "grid",
+    spacing: float = 0.2,
+    shots_per_line: int = None,
+    fovy: float = 60.0,
+    aspect_ratio: float = 1.0,
+) -> Poses:
+    """Poses of n shots looking at the plane at `FOCAL_PLANE_Z`.
+
+    Args:
+        n (int): number of shots
+        layout (str): one of `LAYOUTS`
+        spacing (float): distance between neighbouring shots
+        shots_per_line (int): shots per grid row or flight line, defaults to
+            about sqrt(n)
+        fovy (float): vertical field of view in degrees
+        aspect_ratio (float): aspect ratio of the shots (width / height)
+
+    Returns:
+        Poses: the poses, the files are named "000000.png", ...
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, use one of {LAYOUTS}")
+    if shots_per_line is None:
+        shots_per_line = max(1, int(np.ceil(np.sqrt(n))))
+
+    index = np.arange(n)
+    line, column = np.divmod(index, shots_per_line)
+    quaternions = np.zeros((n, 4))
+    quaternions[:] = SYNTHETIC_ROTATION
+    if layout == "flight":
+        backwards = line % 2 == 1
+        column = np.where(backwards, shots_per_line - 1 - column, column)
+        # additionally rotated by 180 degrees about z
+        quaternions[backwards] = [1.0, 0.0, 0.0, 0.0]
+
+    positions = np.zeros((n, 3))
+    positions[:, 0] = (column - (shots_per_line - 1) / 2) * spacing
+    positions[:, 1] = (line - (line.max(initial=0)) / 2) * spacing
+    return Poses(
+        np.array([f"{i:06d}.png" for i in index], dtype=str),
+        positions,
+        quaternions,
+        np.full(n, fovy, dtype=np.float64),
+        np.full(n, aspect_ratio, dtype=np.float64),
+        *_no_distortion(n),
+    )
+
+
+def _plane_texture(x: np.ndarray, y: np.ndarray, channels: int) -> np.ndarray:
+    """Colors of the plane at x, y: a checkerboard with smooth color bands."""
+    checker = (np.floor(x) + np.floor(y)) % 2
+    phases = np.arange(channels) * 2.0 * np.pi / max(channels, 1)
+    bands = 0.5 + 0.5 * np.sin(
+        0.7 * x[..., np.newaxis] + 0.3 * y[..., np.newaxis] + phases
+    )
+    img = 0.25 + 0.5 * checker[..., np.newaxis] + 0.25 * (2.0 * bands - 1.0)
+    if channels == 4:
+        img[..., 3] = 1.0  # opaque
+    return np.clip(img * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+def synthetic_image(
+    position: np.ndarray,
+    quaternion: np.ndarray,
+    resolution: tuple = (64, 64),
+    channels: int = 3,
+    fovy: float = 60.0,
+    depth: float = FOCAL_PLANE_Z,
+) -> np.ndarray:
+    """The image of the textured plane at depth seen by a shot.
+
+    Args:
+        position (np.ndarray): position of the shot
+        quaternion (np.ndarray): rotation of the shot (x,y,z,w)
+        resolution (tuple): width and height of the image
+        channels (int): number of channels (1 to 4)
+        fovy (float): vertical field of view in degrees
+        depth (float): the depth (z) of the plane
+
+    Returns:
+        np.ndarray: HxWxC uint8 image, RGB(A) and flipped vertically (as
+            `Shot._load_image`)
+    """
+    if not 1 <= channels <= 4:
+        raise ValueError("channels must be in [1, 4]!")
+    width, height = resolution
+    tan_y = np.tan(np.radians(fovy) / 2.0)
+    # normalized device coordinates of the pixel centers, row 0 is the bottom
+    ndc_x = (np.arange(width) + 0.5) / width * 2.0 - 1.0
+    ndc_y = (np.arange(height) + 0.5) / height * 2.0 - 1.0
+    rays = np.empty((height, width, 3))
+    rays[..., 0] = ndc_x[np.newaxis, :] * tan_y * width / height
+    rays[..., 1] = ndc_y[:, np.newaxis] * tan_y
+    rays[..., 2] = -1.0
+    # camera to world, the view matrix maps (p - position) @ R to the camera
+    R = rotation_matrices(np.asarray(quaternion, dtype=np.float64)[np.newaxis])[0]
+    rays = rays @ R.T
+    # the projection maps the whole line, so the plane may also be behind the shot
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (depth - position[2]) / rays[..., 2]
+    x = position[0] + t * rays[..., 0]
+    y = position[1] + t * rays[..., 1]
+    img = _plane_texture(np.nan_to_num(x), np.nan_to_num(y), channels)
+    img[~np.isfinite(t)] = 0
+    return img
+
+
+def iter_synthetic_images(
+    poses: Poses,
+    resolution: tuple = (64, 64),
+    channels: int = 3,
+    depth: float = FOCAL_PLANE_Z,
+) -> Iterator[np.ndarray]:
+    """Yield the images of the poses one by one (see `synthetic_image`)."""
+    for pos, rot, fov in zip(poses.positions, poses.quaternions, poses.fovy):
+        yield synthetic_image(pos, rot, resolution, channels, fov, depth)
+
+
+def synthetic_shots(
+    n: int,
+    resolution: tuple = (64, 64),
+    channels: int = 3,
+    layout: str = "grid",
+    spacing: float = 0.2,
+    depth: float = FOCAL_PLANE_Z,
+    ctx: moderngl.Context = None,
+) -> List[Shot]:
+    """Create a synthetic light field of n in-memory shots.
+
+    Args:
+        n (int): number of shots
+        resolution (tuple): width and height of the images
+        channels (int): number of channels of the images (1 to 4)
+        layout (str): one of `LAYOUTS`
+        spacing (float): distance between neighbouring shots
+        depth (float): the depth (z) of the textured plane
+
+    Returns:
+        List[Shot]: the shots
+    """
+    poses = synthetic_poses(
+        n, layout, spacing, aspect_ratio=resolution[0] / resolution[1]
+    )
+    return [
+        Shot(
+            img,
+            pos,
+            rot,
+            fov,
+            shot_aspect_ratio=aspect_ratio,
+            ctx=ctx,
+        )
+        for img, pos, rot, fov, aspect_ratio in zip(
+            iter_synthetic_images(poses, resolution, channels, depth),
+            poses.positions,
+            poses.quaternions,
+            poses.fovy,
+            poses.aspect_ratios,
+        )
+    ]
+
+
+def write_synthetic_light_field(
+    directory: str,
+    n: int,
+    resolution: tuple = (64, 64),
+    channels: int = 3,
+    layout: str = "grid",
+    spacing: float = 0.2,
+    depth: float = FOCAL_PLANE_Z,
+) -> str:
+    """Write a synthetic light field of n shots to png files and a pose npz file.
+
+    The images are written one by one, so the host memory does not grow with n.
+    The shots are loaded with `load_shots_from_npz` (as RGB images).
+
+    Args:
+        directory (str): the output directory, created if missing
+        n (int): number of shots
+        resolution (tuple): width and height of the images
+        channels (int): number of channels of the images (1, 3 or 4)
+        layout (str): one of `LAYOUTS`
+        spacing (float): distance between neighbouring shots
+        depth (float): the depth (z) of the textured plane
+
+    Returns:
+        str: the path of the pose npz file
+    """
+    if channels == 2:
+        raise ValueError("png images need 1, 3 or 4 channels!")
+    os.makedirs(directory, exist_ok=True)
+    poses = synthetic_poses(
+        n, layout, spacing, aspect_ratio=resolution[0] / resolution[1]
+    )
+    for file, img in zip(
+        poses.files, iter_synthetic_images(poses, resolution, channels, depth)
+    ):
+        img = np.flip(img, 0)  # top-down rows as stored in image files
+        if channels >= 3:
+            img = cv2.cvtColor(
+                img, cv2.COLOR_RGB2BGR if channels == 3 else cv2.COLOR_RGBA2BGRA
+            )
+        cv2.imwrite(os.path.join(directory, file), img)
+
+    # the columnar format of `export_shots_to_npz`, it keeps the aspect ratios
+    npz_file = os.path.join(directory, "poses.npz")
+    np.savez(npz_file, **poses._asdict())
+    return npz_file
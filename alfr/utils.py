@@ -1,14 +1,22 @@
-from .thirdparty.read_write_model import (
-    read_model,
-)  # from https://github.com/colmap/colmap
+from .colmap import read_model  # fast version of the COLMAP reader
 import moderngl
-from alfr.globals import ContextManager
-from alfr.camera import Camera
-from alfr.shot import Shot
+from alfr.camera import (
+    Camera,
+    rotation_matrices,
+    quaternions_from_matrices,
+    rotate_vectors,
+)
+from alfr.shot import DISTORTION_MODELS, Shot, ShotCollection
+from alfr.profiling import trace_span, traced
 from pyrr import Matrix44, Matrix33, Quaternion, Vector3, vector
-from typing import List
+from typing import List, Union
+import collections
+import csv
+import hashlib
 import json
 import os
+import threading
+import zipfile
 import numpy as np
 
 
@@ -53,159 +61,663 @@ def export_shots_to_json(
         json.dump(data, f)
 
 
-def load_shots_from_json(
-    json_file: str,
-    fovy: float = 60.0,
-    ctx: moderngl.Context = ContextManager.get_default_context(),
-):
+class _JSONStream:
+    """Incremental reader of a JSON text, decoding one value at a time."""
+
+    def __init__(self, f, chunk_size: int):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Read the next chunk, returns False at the end of the file."""
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos :] + chunk
+        self._pos = 0
+        return not self._eof
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character ("" at the end)."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos : self._pos + 1]
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError(f"Expected one of '{chars}' but found '{c}' in JSON")
+        self._pos += 1
+        return c
+
+    def value(self):
+        """Decode the next value, reading more chunks until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the end of the buffer might continue in the next chunk,
+                # so the value is only complete if it is followed by a delimiter
+                if self._eof or (
+                    end < len(self._buf) and self._buf[end] in " \t\n\r,:]}"
+                ):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def iter_json_images(json_file: str, chunk_size: int = 1 << 16):
     """
-    Loads shots from a json file.
+    Yields the entries of the "images" array of a pose json file one by one,
+    without loading the whole file into memory.
     """
-    shots = []
     with open(json_file, "r") as f:
-        data = json.load(f)
+        stream = _JSONStream(f, chunk_size)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "images":
+                stream.expect("[")
+                if stream.peek() != "]":
+                    while True:
+                        yield stream.value()
+                        if stream.expect(",]") == "]":
+                            break
+                else:
+                    stream.expect("]")
+            else:
+                stream.value()  # skip other entries
+            if stream.expect(",}") == "}":
+                return
+
+
+def _batches(iterable, batch_size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Poses of all images of a light field as arrays:
+#   files (N image files), positions (Nx3), quaternions (Nx4, x,y,z,w),
+#   fovy (N, NaN if not given by the source), aspect_ratios (N),
+#   distortion_models (N indices into DISTORTION_MODELS) and distortions (Nx4)
+Poses = collections.namedtuple(
+    "Poses",
+    [
+        "files",
+        "positions",
+        "quaternions",
+        "fovy",
+        "aspect_ratios",
+        "distortion_models",
+        "distortions",
+    ],
+)
+
+POSE_CACHE_SUFFIX = ".poses.npz"
+POSE_CACHE_VERSION = 2
+
+
+def _no_distortion(n: int):
+    """distortion_models and distortions of n ideal pinhole images."""
+    return np.zeros(n, dtype=np.int32), np.zeros((n, 4))
+
+
+def _file_hash(file: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _read_pose_cache(cache_file: str, sources: List[str]):
+    """Read poses from the cache file if it is valid for the source files.
+
+    The cache is valid if every source has the recorded mtime and size, or
+    otherwise (e.g. after a copy or touch) the recorded hash.
+
+    Returns:
+        Poses: the cached poses or None if there is no valid cache
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            cache = dict(cache)
+
+        if int(cache.get("version", -1)) != POSE_CACHE_VERSION or list(
+            cache["sources"]
+        ) != [os.path.basename(source) for source in sources]:
+            return None
+        touched = False
+        for source, mtime, size, sha1 in zip(
+            sources, cache["mtimes"], cache["sizes"], cache["hashes"]
+        ):
+            stat = os.stat(source)
+            if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                if _file_hash(source) != sha1:
+                    return None
+                touched = True
+
+        poses = Poses(*(cache[field] for field in Poses._fields))
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        # e.g. a truncated or incomplete file, it is written again
+        return None
+    if touched:  # record the new mtimes, so the next load does not hash again
+        _write_pose_cache(cache_file, sources, poses)
+    return poses
+
+
+def _write_pose_cache(cache_file: str, sources: List[str], poses: Poses):
+    """Write the poses and the signatures of their source files to the cache."""
+    stats = [os.stat(source) for source in sources]
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            np.savez(
+                f,
+                version=POSE_CACHE_VERSION,
+                sources=np.array([os.path.basename(source) for source in sources]),
+                mtimes=np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64),
+                sizes=np.array([stat.st_size for stat in stats], dtype=np.int64),
+                hashes=np.array([_file_hash(source) for source in sources]),
+                **{
+                    field: np.asarray(value) for field, value in poses._asdict().items()
+                },
+            )
+        os.replace(tmp_file, cache_file)  # atomic, readers never see partial files
+    except OSError as e:
+        print(f"Could not write pose cache {cache_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _load_poses(
+    parse_poses, sources: List[str], cache_file: str, cache_poses: bool
+) -> Poses:
+    """Parse poses from the sources or, with cache_poses, reuse the pose cache."""
+    if cache_poses:
+        poses = _read_pose_cache(cache_file, sources)
+        if poses is not None:
+            return poses
+
+    with trace_span("parse_poses", "loader", sources=sources):
+        poses = parse_poses()
+    if cache_poses:
+        _write_pose_cache(cache_file, sources, poses)
+    return poses
+
+
+def _iter_shots_from_poses(
+    poses: Poses, image_dir: str, fovy: float, ctx: moderngl.Context
+):
+    """Create the shots for the given poses, fovy is used where no fov is given."""
+    for file, pos, rot, fov, aspect_ratio, model, distortion in zip(*poses):
+        yield Shot(
+            os.path.join(image_dir, file),
+            Vector3(pos),
+            Quaternion(rot),  # format x,y,z,w
+            fovy if np.isnan(fov) else fov,
+            shot_aspect_ratio=aspect_ratio,
+            ctx=ctx,
+            distortion_model=DISTORTION_MODELS[model],
+            distortion=distortion,
+        )
 
-        json_dir = os.path.dirname(os.path.realpath(f.name))
 
-        if "images" in data.keys():
-            for image in data["images"]:
-                file, pos, rot, fov = get_file_pos_rot(image)
-                shot = Shot(
-                    os.path.join(json_dir, file),
-                    Vector3(pos),
-                    Quaternion(rot),  # format x,y,z,w
-                    fov if fov is not None else fovy,
-                    shot_aspect_ratio=1.0,
-                    ctx=ctx,
-                )
-                shots.append(shot)
+def _shots_from_poses(
+    poses: Poses, image_dir: str, fovy: float, ctx: moderngl.Context
+) -> List[Shot]:
+    return list(_iter_shots_from_poses(poses, image_dir, fovy, ctx))
+
+
+def _json_poses(images) -> Poses:
+    """Poses of the given entries of the "images" array of a pose json file."""
+    files, positions, quaternions, fovs = [], [], [], []
+    for image in images:
+        file, pos, rot, fov = get_file_pos_rot(image)
+        files.append(file)
+        positions.append(pos)
+        quaternions.append(rot)
+        fovs.append(fov if fov is not None else np.nan)
+
+    return Poses(
+        np.array(files, dtype=str),
+        np.array(positions, dtype=np.float64).reshape(-1, 3),
+        np.array(quaternions, dtype=np.float64).reshape(-1, 4),
+        np.array(fovs, dtype=np.float64),
+        np.ones(len(files)),
+        *_no_distortion(len(files)),
+    )
+
+
+def _parse_json_poses(json_file: str) -> Poses:
+    return _json_poses(iter_json_images(json_file))
+
+
+def _poses_from_shots(
+    shots: Union[List[Shot], ShotCollection], export_dir: str
+) -> Poses:
+    """Poses of the shots, image files are relative to export_dir if possible."""
+    if isinstance(shots, ShotCollection):
+        files = shots.image_files
+        poses = Poses(
+            None,
+            shots.positions,
+            shots.quaternions,
+            shots.fov_degrees,
+            shots.aspect_ratios,
+            shots.distortion_models,
+            shots.distortions,
+        )
+    else:
+        files = [shot.image_file for shot in shots]
+        poses = Poses(
+            None,
+            np.array([shot.position for shot in shots], dtype=np.float64).reshape(
+                -1, 3
+            ),
+            np.array([shot.rotation for shot in shots], dtype=np.float64).reshape(
+                -1, 4
+            ),
+            np.array([shot.fov_degree for shot in shots], dtype=np.float64),
+            np.array([shot.aspect_ratio for shot in shots], dtype=np.float64),
+            np.array(
+                [DISTORTION_MODELS.index(shot.distortion_model) for shot in shots],
+                dtype=np.int32,
+            ),
+            np.array([shot.distortion for shot in shots]).reshape(-1, 4),
+        )
 
-    return shots
+    # relative paths are computed once per image directory
+    relative_dirs = {}
 
+    def relative(file):
+        if file is None:
+            return ""  # shot created from an image array
+        file_dir, name = os.path.split(os.path.abspath(file))
+        if file_dir not in relative_dirs:
+            try:
+                relative_dirs[file_dir] = os.path.relpath(file_dir, export_dir)
+            except ValueError:  # e.g. a different drive on windows
+                relative_dirs[file_dir] = file_dir
+        return os.path.join(relative_dirs[file_dir], name)
 
-def load_shots_from_legacy_json(
-    json_file: str,
-    fovy: float = 60.0,
-    ctx: moderngl.Context = ContextManager.get_default_context(),
-):
+    return poses._replace(files=np.array([relative(f) for f in files], dtype=str))
+
+
+def _export_dir(file: str) -> str:
+    return os.path.dirname(os.path.abspath(file))
+
+
+def _imported_files(poses: Poses, export_file: str) -> Poses:
+    """Resolve the relative image files of exported poses."""
+    export_dir = _export_dir(export_file)
+    return poses._replace(
+        files=np.array(
+            [os.path.normpath(os.path.join(export_dir, f)) for f in poses.files],
+            dtype=str,
+        )
+    )
+
+
+def export_shots_to_npz(shots: Union[List[Shot], ShotCollection], npz_file: str):
     """
-    Loads shots from a legacy json file.
+    Exports the poses of shots as columnar arrays (the fields of `Poses`)
+    to a numpy .npz file.
+    Image files are stored relative to the directory of the npz file.
     """
-    shots = []
-    with open(json_file, "r") as f:
-        data = json.load(f)
+    poses = _poses_from_shots(shots, _export_dir(npz_file))
+    np.savez(npz_file, **poses._asdict())
 
-        json_dir = os.path.dirname(os.path.realpath(f.name))
 
-        # m = Matrix33([[1.,0.,0.],[0.,1.,0.],[0.,0.,1.]])
-        flip_yz_matrix = Matrix33([[1, 0, 0], [0, -1, 0], [0, 0, -1]])
+def read_poses_from_npz(npz_file: str) -> Poses:
+    """
+    Reads the poses written by `export_shots_to_npz` (or a pose cache).
+    """
+    with np.load(npz_file, allow_pickle=False) as data:
+        data = dict(data)
+    if "distortion_models" not in data:  # exported without lens distortions
+        data["distortion_models"], data["distortions"] = _no_distortion(
+            len(data["files"])
+        )
+    return Poses(*(data[field] for field in Poses._fields))
 
-        if "images" in data.keys():
-            for image in data["images"]:
-                file = get_from_dict(image, ["imagefile", "file", "image"])
-                M_3x4: list = get_from_dict(image, ["M3x4"])
-                legacy_M3x4 = Matrix44(
-                    [M_3x4[0][:4], M_3x4[1][:4], M_3x4[2][:4], [0.0, 0.0, 0.0, 1.0]]
-                )
 
-                scale, rotate, translate = legacy_M3x4.T.decompose()
+@traced("loader")
+def load_shots_from_npz(
+    npz_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+):
+    """
+    Loads shots from a npz file written by `export_shots_to_npz`.
+    """
+    poses = _imported_files(read_poses_from_npz(npz_file), npz_file)
+    return _shots_from_poses(poses, "", fovy, ctx)
+
+
+CSV_HEADER = [
+    "imagefile",
+    "x",
+    "y",
+    "z",
+    "qx",
+    "qy",
+    "qz",
+    "qw",
+    "fovy",
+    "aspect",
+    "distortion",
+    "d0",
+    "d1",
+    "d2",
+    "d3",
+]
+
+
+def export_shots_to_csv(shots: Union[List[Shot], ShotCollection], csv_file: str):
+    """
+    Exports the poses of shots to a csv file with the columns `CSV_HEADER`.
+    Image files are stored relative to the directory of the csv file.
+    """
+    poses = _poses_from_shots(shots, _export_dir(csv_file))
+    values = np.column_stack(
+        [poses.positions, poses.quaternions, poses.fovy, poses.aspect_ratios]
+    )
+    models = [DISTORTION_MODELS[model] for model in poses.distortion_models]
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(
+            [file, *row, model, *distortion]
+            for file, row, model, distortion in zip(
+                poses.files.tolist(),
+                values.tolist(),
+                models,
+                poses.distortions.tolist(),
+            )
+        )
 
-                pos = -(rotate * translate)
 
-                # for some reason we need to modify the quaternion here.
-                # Colmap has a weird format???
-                qt = rotate
-                _q = Quaternion(np.hstack((qt.w, qt.z, -qt.y, qt.x)))
-                # Todo: verify why we need this!!
+def read_poses_from_csv(csv_file: str) -> Poses:
+    """
+    Reads the poses written by `export_shots_to_csv`.
+    """
+    with open(csv_file, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header != CSV_HEADER:
+            raise Exception(f"Unexpected csv header {header}, expected {CSV_HEADER}")
+        rows = list(reader)
+
+    files = np.array([row[0] for row in rows], dtype=str)
+    values = np.array([row[1:10] for row in rows], dtype=np.float64).reshape(-1, 9)
+    models = np.array(
+        [DISTORTION_MODELS.index(row[10]) for row in rows], dtype=np.int32
+    )
+    distortions = np.array([row[11:] for row in rows], dtype=np.float64)
+    return Poses(
+        files,
+        values[:, 0:3],
+        values[:, 3:7],
+        values[:, 7],
+        values[:, 8],
+        models,
+        distortions.reshape(-1, 4),
+    )
+
+
+@traced("loader")
+def load_shots_from_csv(
+    csv_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+):
+    """
+    Loads shots from a csv file written by `export_shots_to_csv`.
+    """
+    poses = _imported_files(read_poses_from_csv(csv_file), csv_file)
+    return _shots_from_poses(poses, "", fovy, ctx)
 
-                shot = Shot(
-                    os.path.join(json_dir, file),
-                    Vector3(pos),
-                    _q,
-                    fovy,
-                    shot_aspect_ratio=1.0,
-                    ctx=ctx,
-                )
-                shots.append(shot)
 
-    return shots
+@traced("loader")
+def load_shots_from_json(
+    json_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+    cache_poses: bool = False,
+):
+    """
+    Loads shots from a json file.
+    With cache_poses the parsed poses are stored next to the json file
+    (`POSE_CACHE_SUFFIX`) and reused as long as the json file is unchanged.
+    """
+    poses = _load_poses(
+        lambda: _parse_json_poses(json_file),
+        [json_file],
+        json_file + POSE_CACHE_SUFFIX,
+        cache_poses,
+    )
+    json_dir = os.path.dirname(os.path.realpath(json_file))
+    return _shots_from_poses(poses, json_dir, fovy, ctx)
+
+
+def _legacy_json_poses(images) -> Poses:
+    """Poses of the given entries of the "images" array of a legacy json file."""
+    files, M_3x4 = [], []
+    for image in images:
+        files.append(get_from_dict(image, ["imagefile", "file", "image"]))
+        M_3x4.append([row[:4] for row in get_from_dict(image, ["M3x4"])[:3]])
+    M_3x4 = np.array(M_3x4, dtype=np.float64).reshape(-1, 3, 4)
+
+    # decompose the transposed legacy matrices of all images at once
+    # (same as Matrix44.decompose() of legacy_M3x4.T)
+    rotate = M_3x4[:, :3, :3].transpose(0, 2, 1)
+    scale = np.linalg.norm(rotate, axis=2)
+    scale[np.linalg.det(rotate) < 0, 0] *= -1
+    rotate = quaternions_from_matrices(rotate / scale[:, :, np.newaxis])
+    translate = M_3x4[:, :, 3]
+
+    pos = -rotate_vectors(rotate, translate)
+
+    # for some reason we need to modify the quaternion here.
+    # Colmap has a weird format???
+    # (w, z, -y, x) of the decomposed rotation
+    _q = rotate[:, [3, 2, 1, 0]] * np.array([1.0, 1.0, -1.0, 1.0])
+    # Todo: verify why we need this!!
+
+    return Poses(
+        np.array(files, dtype=str),
+        pos,
+        _q,
+        np.full(len(files), np.nan),  # the legacy format has no field of view
+        np.ones(len(files)),
+        *_no_distortion(len(files)),
+    )
+
+
+def _parse_legacy_json_poses(json_file: str) -> Poses:
+    return _legacy_json_poses(iter_json_images(json_file))
+
+
+@traced("loader")
+def load_shots_from_legacy_json(
+    json_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+    cache_poses: bool = False,
+):
+    """
+    Loads shots from a legacy json file.
+    With cache_poses the parsed poses are stored next to the json file
+    (`POSE_CACHE_SUFFIX`) and reused as long as the json file is unchanged.
+    """
+    poses = _load_poses(
+        lambda: _parse_legacy_json_poses(json_file),
+        [json_file],
+        json_file + POSE_CACHE_SUFFIX,
+        cache_poses,
+    )
+    json_dir = os.path.dirname(os.path.realpath(json_file))
+    return _shots_from_poses(poses, json_dir, fovy, ctx)
 
 
-# Todo!!
-def load_shots_from_colmap(
-    model_folder: str,
-    image_folder: str,
-    fovy: float = None,
-    ctx: moderngl.Context = ContextManager.get_default_context(),
+def iter_shots_from_json(
+    json_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+    batch_size: int = 64,
 ):
     """
-    Loads shots from a colmap.
+    Yields shots from a json file while it is read, the pose file is never
+    loaded completely into memory. Poses are converted in batches of batch_size.
     """
+    json_dir = os.path.dirname(os.path.realpath(json_file))
+    for images in _batches(iter_json_images(json_file), batch_size):
+        yield from _iter_shots_from_poses(_json_poses(images), json_dir, fovy, ctx)
 
-    cameras, images, points3D = read_model(model_folder)  # read the colmap model
 
-    # Todo: finish this!
+def iter_shots_from_legacy_json(
+    json_file: str,
+    fovy: float = 60.0,
+    ctx: moderngl.Context = None,
+    batch_size: int = 64,
+):
+    """
+    Yields shots from a legacy json file while it is read, the pose file is never
+    loaded completely into memory. Poses are converted in batches of batch_size.
+    """
+    json_dir = os.path.dirname(os.path.realpath(json_file))
+    for images in _batches(iter_json_images(json_file), batch_size):
+        yield from _iter_shots_from_poses(
+            _legacy_json_poses(images), json_dir, fovy, ctx
+        )
 
-    shots = []
-    for img in images.values():
-        # look into https://github.com/colmap/colmap/blob/dev/scripts/python/visualize_model.py
-        # to see how to get the camera parameters
 
-        # rotation
-        q = Quaternion((img.qvec[1], img.qvec[2], img.qvec[3], img.qvec[0]))
-        # pyrr.Quaternion format is x,y,z,w while colmap uses w,x,y,z!!!
-        R = Matrix33.from_quaternion(q)
+# lens distortion of the COLMAP camera models:
+#   model: (distortion model, first distortion parameter)
+COLMAP_DISTORTIONS = {
+    "SIMPLE_PINHOLE": ("none", None),
+    "PINHOLE": ("none", None),
+    "SIMPLE_RADIAL": ("opencv", 3),  # k
+    "RADIAL": ("opencv", 3),  # k1, k2
+    "OPENCV": ("opencv", 4),  # k1, k2, p1, p2
+    "OPENCV_FISHEYE": ("fisheye", 4),  # k1, k2, k3, k4
+}
 
-        # translation
-        t = Vector3(img.tvec)
 
-        # invert
-        t = -R.T @ t
-        _R = Matrix33(R.T)
+def _parse_colmap_poses(model_folder: str) -> Poses:
+    # read the colmap model, only camera intrinsics and image poses are needed
+    cameras, images, _ = read_model(model_folder, poses_only=True)
+    images = list(images.values())
 
-        # intrinsics
-        cam = cameras[img.camera_id]
+    # Todo: finish this!
+
+    # intrinsics, only computed once per camera
+    # look into https://github.com/colmap/colmap/blob/dev/scripts/python/visualize_model.py
+    # to see how to get the camera parameters
+    cam_fovy, cam_ratio, cam_model, cam_distortion = {}, {}, {}, {}
+    for camera_id in {img.camera_id for img in images}:
+        cam = cameras[camera_id]
 
         if cam.model in ("SIMPLE_PINHOLE", "SIMPLE_RADIAL", "RADIAL"):
-            fx = fy = cam.params[0]
-            cx = cam.params[1]
-            cy = cam.params[2]
+            fy = cam.params[0]
         elif cam.model in ("PINHOLE", "OPENCV", "OPENCV_FISHEYE"):
-            fx = cam.params[0]
             fy = cam.params[1]
-            cx = cam.params[2]
-            cy = cam.params[3]
         else:
             raise Exception("Camera model not supported")
 
-        # intrinsics
-        K = np.identity(3)
-        K[0, 0] = fx
-        K[1, 1] = fy
-        K[0, 2] = cx
-        K[1, 2] = cy
-
         # field of view in degrees
-        cam_fovy = np.degrees(
+        cam_fovy[camera_id] = np.degrees(
             2 * np.arctan(cam.height / (2 * fy))
         )  # Todo: check if width or height is correct here!
-        # print("fovy:", cam_fovy)
-
-        # for some reason we need to modify the quaternion here.
-        # Colmap has a weird format???
-        # probably related to image convention 0,0 coordinate at left top corner vs left bottom corner
-        qt = _R.quaternion
-        _q = Quaternion(np.hstack((qt.w, qt.z, -qt.y, qt.x)))
-        # Todo: verify why we need this!!
-
-        shot = Shot(
-            os.path.join(image_folder, img.name),
-            Vector3(t),
-            _q,
-            fovy if fovy is not None else cam_fovy,
-            shot_aspect_ratio=cam.width / cam.height,
-            ctx=ctx,
-        )
-        shots.append(shot)
+        cam_ratio[camera_id] = cam.width / cam.height
+
+        # distortion coefficients, missing ones are zero
+        model, first = COLMAP_DISTORTIONS[cam.model]
+        cam_model[camera_id] = DISTORTION_MODELS.index(model)
+        cam_distortion[camera_id] = np.zeros(4)
+        if first is not None:
+            coefficients = cam.params[first : first + 4]
+            cam_distortion[camera_id][: len(coefficients)] = coefficients
+
+    # extrinsics of all images at once
+    qvecs = np.array([img.qvec for img in images], dtype=np.float64).reshape(-1, 4)
+    tvecs = np.array([img.tvec for img in images], dtype=np.float64).reshape(-1, 3)
+
+    # rotation
+    # pyrr.Quaternion format is x,y,z,w while colmap uses w,x,y,z!!!
+    R = rotation_matrices(qvecs[:, [1, 2, 3, 0]])
+
+    # invert
+    _R = R.transpose(0, 2, 1)
+    t = -np.einsum("nij,nj->ni", _R, tvecs)
+
+    # for some reason we need to modify the quaternion here.
+    # Colmap has a weird format???
+    # probably related to image convention 0,0 coordinate at left top corner vs left bottom corner
+    # (w, z, -y, x) of the inverted rotation
+    _q = quaternions_from_matrices(_R)[:, [3, 2, 1, 0]] * np.array(
+        [1.0, 1.0, -1.0, 1.0]
+    )
+    # Todo: verify why we need this!!
+
+    return Poses(
+        np.array([img.name for img in images], dtype=str),
+        t,
+        _q,
+        np.array([cam_fovy[img.camera_id] for img in images], dtype=np.float64),
+        np.array([cam_ratio[img.camera_id] for img in images], dtype=np.float64),
+        np.array([cam_model[img.camera_id] for img in images], dtype=np.int32),
+        np.array([cam_distortion[img.camera_id] for img in images]).reshape(-1, 4),
+    )
 
-    return shots
+
+# Todo!!
+@traced("loader")
+def load_shots_from_colmap(
+    model_folder: str,
+    image_folder: str,
+    fovy: float = None,
+    ctx: moderngl.Context = None,
+    cache_poses: bool = False,
+):
+    """
+    Loads shots from a colmap.
+    With cache_poses the parsed poses are stored in the model folder
+    (`POSE_CACHE_SUFFIX`) and reused as long as the model is unchanged.
+    """
+    sources = [
+        os.path.join(model_folder, file)
+        for file in ("cameras.bin", "images.bin", "cameras.txt", "images.txt")
+        if os.path.isfile(os.path.join(model_folder, file))
+    ]
+    poses = _load_poses(
+        lambda: _parse_colmap_poses(model_folder),
+        sources,
+        os.path.join(model_folder, "model" + POSE_CACHE_SUFFIX),
+        cache_poses,
+    )
+    if fovy is not None:
+        poses = poses._replace(fovy=np.full(len(poses.files), float(fovy)))
+    return _shots_from_poses(poses, image_folder, fovy, ctx)
@@ -92,7 +92,8 @@ class RendererThread(QObject):
         self._terminate = value
 
     def run(self):
-        self._ctx = moderngl.create_standalone_context()
+        # every thread has its own default context
+        self._ctx = alfr.ContextManager.get_default_context()
         self._renderer = alfr.Renderer(resolution=self._resolution, ctx=self._ctx)
 
         self._shots = alfr.load_shots_from_json(
@@ -347,11 +348,13 @@ class CameraWidget(QWidget):
     def _on_position_changed(self, vec: Vector3):
         # print(f"Camera position: {self._camera.position}")
         # print(f"Signal position: {vec}")
+        self._camera.position = vec  # assign, so the camera rebuilds its matrices
         self.cameraChanged.emit(self._camera)
 
     def _on_rotation_changed(self, q: Quaternion):
         # print(f"Camera rotation: {self._camera.rotation}")
         # print(f"Signal rotation: {q}")
+        self._camera.rotation = q  # assign, so the camera rebuilds its matrices
         self.cameraChanged.emit(self._camera)
 
     def _on_fov_changed(self, value: float):
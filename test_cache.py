@@ -0,0 +1,156 @@
+"""
+Check the result cache: hits and misses, eviction, the disk tier and the
+invalidation of keys (run directly or with pytest)
+"""
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import alfr
+from pyrr import Quaternion
+
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+RESOLUTION = (64, 64)
+RESULT_BYTES = RESOLUTION[0] * RESOLUTION[1] * 4 * 4  # float32 RGBA integrals
+
+
+def debug_scene_camera(x=0.0):
+    return alfr.Camera(quaternion=Quaternion.from_y_rotation(np.pi), position=[x, 0, 0])
+
+
+def test_hits_and_misses():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer(RESOLUTION)
+    vcam = debug_scene_camera()
+    expected = renderer.integrate(shots, vcam)
+
+    renderer.cache = alfr.ResultCache()
+    first = renderer.integrate(shots, vcam)
+    first[:] = 0  # results are copies
+    second = renderer.integrate(shots, vcam)
+    assert np.array_equal(second, expected)
+    assert renderer.cache.stats()[:3] == (1, 0, 1)
+
+    # the same shots as collection, closer than the quantization, default focus
+    renderer.integrate(alfr.ShotCollection.from_shots(shots), debug_scene_camera(1e-5))
+    renderer.integrate(shots, vcam, focus=alfr.FOCAL_PLANE_Z)
+    assert renderer.cache.stats().hits == 3
+
+    # other arguments
+    renderer.integrate(shots, vcam, focus=12.0)
+    renderer.integrate(shots, vcam, method="median")
+    renderer.project_shot(shots[0], vcam)
+    assert renderer.cache.stats().misses == 4
+
+    # weights given as list are cached, weight functions bypass the cache
+    weights = list(range(1, len(shots) + 1))
+    weighted = renderer.integrate(shots, vcam, weights=weights)
+    assert np.array_equal(renderer.integrate(shots, vcam, weights=weights), weighted)
+    renderer.integrate(shots, vcam, weights=lambda shots, vcam: np.ones(len(shots)))
+    stats = renderer.cache.stats()
+    assert (stats.hits, stats.misses, stats.bypassed) == (4, 5, 1)
+
+
+def test_eviction():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer(RESOLUTION)
+    renderer.cache = alfr.ResultCache(max_bytes=2 * RESULT_BYTES)
+    for x in (0.0, 0.1, 0.2):
+        renderer.integrate(shots, debug_scene_camera(x))
+    stats = renderer.cache.stats()
+    assert (stats.evictions, stats.entries, stats.bytes) == (1, 2, 2 * RESULT_BYTES)
+
+    renderer.integrate(shots, debug_scene_camera(0.2))  # kept
+    renderer.integrate(shots, debug_scene_camera(0.0))  # evicted
+    assert renderer.cache.stats()[:3] == (1, 0, 4)
+
+
+def test_key_invalidation():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer(RESOLUTION)
+    renderer.cache = alfr.ResultCache()
+    vcam = debug_scene_camera()
+    renderer.integrate(shots, vcam)
+
+    shots[0].position = shots[0].position + [1.0, 0.0, 0.0]
+    moved = renderer.integrate(shots, vcam)
+    shots[1].weight = 0.5
+    renderer.integrate(shots, vcam)
+    assert renderer.cache.stats().misses == 3
+
+    # back to the moved state
+    shots[1].weight = 1.0
+    assert np.array_equal(renderer.integrate(shots, vcam), moved)
+    assert renderer.cache.stats()[:3] == (1, 0, 3)
+
+
+def test_disk_tier():
+    with tempfile.TemporaryDirectory() as directory:
+        scene = os.path.join(directory, "scene")
+        shutil.copytree(os.path.dirname(DEBUG_SCENE), scene)
+        pose_file = os.path.join(scene, os.path.basename(DEBUG_SCENE))
+        cache_dir = os.path.join(directory, "cache")
+        vcam = debug_scene_camera()
+
+        renderer = alfr.Renderer(RESOLUTION)
+        renderer.cache = alfr.ResultCache(disk_dir=cache_dir)
+        expected = renderer.integrate(alfr.load_shots_from_json(pose_file), vcam)
+
+        # a new cache (e.g. after a restart) and reloaded shots
+        renderer.cache = alfr.ResultCache(disk_dir=cache_dir)
+        shots = alfr.load_shots_from_json(pose_file)
+        assert np.array_equal(renderer.integrate(shots, vcam), expected)
+        assert renderer.cache.stats()[:3] == (0, 1, 0)
+
+        # a rewritten image gives a new key
+        image_file = shots[0].image_file
+        os.utime(image_file, ns=(1, 1))
+        renderer.cache = alfr.ResultCache(disk_dir=cache_dir)
+        renderer.integrate(alfr.load_shots_from_json(pose_file), vcam)
+        assert renderer.cache.stats()[:3] == (0, 0, 1)
+
+        # the memory limit is kept on disk too
+        renderer.cache = alfr.ResultCache(disk_dir=cache_dir, max_disk_bytes=0)
+        renderer.integrate(shots, debug_scene_camera(0.1))
+        assert not os.listdir(cache_dir)
+
+
+def test_textures_of_thread_contexts():
+    """Shots from arrays have the same texture names in the contexts of threads."""
+    cache = alfr.ResultCache()
+    results = {}
+
+    def render(value):
+        try:
+            shot = alfr.Shot(
+                np.full((8, 8, 3), value, dtype=np.uint8),
+                [0.0, 0.0, 0.0],
+                [0.0, 1.0, 0.0, 0.0],
+            )
+            renderer = alfr.Renderer(RESOLUTION)
+            renderer.cache = cache
+            results[value] = renderer.integrate([shot], debug_scene_camera())
+        finally:
+            alfr.ContextManager.release_thread_context()
+
+    for value in (50, 200):
+        thread = threading.Thread(target=render, args=(value,))
+        thread.start()
+        thread.join()
+    assert cache.stats().misses == 2
+    assert not np.array_equal(results[50], results[200])
+
+
+if __name__ == "__main__":
+    test_hits_and_misses()
+    test_eviction()
+    test_key_invalidation()
+    test_disk_tier()
+    test_textures_of_thread_contexts()
+    print("ok")
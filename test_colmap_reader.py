@@ -0,0 +1,65 @@
+"""
+Check the fast COLMAP reader against the thirdparty reader on small models
+with 0, 1 and many 2D points per image (run directly or with pytest)
+"""
+import tempfile
+import numpy as np
+import alfr.colmap
+import alfr.thirdparty.read_write_model as rwm
+
+
+def write_test_model(path, points_per_image):
+    rng = np.random.default_rng(0)
+    cameras = {
+        1: rwm.Camera(1, "SIMPLE_RADIAL", 640, 480, np.array([500.0, 320, 240, 0.01]))
+    }
+    images, points3D = {}, {}
+    for image_id, num_points in enumerate(points_per_image, start=1):
+        qvec = rng.normal(size=4)
+        images[image_id] = rwm.Image(
+            id=image_id,
+            qvec=qvec / np.linalg.norm(qvec),
+            tvec=rng.normal(size=3),
+            camera_id=1,
+            name=f"image_{image_id}.png",
+            xys=rng.uniform(0, 480, size=(num_points, 2)),
+            point3D_ids=rng.integers(-1, 100, size=num_points),
+        )
+    for point3D_id, track_length in enumerate(points_per_image, start=1):
+        points3D[point3D_id] = rwm.Point3D(
+            id=point3D_id,
+            xyz=rng.normal(size=3),
+            rgb=rng.integers(0, 256, size=3),
+            error=rng.uniform(),
+            image_ids=rng.integers(1, 10, size=track_length),
+            point2D_idxs=rng.integers(0, 100, size=track_length),
+        )
+    rwm.write_model(cameras, images, points3D, path, ext=".bin")
+
+
+def assert_same_model(expected, actual):
+    for expected_items, actual_items in zip(expected, actual):
+        assert expected_items.keys() == actual_items.keys()
+        for key, expected_item in expected_items.items():
+            actual_item = actual_items[key]
+            assert type(expected_item) is type(actual_item)
+            for field, expected_value in expected_item._asdict().items():
+                actual_value = getattr(actual_item, field)
+                if isinstance(expected_value, np.ndarray):
+                    assert expected_value.shape == actual_value.shape, field
+                    assert np.array_equal(expected_value, actual_value), field
+                else:
+                    assert expected_value == actual_value, field
+
+
+def test_read_model_points_per_image():
+    for points_per_image in ([0], [1], [2], [1, 0, 1], [50, 1, 0, 7]):
+        with tempfile.TemporaryDirectory() as path:
+            write_test_model(path, points_per_image)
+            expected = rwm.read_model(path, ext=".bin")
+            assert_same_model(expected, alfr.colmap.read_model(path, ext=".bin"))
+
+
+if __name__ == "__main__":
+    test_read_model_points_per_image()
+    print("ok")
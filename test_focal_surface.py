@@ -0,0 +1,73 @@
+"""
+Check that hidden layers of a focal surface do not contribute to the integrals,
+statistics and weighted integrals, and that the focus moves a surface like the
+focal plane (run directly or with pytest)
+"""
+import os
+import numpy as np
+import alfr
+from pyrr import Quaternion
+
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+
+
+def quad(z, size=50.0):
+    return [[-size, -size, z], [size, -size, z], [size, size, z], [-size, size, z]]
+
+
+def test_hidden_surface_layers():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer((256, 256))
+    vcam = alfr.Camera(quaternion=Quaternion.from_y_rotation(np.pi))
+    front = alfr.FocalSurface(quad(10.0), [[0, 1, 2], [0, 2, 3]], levels=1, tiles=1)
+    # the same front quad and a hidden quad behind it
+    layers = alfr.FocalSurface(
+        quad(10.0) + quad(14.0),
+        [[0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7]],
+        levels=1,
+        tiles=1,
+    )
+
+    calls = [
+        lambda: renderer.integrate(shots, vcam, method=method)
+        for method in alfr.INTEGRATION_METHODS
+    ]
+    calls.append(lambda: renderer.statistics(shots, vcam).mean)
+    calls.append(
+        lambda: renderer.integrate(
+            shots, vcam, weights=np.arange(1.0, len(shots) + 1.0), border=0.2
+        )
+    )
+    for call in calls:
+        renderer.focal_surface = front
+        expected = call()
+        renderer.focal_surface = layers
+        for _ in range(2):  # also with the uniforms left by the previous call
+            assert np.abs(call() - expected).max() < 1e-3
+
+
+def test_surface_focus():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer((256, 256))
+    vcam = alfr.Camera(quaternion=Quaternion.from_y_rotation(np.pi))
+    plane = alfr.FocalSurface(
+        quad(alfr.FOCAL_PLANE_Z), [[0, 1, 2], [0, 2, 3]], levels=1, tiles=1
+    )
+    for focus in (None, alfr.FOCAL_PLANE_Z, 12.0):
+        renderer.focal_surface = None
+        expected = renderer.integrate(shots, vcam, focus=focus)
+        renderer.focal_surface = plane
+        # the triangulations differ, so the interpolation differs slightly
+        error = np.abs(renderer.integrate(shots, vcam, focus=focus) - expected)
+        assert error.max() < 0.5, f"focus {focus}: {error.max()}"
+
+
+if __name__ == "__main__":
+    test_hidden_surface_layers()
+    test_surface_focus()
+    print("ok")
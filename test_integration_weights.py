@@ -0,0 +1,39 @@
+"""
+Check that scaling all shot weights leaves the integrals unchanged, for every
+integration method with and without border weights (run directly or with pytest)
+"""
+import os
+import numpy as np
+import alfr
+from pyrr import Quaternion
+
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+
+
+def test_uniform_weight_scaling():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer((256, 256))
+    vcam = alfr.Camera(quaternion=Quaternion.from_y_rotation(np.pi))
+    for method in alfr.INTEGRATION_METHODS:
+        for border in (0.0, 0.2):
+            integral = renderer.integrate(shots, vcam, method=method, border=border)
+            assert integral[..., 3].max() > 0, "the camera does not see the shots"
+            scaled = renderer.integrate(
+                shots,
+                vcam,
+                method=method,
+                border=border,
+                weights=np.full(len(shots), 2.0),
+            )
+            error = np.abs(integral - scaled).max()
+            assert error < 1e-3, f"{method} with border {border}: {error}"
+
+
+if __name__ == "__main__":
+    test_uniform_weight_scaling()
+    print("ok")
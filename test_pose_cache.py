@@ -0,0 +1,46 @@
+"""
+Check that damaged pose cache files are ignored and written again
+(run directly or with pytest)
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+import alfr
+from alfr.utils import POSE_CACHE_SUFFIX
+
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+
+
+def test_damaged_pose_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        scene = os.path.join(directory, "scene")
+        shutil.copytree(os.path.dirname(DEBUG_SCENE), scene)
+        pose_file = os.path.join(scene, os.path.basename(DEBUG_SCENE))
+        cache_file = pose_file + POSE_CACHE_SUFFIX
+        expected = alfr.load_shots_from_json(pose_file, cache_poses=True)
+        with open(cache_file, "rb") as f:
+            data = f.read()
+
+        # truncated (no zip directory), cut within a member, empty
+        for damaged in (data[: len(data) // 2], data[: len(data) - 30], b""):
+            with open(cache_file, "wb") as f:
+                f.write(damaged)
+            shots = alfr.load_shots_from_json(pose_file, cache_poses=True)
+            for shot, expected_shot in zip(shots, expected):
+                assert np.array_equal(shot.position, expected_shot.position)
+            with open(cache_file, "rb") as f:
+                assert f.read() == data  # written again
+        assert sorted(os.listdir(scene)) == sorted(
+            os.listdir(os.path.dirname(DEBUG_SCENE)) + [os.path.basename(cache_file)]
+        )
+
+
+if __name__ == "__main__":
+    test_damaged_pose_cache()
+    print("ok")
@@ -0,0 +1,45 @@
+"""
+Check the render stats: a call that raises within its stages is not recorded
+and leaves no stage or query behind (run directly or with pytest)
+"""
+import os
+import alfr
+
+DEBUG_SCENE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "debug_scene",
+    "blender_poses.json",
+)
+
+
+def test_call_raising_within_stages():
+    shots = alfr.load_shots_from_json(DEBUG_SCENE)
+    renderer = alfr.Renderer((64, 64))
+    stats = renderer.stats
+    stats.enabled = True
+    try:
+        with stats.call("integrate"):
+            with stats.stage("setup"):
+                pass
+            held = renderer._bind_shots(shots)  # holds the draw stage
+            next(held)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert not stats.calls
+    assert not stats._stages and not stats._pending
+
+    # the held stage is closed within the next call, which is not affected
+    with stats.call("integrate"):
+        with stats.stage("setup"):
+            held.close()
+    assert len(stats.calls) == 1
+    assert all(seconds >= 0.0 for seconds in stats.last.cpu.values())
+    assert stats.last.cpu["draw"] == 0.0
+    assert not stats._stages and not stats._pending
+
+
+if __name__ == "__main__":
+    test_call_raising_within_stages()
+    print("ok")